@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+'''
+Benchmark the http backends of the test origins (see tsqa.wsgi)
+
+For each backend this starts a server in this process and hammers it from
+client processes, reporting requests/sec and requests/sec per cpu-second the
+server used (measured with getrusage, so only the server's cpu is counted).
+
+    python benchmarks/origin_benchmark.py --duration 10 --clients 4 --concurrency 32
+'''
+#  Licensed to the Apache Software Foundation (ASF) under one
+#  or more contributor license agreements.  See the NOTICE file
+#  distributed with this work for additional information
+#  regarding copyright ownership.  The ASF licenses this file
+#  to you under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance
+#  with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import httplib
+import multiprocessing
+import resource
+import socket
+import threading
+import time
+import wsgiref.simple_server
+
+import tsqa.utils
+import tsqa.wsgi
+
+BODY = 'x' * 100
+
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(BODY)))])
+    return [BODY]
+
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def fetch(address):
+    '''
+    Do one request on its own connection, returning whether it succeeded
+    '''
+    sock = socket.create_connection(address)
+    try:
+        sock.sendall('GET / HTTP/1.0\r\nHost: origin\r\n\r\n')
+        data = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+        return ''.join(data).startswith('HTTP/1.') and ''.join(data).endswith(BODY)
+    finally:
+        sock.close()
+
+
+def client(address, concurrency, deadline, keep_alive, results):
+    '''
+    Run concurrency threads doing requests until deadline, and put the
+    (successes, failures) on results. With keep_alive each thread reuses one
+    HTTP/1.1 connection, otherwise every request gets its own
+    '''
+    counts = [0, 0]
+    lock = threading.Lock()
+
+    def loop():
+        conn = httplib.HTTPConnection(*address) if keep_alive else None
+        while time.time() < deadline:
+            try:
+                if conn is None:
+                    ok = fetch(address)
+                else:
+                    conn.request('GET', '/')
+                    ok = conn.getresponse().read() == BODY
+            except (socket.error, httplib.HTTPException):
+                ok = False
+                if conn is not None:
+                    conn.close()
+            with lock:
+                counts[0 if ok else 1] += 1
+        if conn is not None:
+            conn.close()
+
+    threads = [threading.Thread(target=loop) for _ in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(tuple(counts))
+
+
+def hold_connections(address, count):
+    '''
+    Open count idle connections, to check a backend copes with many
+    connections while serving others
+    '''
+    socks = []
+    for _ in xrange(count):
+        socks.append(socket.create_connection(address))
+    return socks
+
+
+def run(backend, args):
+    sock, port = tsqa.utils.bind_unused_port()
+    sock.close()
+    kwargs = {'handler_class': QuietHandler} if backend == 'simple' else {}
+    server = tsqa.wsgi.make_server('127.0.0.1', port, app, backend=backend, **kwargs)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    address = ('127.0.0.1', port)
+
+    idle = hold_connections(address, args.idle) if backend != 'simple' else []
+    results = multiprocessing.Queue()
+    deadline = time.time() + args.duration
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    clients = [multiprocessing.Process(target=client, args=(address, args.concurrency, deadline, args.keep_alive, results))
+               for _ in xrange(args.clients)]
+    for proc in clients:
+        proc.start()
+    counts = [results.get() for _ in clients]
+    elapsed = time.time() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    for proc in clients:
+        proc.join()
+
+    for sock in idle:
+        sock.close()
+    connections = server.counters()['connections'] - len(idle)
+    server.shutdown()
+    server.server_close()
+
+    successes = sum(count[0] for count in counts)
+    failures = sum(count[1] for count in counts)
+    cpu = (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime)
+    return {
+        'backend': backend,
+        'requests': successes,
+        'failures': failures,
+        'connections': connections,
+        'rps': successes / elapsed,
+        'cpu': cpu,
+        'rps_per_core': successes / cpu if cpu else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--backend', action='append', dest='backends',
+                        help='backend to benchmark (repeatable, default all)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per backend')
+    parser.add_argument('--clients', type=int, default=multiprocessing.cpu_count(),
+                        help='client processes')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='concurrent requests per client process')
+    parser.add_argument('--idle', type=int, default=1000,
+                        help='idle connections to hold open against the thread/event backends')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='reuse connections (simple never keeps them open)')
+    args = parser.parse_args()
+
+    backends = args.backends or ['simple'] + sorted(tsqa.wsgi.BACKENDS)
+    print '{0:<8} {1:>10} {2:>8} {3:>12} {4:>10} {5:>8} {6:>12}'.format(
+        'backend', 'requests', 'failed', 'connections', 'req/s', 'cpu(s)', 'req/s/core')
+    for backend in backends:
+        result = run(backend, args)
+        print '{backend:<8} {requests:>10} {failures:>8} {connections:>12} {rps:>10.0f} {cpu:>8.2f} {rps_per_core:>12.0f}'.format(**result)
+
+
+if __name__ == '__main__':
+    main()
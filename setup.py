@@ -14,6 +14,9 @@ config = {
     'install_requires': ['nose', 'unittest2', 'requests', 'flask', 'httpbin'],
     'packages': ['tsqa'],
     'scripts': [],
+    'entry_points': {
+        'console_scripts': ['tsqa = tsqa.runner:main'],
+    },
     'name': 'tsqa'
 }
 
@@ -0,0 +1,172 @@
+'''
+Test the EnvironmentFactory against a tiny autotools project
+'''
+
+import tsqa.utils
+unittest = tsqa.utils.import_unittest()
+import tsqa.environment
+
+import tempfile
+import shutil
+import os
+import subprocess
+
+CONFIGURE_AC = '''AC_INIT([tsqa-fake], [1.0])
+AM_INIT_AUTOMAKE([foreign])
+AC_ARG_ENABLE([variant], [AS_HELP_STRING([--enable-variant], [fake variant])])
+AC_CONFIG_FILES([Makefile])
+AC_OUTPUT
+'''
+
+MAKEFILE_AM = '''bin_SCRIPTS = traffic_cop
+EXTRA_DIST = traffic_cop
+'''
+
+
+def commit(path):
+    for cmd in (['git', 'add', '-A'],
+                ['git', '-c', 'user.name=tsqa', '-c', 'user.email=tsqa@localhost',
+                 'commit', '-q', '-m', 'fake'],
+                ):
+        tsqa.utils.run_sync_command(cmd, cwd=path)
+
+
+def make_source_dir(path):
+    '''
+    Create a git repo with a minimal autotools project in it
+    '''
+    with open(os.path.join(path, 'configure.ac'), 'w') as fh:
+        fh.write(CONFIGURE_AC)
+    with open(os.path.join(path, 'Makefile.am'), 'w') as fh:
+        fh.write(MAKEFILE_AM)
+    with open(os.path.join(path, 'traffic_cop'), 'w') as fh:
+        fh.write('#! /usr/bin/env sh\n')
+    tsqa.utils.run_sync_command(['git', 'init', '-q'], cwd=path)
+    commit(path)
+
+
+class TestEnvironmentFactory(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, 'src')
+        os.makedirs(self.source_dir)
+        make_source_dir(self.source_dir)
+        self.ef = tsqa.environment.EnvironmentFactory(self.source_dir,
+                                                      os.path.join(self.tmp_dir, 'cache'))
+
+    def tearDown(self):
+        tsqa.environment.EnvironmentFactory.negative_cache.clear()
+        tsqa.environment.EnvironmentFactory.pending_builds.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_schedule_builds(self):
+        variants = [{'configure': None, 'env': None},
+                    {'configure': {'enable-variant': None}, 'env': None},
+                    # duplicate of the first one
+                    {'configure': {}, 'env': None},
+                    ]
+        results = self.ef.schedule_builds(variants, cpu_budget=2)
+        self.assertEqual(len(results), 2)
+
+        for key, result in results.iteritems():
+            result.get()
+            self.assertIn(key, self.ef.environment_stash)
+
+        # already built, nothing to schedule
+        self.assertEqual(self.ef.schedule_builds(variants), {})
+
+        env = self.ef.get_environment({'enable-variant': None})
+        try:
+            self.assertTrue(os.path.exists(os.path.join(env.layout.bindir, 'traffic_cop')))
+        finally:
+            env.destroy()
+        self.assertEqual(tsqa.environment.EnvironmentFactory.pending_builds, {})
+
+    def test_single_flight(self):
+        env = self.ef.get_environment()
+        env.destroy()
+        key = self.ef.environment_stash.keys()[0]
+        path = self.ef.environment_stash[key]['path']
+
+        # another "process" with its own view of the cache, which missed
+        ef = tsqa.environment.EnvironmentFactory(self.source_dir,
+                                                 os.path.join(self.tmp_dir, 'cache'))
+        ef.class_environment_stash._dict = {}
+        ef._build(*ef._resolve())
+        self.assertEqual(ef.environment_stash[key]['path'], path)
+
+    def test_autoreconf(self):
+        configure = os.path.join(self.source_dir, 'configure')
+        self.ef.autoreconf()
+        mtime = os.stat(configure).st_mtime
+
+        # nothing changed, so autoreconf shouldn't run again
+        self.ef.autoreconf()
+        self.assertEqual(os.stat(configure).st_mtime, mtime)
+
+        # changing an input regenerates
+        makefile_am = os.path.join(self.source_dir, 'Makefile.am')
+        with open(makefile_am, 'a') as fh:
+            fh.write('# changed\n')
+        self.ef.autoreconf()
+        with open(os.path.join(self.source_dir, 'Makefile.in')) as fh:
+            self.assertIn('# changed', fh.read())
+
+        # going back restores the cached output
+        with open(makefile_am, 'w') as fh:
+            fh.write(MAKEFILE_AM)
+        self.ef.autoreconf()
+        with open(os.path.join(self.source_dir, 'Makefile.in')) as fh:
+            self.assertNotIn('# changed', fh.read())
+
+    def test_autoreconf_installed_macros(self):
+        # libtoolize installs m4/libtool.m4 (and friends), which aren't inputs
+        with open(os.path.join(self.source_dir, 'configure.ac'), 'w') as fh:
+            fh.write(CONFIGURE_AC.replace('AM_INIT_AUTOMAKE([foreign])\n',
+                                          'AM_INIT_AUTOMAKE([foreign])\nAC_CONFIG_MACRO_DIR([m4])\nLT_INIT\n'))
+        with open(os.path.join(self.source_dir, 'Makefile.am'), 'a') as fh:
+            fh.write('ACLOCAL_AMFLAGS = -I m4\n')
+        os.makedirs(os.path.join(self.source_dir, 'm4'))
+        configure = os.path.join(self.source_dir, 'configure')
+        self.ef.autoreconf()
+        self.assertTrue(os.path.isfile(os.path.join(self.source_dir, 'm4', 'libtool.m4')))
+        mtime = os.stat(configure).st_mtime
+
+        self.ef.autoreconf()
+        self.assertEqual(os.stat(configure).st_mtime, mtime)
+
+    def test_incremental(self):
+        ef = tsqa.environment.EnvironmentFactory(self.source_dir,
+                                                 os.path.join(self.tmp_dir, 'cache'),
+                                                 incremental=True)
+        env = ef.get_environment()
+        env.destroy()
+        key = ef.environment_stash.keys()[0]
+        builddir = ef._get_build_dir(key)
+        self.assertTrue(os.path.isfile(os.path.join(builddir, 'Makefile')))
+
+        # move the source forward, and make sure we rebuild in the same tree
+        with open(os.path.join(self.source_dir, 'traffic_cop'), 'a') as fh:
+            fh.write('# new commit\n')
+        commit(self.source_dir)
+        ef = tsqa.environment.EnvironmentFactory(self.source_dir,
+                                                 os.path.join(self.tmp_dir, 'cache'),
+                                                 incremental=True)
+        env = ef.get_environment()
+        try:
+            with open(os.path.join(env.layout.bindir, 'traffic_cop')) as fh:
+                self.assertIn('new commit', fh.read())
+        finally:
+            env.destroy()
+        self.assertEqual(ef._get_build_dir(key), builddir)
+        self.assertTrue(os.path.isfile(os.path.join(builddir, 'Makefile')))
+
+        # another source dir never reuses this tree
+        other = tsqa.environment.EnvironmentFactory(self.tmp_dir,
+                                                    os.path.join(self.tmp_dir, 'cache'),
+                                                    incremental=True)
+        self.assertNotEqual(other._get_build_dir(key), builddir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,424 @@
+'''
+Test Environment (and friends) using a fake layout
+'''
+
+import tsqa.utils
+unittest = tsqa.utils.import_unittest()
+import tsqa.environment
+
+import tempfile
+import shutil
+import os
+import subprocess
+import sys
+import time
+import json
+
+
+def make_layout(prefix):
+    '''
+    Create a layout which looks enough like an ATS install to be cloned
+    '''
+    layout = tsqa.environment.Layout(prefix)
+    for name in ('bindir', 'libdir', 'sysconfdir'):
+        os.makedirs(getattr(layout, name))
+    with open(os.path.join(layout.bindir, 'traffic_cop'), 'w') as fh:
+        fh.write('#! /usr/bin/env sh\n')
+    with open(os.path.join(layout.libdir, 'libtsutil.so'), 'w') as fh:
+        fh.write('not really a library')
+    for name in ('records.config', 'remap.config', 'storage.config'):
+        open(os.path.join(layout.sysconfdir, name), 'w').close()
+    return layout
+
+
+# something shaped like traffic_cop: listens on the ports in records.config
+# and logs to diags.log
+FAKE_COP = '''#! {python}
+import os, socket, time
+sysconfdir = os.path.join(os.environ['TS_ROOT'], 'etc', 'trafficserver')
+records = dict(line.split()[1::2] for line in open(os.path.join(sysconfdir, 'records.config')) if line.strip())
+socks = []
+for name in ('proxy.config.http.server_ports',
+             'proxy.config.process_manager.mgmt_port',
+             'proxy.config.admin.synthetic_port'):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', int(records[name])))
+    sock.listen(5)
+    socks.append(sock)
+with open(os.path.join(os.environ['TS_ROOT'], 'var', 'log', 'diags.log'), 'a') as fh:
+    fh.write('NOTE: cache enabled\\nNOTE: traffic server running\\n')
+time.sleep(60)
+'''.format(python=sys.executable)
+
+
+class EnvironmentTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.layout = make_layout(os.path.join(self.tmp_dir, 'layout'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def clone(self, **kwargs):
+        env = tsqa.environment.Environment()
+        env.clone(layout=self.layout, **kwargs)
+        self.addCleanup(env.destroy)
+        return env
+
+
+class TestClone(EnvironmentTestCase):
+    def test_link(self):
+        env = self.clone(mode='link')
+        with open(os.path.join(env.layout.libdir, 'libtsutil.so')) as fh:
+            self.assertEqual(fh.read(), 'not really a library')
+        # configs are always real copies
+        path = os.path.join(env.layout.sysconfdir, 'remap.config')
+        self.assertFalse(os.path.islink(path))
+        self.assertFalse(os.path.samefile(path, os.path.join(self.layout.sysconfdir, 'remap.config')))
+
+    def test_reflink(self):
+        # the default, which never shares an inode with the cached layout
+        os.makedirs(self.layout.plugindir)
+        with open(os.path.join(self.layout.plugindir, 'stats_over_http.so'), 'w') as fh:
+            fh.write('not really a plugin')
+        env = self.clone()
+        path = os.path.join(env.layout.plugindir, 'stats_over_http.so')
+        self.assertFalse(os.path.islink(path))
+        self.assertFalse(os.path.samefile(path, os.path.join(self.layout.plugindir, 'stats_over_http.so')))
+
+    def test_symlinked(self):
+        # bin and lib are symlinked, whatever the mode
+        for mode in ('reflink', 'link', 'copy'):
+            env = self.clone(mode=mode)
+            self.assertTrue(os.path.islink(os.path.join(env.layout.bindir, 'traffic_cop')))
+            self.assertTrue(os.path.islink(os.path.join(env.layout.libdir, 'libtsutil.so')))
+
+    def test_cache_storage(self):
+        env = self.clone(cache_storage_size='200M')
+        with open(os.path.join(env.layout.sysconfdir, 'storage.config')) as fh:
+            path, size = fh.read().split()
+        self.assertEqual(int(size), 200 * 1024 * 1024)
+        self.assertEqual(os.path.getsize(path), int(size))
+        # sparse
+        self.assertLess(os.stat(path).st_blocks * 512, int(size))
+        env.destroy()
+        self.assertFalse(os.path.exists(path))
+
+    def test_cache_storage_fallback(self):
+        env = self.clone()
+        env.tmpfs_dir = os.path.join(self.tmp_dir, 'no_tmpfs')
+        path = env.setup_cache_storage(1024)
+        self.assertTrue(path.startswith(env.layout.prefix))
+        # sized up to the minimum
+        self.assertEqual(os.path.getsize(path), env.min_cache_storage_size)
+
+    def test_tmpfs(self):
+        if tsqa.utils.free_space(tsqa.environment.Environment.tmpfs_dir) == 0:
+            self.skipTest('no tmpfs')
+        env = self.clone(tmpfs=True)
+        self.assertEqual(os.path.dirname(env.layout.prefix), env.tmpfs_dir)
+        with open(os.path.join(env.layout.libdir, 'libtsutil.so')) as fh:
+            self.assertEqual(fh.read(), 'not really a library')
+
+
+class TestEnvironmentPool(EnvironmentTestCase):
+    def test_pool(self):
+        created = []
+
+        def create():
+            env = tsqa.environment.Environment()
+            env.clone(layout=self.layout)
+            created.append(env)
+            return env
+
+        pool = tsqa.environment.EnvironmentPool(create, size=2)
+        env = pool.get()
+        self.addCleanup(env.destroy)
+        self.assertTrue(os.path.isdir(env.layout.sysconfdir))
+
+        pool.close()
+        # whatever was left in the pool has been destroyed
+        for other in created:
+            if other is not env:
+                self.assertIsNone(other.layout.prefix)
+        self.assertIsNotNone(env.layout.prefix)
+        self.assertRaises(Exception, pool.get)
+
+
+class TestStop(EnvironmentTestCase):
+    def start_fake_cop(self, env, script='sleep 60 & sleep 60 & wait'):
+        '''
+        Start something shaped like traffic_cop: a process group with children
+        (which outlive their parent if they only kill it)
+        '''
+        tsqa.utils.become_subreaper()
+        env.cop = subprocess.Popen(['sh', '-c', script], stdout=subprocess.PIPE, preexec_fn=os.setsid)
+        env._pgid = env.cop.pid
+        return env.cop.pid
+
+    def test_stop(self):
+        env = self.clone()
+        pgid = self.start_fake_cop(env)
+        self.assertTrue(env.running())
+        start = time.time()
+        env.stop()
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(env.running())
+        self.assertRaises(OSError, os.killpg, pgid, 0)
+        self.assertIsNone(env._pgid)
+        # stopping again is a no-op
+        env.stop()
+
+    def test_stop_kill(self):
+        # ignores SIGTERM, so it is killed once the timeout passes
+        env = self.clone()
+        pgid = self.start_fake_cop(env, 'trap "" TERM; echo trapped; sleep 60 & sleep 60 & wait')
+        env.cop.stdout.readline()
+        start = time.time()
+        env.stop(timeout=0.2)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertFalse(env.running())
+        self.assertRaises(OSError, os.killpg, pgid, 0)
+        self.assertIsNone(env._pgid)
+
+    def test_stop_all(self):
+        envs = [self.clone() for _ in xrange(3)]
+        pgids = [self.start_fake_cop(env) for env in envs]
+        tsqa.environment.stop_all(envs)
+        for env, pgid in zip(envs, pgids):
+            self.assertFalse(env.running())
+            self.assertRaises(OSError, os.killpg, pgid, 0)
+
+
+class TestStart(EnvironmentTestCase):
+    def setUp(self):
+        super(TestStart, self).setUp()
+        os.unlink(os.path.join(self.layout.bindir, 'traffic_cop'))
+        with open(os.path.join(self.layout.bindir, 'traffic_cop'), 'w') as fh:
+            fh.write(FAKE_COP)
+        os.chmod(os.path.join(self.layout.bindir, 'traffic_cop'), 0755)
+
+    def test_process_group(self):
+        env = self.clone()
+        env.start()
+        self.assertEqual(os.getpgid(env.cop.pid), env.cop.pid)
+        self.assertEqual(os.getsid(env.cop.pid), env.cop.pid)
+        env.stop()
+        self.assertFalse(env.running())
+
+    def test_startup_profile(self):
+        env = self.clone()
+        env.start(log_marker='traffic server running')
+        self.assertEqual(env.wait_for_log('cache (\w+)').group(1), 'enabled')
+        env.stop()
+
+        profile = env.startup_profile
+        kinds = [event['kind'] for event in profile['events']]
+        self.assertEqual(kinds[0], 'exec')
+        self.assertEqual(kinds[-1], 'ready')
+        self.assertEqual(kinds.count('port'), 3)
+        self.assertIn('process', kinds)
+        self.assertEqual([event['name'] for event in profile['events'] if event['kind'] == 'log'],
+                         ['cache_enabled', 'server_running'])
+        with open(os.path.join(env.layout.prefix, 'startup_profile.json')) as fh:
+            self.assertEqual(json.load(fh)['total'], profile['total'])
+
+    def test_sampler(self):
+        env = self.clone()
+        sampler = env.start_sampler(interval=0.01)
+        env.start()
+        while len(sampler.series('traffic_cop', 'rss')) < 2:
+            time.sleep(0.01)
+        env.stop()
+        self.assertIs(env.stop_sampler(), sampler)
+        self.assertIsNone(env.sampler)
+        self.assertGreater(sampler.series('traffic_cop', 'rss').peak(), 0)
+        self.assertTrue(os.path.isfile(os.path.join(env.layout.prefix, 'resources.json')))
+        # and it can be started again
+        env.start_sampler(interval=0.01)
+
+        # the artifacts outlive the environment
+        env.results_dir = os.path.join(self.tmp_dir, 'results')
+        name = os.path.basename(env.layout.prefix)
+        env.destroy()
+        self.assertEqual(sorted(os.listdir(os.path.join(env.results_dir, name))),
+                         ['resources.json', 'startup_profile.json'])
+
+
+class TestReconfigure(EnvironmentTestCase):
+    def write_config(self, env, name, contents):
+        with open(os.path.join(env.layout.sysconfdir, name), 'w') as fh:
+            fh.write(contents)
+
+    def test_needs_restart(self):
+        env = self.clone()
+        self.write_config(env, 'records.config', 'CONFIG proxy.config.diags.debug.enabled INT 0\n')
+        env._loaded_configs = env._read_configs()
+        self.assertFalse(env.needs_restart())
+
+        # reloadable record
+        self.write_config(env, 'records.config', 'CONFIG proxy.config.diags.debug.enabled INT 1\n')
+        self.write_config(env, 'remap.config', 'map / http://127.0.0.1/\n')
+        self.assertFalse(env.needs_restart())
+
+        # a record which is only read on startup
+        with open(os.path.join(env.layout.sysconfdir, 'records.config'), 'a') as fh:
+            fh.write('CONFIG proxy.config.cache.ram_cache.size INT 1024\n')
+        self.assertTrue(env.needs_restart())
+
+        # a file which is only read on startup
+        env._loaded_configs = env._read_configs()
+        self.write_config(env, 'storage.config', '/tmp 1M\n')
+        self.assertTrue(env.needs_restart())
+
+        # reloadable cache records
+        env._loaded_configs = env._read_configs()
+        with open(os.path.join(env.layout.sysconfdir, 'records.config'), 'a') as fh:
+            fh.write('CONFIG proxy.config.cache.max_doc_size INT 1024\n')
+        self.assertFalse(env.needs_restart())
+
+    def test_reload_within_a_second(self):
+        with open(os.path.join(self.layout.bindir, 'traffic_cop'), 'w') as fh:
+            fh.write(FAKE_COP)
+        # the reconfigure time is always now (so it never changes), but reloads
+        # are logged
+        with open(os.path.join(self.layout.bindir, 'traffic_ctl'), 'w') as fh:
+            fh.write('#! /usr/bin/env sh\n'
+                     'case "$*" in\n'
+                     '"config reload") echo "NOTE: remap.config finished loading" >> "$TS_ROOT/var/log/diags.log" ;;\n'
+                     '*reconfigure_time) echo "$3 $(date +%s)" ;;\n'
+                     '*) echo "$3 0" ;;\n'
+                     'esac\n')
+        for name in ('traffic_cop', 'traffic_ctl'):
+            os.chmod(os.path.join(self.layout.bindir, name), 0755)
+        env = self.clone()
+        env.start(log_marker='traffic server running')
+        start = time.time()
+        for i in xrange(2):
+            self.write_config(env, 'remap.config', 'map /{0} http://127.0.0.1/\n'.format(i))
+            self.assertEqual(env.reconfigure(timeout=2), 'reload')
+        # without waiting for the reconfigure time to change
+        self.assertLess(time.time() - start, 1)
+        self.assertIsNone(env.reconfigure())
+
+
+class TestMetrics(EnvironmentTestCase):
+    def test_metrics(self):
+        env = self.clone()
+        traffic_ctl = os.path.join(env.layout.bindir, 'traffic_ctl')
+        with open(traffic_ctl, 'w') as fh:
+            fh.write('#! /usr/bin/env sh\necho "$@" >> "$TS_ROOT/calls"\ncat "$TS_ROOT/metrics"\n')
+        os.chmod(traffic_ctl, 0755)
+
+        def set_metrics(contents):
+            with open(os.path.join(env.layout.prefix, 'metrics'), 'w') as fh:
+                fh.write(contents)
+
+        set_metrics('proxy.process.http.completed_requests 10\n'
+                    'proxy.process.cache.percent_full 0.500000\n'
+                    'proxy.node.hostname localhost\n'
+                    'proxy.process.http.cache_hit_fresh 3\n')
+        before = env.metrics()
+        self.assertEqual(before['proxy.process.http.completed_requests'], 10)
+        self.assertEqual(before['proxy.process.cache.percent_full'], 0.5)
+        self.assertEqual(before['proxy.node.hostname'], 'localhost')
+
+        set_metrics('proxy.process.http.completed_requests 15\n'
+                    'proxy.process.cache.percent_full 0.500000\n'
+                    'proxy.node.hostname otherhost\n'
+                    'proxy.process.http.cache_hit_fresh 3\n'
+                    'proxy.process.http.cache_miss_cold 2\n')
+        self.assertEqual(env.metrics().diff(before),
+                         {'proxy.process.http.completed_requests': 5,
+                          'proxy.process.http.cache_miss_cold': 2,
+                          })
+
+        # one call per snapshot
+        with open(os.path.join(env.layout.prefix, 'calls')) as fh:
+            self.assertEqual(fh.read().splitlines(), ['metric match proxy\\.(process|node)\\..*'] * 2)
+
+
+class TestReset(EnvironmentTestCase):
+    def test_reset(self):
+        env = self.clone()
+        remap = os.path.join(env.layout.sysconfdir, 'remap.config')
+        records = os.path.join(env.layout.sysconfdir, 'records.config')
+        baseline = env._read_configs()
+        env.snapshot()
+
+        # dirty some state
+        with open(remap, 'w') as fh:
+            fh.write('map / http://127.0.0.1/\n')
+        with open(os.path.join(env.layout.sysconfdir, 'ssl_multicert.config'), 'w') as fh:
+            fh.write('dest_ip=* ssl_cert_name=foo.pem\n')
+        with open(os.path.join(env.layout.logdir, 'diags.log'), 'w') as fh:
+            fh.write('lots of logs')
+        os.makedirs(os.path.join(env.layout.runtimedir, 'cache'))
+        with open(os.path.join(env.layout.runtimedir, 'cache', 'cache.db'), 'w') as fh:
+            fh.write('cached things')
+        records_inode = os.stat(records).st_ino
+
+        env.reset()
+        self.assertEqual(env._read_configs(), baseline)
+        # untouched configs are left alone
+        self.assertEqual(os.stat(records).st_ino, records_inode)
+        self.assertEqual(os.path.getsize(os.path.join(env.layout.logdir, 'diags.log')), 0)
+        self.assertEqual(os.listdir(env.layout.runtimedir), [])
+
+        # the snapshot survives a reset
+        with open(remap, 'a') as fh:
+            fh.write('map /foo http://127.0.0.1/\n')
+        env.reset_configs()
+        self.assertEqual(env._read_configs(), baseline)
+
+    def test_reset_cache_storage(self):
+        env = self.clone()
+        with open(os.path.join(env.layout.sysconfdir, 'storage.config'), 'w') as fh:
+            fh.write('# comment\nvar/cache 256M\nvar/cache.file 64M\n')
+        os.makedirs(os.path.join(env.layout.prefix, 'var', 'cache'))
+        with open(os.path.join(env.layout.prefix, 'var', 'cache', 'cache.db'), 'w') as fh:
+            fh.write('cached things')
+        with open(os.path.join(env.layout.prefix, 'var', 'cache.file'), 'w') as fh:
+            fh.write('cached things')
+        env.snapshot()
+
+        env.reset()
+        self.assertEqual(os.listdir(os.path.join(env.layout.prefix, 'var', 'cache')), [])
+        self.assertFalse(os.path.exists(os.path.join(env.layout.prefix, 'var', 'cache.file')))
+
+    def test_reset_shared_storage(self):
+        # storage outside of the prefix (absolute, or escaping it) is left alone
+        shared = os.path.join(self.tmp_dir, 'shared')
+        os.makedirs(shared)
+        with open(os.path.join(shared, 'cache.db'), 'w') as fh:
+            fh.write('cached things')
+        env = self.clone()
+        with open(os.path.join(env.layout.sysconfdir, 'storage.config'), 'w') as fh:
+            fh.write('{0} 256M\n{1} 256M\n'.format(shared, os.path.relpath(shared, env.layout.prefix)))
+        env.snapshot()
+
+        env.reset()
+        self.assertEqual(os.listdir(shared), ['cache.db'])
+
+    def test_reset_owned_storage(self):
+        # storage made by setup_cache_storage is reset, even outside the prefix
+        env = self.clone()
+        env.tmpfs_dir = os.path.join(self.tmp_dir, 'tmpfs')
+        os.makedirs(env.tmpfs_dir)
+        path = env.setup_cache_storage(1024)
+        self.assertFalse(path.startswith(env.layout.prefix))
+        env.snapshot()
+
+        env.reset()
+        self.assertFalse(os.path.exists(path))
+        env.destroy()
+        self.assertEqual(os.listdir(env.tmpfs_dir), [])
+
+    def test_reset_requires_snapshot(self):
+        env = self.clone()
+        self.assertRaises(Exception, env.reset)
+
+
+if __name__ == "__main__":
+    unittest.main()
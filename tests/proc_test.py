@@ -0,0 +1,85 @@
+'''
+Test the /proc helpers
+'''
+
+import tsqa.utils
+unittest = tsqa.utils.import_unittest()
+import tsqa.proc
+
+import tempfile
+import shutil
+import os
+import json
+import signal
+import subprocess
+import time
+
+
+class TestTimeSeries(unittest.TestCase):
+    def test_stats(self):
+        series = tsqa.proc.TimeSeries()
+        self.assertIsNone(series.peak())
+        self.assertIsNone(series.slope())
+        for t in xrange(100):
+            series.append(t, 10 + 2 * t)
+        self.assertEqual(len(series), 100)
+        self.assertEqual(series.peak(), 208)
+        self.assertAlmostEqual(series.slope(), 2)
+        self.assertEqual(series.percentile(50), 108)
+        self.assertEqual(series.percentile(100), 208)
+        self.assertEqual(series.percentile(0), 10)
+
+
+class TestResourceSampler(unittest.TestCase):
+    def setUp(self):
+        self.proc = subprocess.Popen(['sh', '-c', 'sleep 60 & sleep 60 & wait'], preexec_fn=os.setsid)
+
+    def tearDown(self):
+        os.killpg(self.proc.pid, signal.SIGKILL)
+        self.proc.wait()
+
+    def test_group_processes(self):
+        comms = [stat['comm'] for stat in tsqa.proc.group_processes(self.proc.pid).itervalues()]
+        # the children may not have been started yet
+        self.assertIn('sh', comms)
+        self.assertNotIn(os.getpid(), tsqa.proc.group_processes(self.proc.pid))
+
+    def test_group_processes_leader(self):
+        # wait for both sleeps
+        while len(tsqa.proc.group_processes(self.proc.pid)) < 3:
+            time.sleep(0.01)
+        self.assertEqual(sorted(tsqa.proc.group_processes(self.proc.pid, leader=self.proc.pid)),
+                         sorted(tsqa.proc.group_processes(self.proc.pid)))
+        kids = tsqa.proc.children(self.proc.pid)
+        if kids is not None:
+            self.assertEqual(len(kids), 2)
+
+    def test_sample(self):
+        sampler = tsqa.proc.ResourceSampler(lambda: self.proc.pid)
+        sampler.sample()
+        sampler.sample()
+        self.assertIn('sh', sampler.processes())
+        rss = sampler.series('sh', 'rss')
+        self.assertEqual(len(rss), 2)
+        self.assertGreater(rss.peak(), 0)
+        self.assertGreaterEqual(sampler.series('sh', 'fds').peak(), 3)
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'resources.json')
+        sampler.dump(path)
+        with open(path) as fh:
+            self.assertEqual(len(json.load(fh)['processes']['sh']['cpu']['values']), 2)
+
+    def test_thread(self):
+        sampler = tsqa.proc.ResourceSampler(lambda: self.proc.pid, interval=0.01)
+        sampler.start()
+        while len(sampler.series('sh', 'threads')) < 3:
+            time.sleep(0.01)
+        sampler.stop()
+        # (summed over the shells, children are briefly sh too before they exec)
+        self.assertGreaterEqual(sampler.series('sh', 'threads').peak(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+'''
+Test the routing index of the endpoints
+'''
+
+import tsqa.utils
+unittest = tsqa.utils.import_unittest()
+import tsqa.routing
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = tsqa.routing.Router()
+
+    def lookup(self, path, method='GET'):
+        route = self.router.lookup(path, method)
+        return route and route[0]
+
+    def test_exact(self):
+        self.router.add('/a', 'a')
+        self.assertEqual(self.lookup('/a'), 'a')
+        self.assertIsNone(self.lookup('/a/b'))
+        self.assertRaises(Exception, self.router.add, '/a', 'again')
+        self.router.remove('/a')
+        self.assertIsNone(self.lookup('/a'))
+        self.assertRaises(Exception, self.router.remove, '/a')
+
+    def test_prefix(self):
+        self.router.add('/objects/', 'objects', kind='prefix')
+        self.router.add('/objects/big/', 'big', kind='prefix')
+        self.router.add('/objects/big/exact', 'exact')
+        self.assertEqual(self.lookup('/objects/1'), 'objects')
+        self.assertEqual(self.lookup('/objects/big/1'), 'big')
+        self.assertEqual(self.lookup('/objects/big/exact'), 'exact')
+        self.assertIsNone(self.lookup('/object'))
+
+        self.router.remove('/objects/big/', kind='prefix')
+        self.assertEqual(self.lookup('/objects/big/1'), 'objects')
+        self.router.remove('/objects/', kind='prefix')
+        self.assertIsNone(self.lookup('/objects/big/1'))
+        self.assertEqual(len(self.router), 1)
+
+    def test_glob(self):
+        self.assertEqual(tsqa.routing.glob_to_regex('/a/*.txt'), r'\/a\/[^/]*\.txt')
+        self.router.add('/a/*.txt', 'txt', kind='glob')
+        self.router.add('/a/**', 'any', kind='glob')
+        self.assertEqual(self.lookup('/a/b.txt'), 'txt')
+        self.assertEqual(self.lookup('/a/b/c.txt'), 'any')
+        self.assertIsNone(self.lookup('/b/c.txt'))
+
+    def test_regex(self):
+        self.router.add(r'/id/(\d+)', 'id', kind='regex')
+        func, match = self.router.lookup('/id/42', 'GET')
+        self.assertEqual((func, match.group(1)), ('id', '42'))
+        # the whole path has to match
+        self.assertIsNone(self.lookup('/id/42/more'))
+
+    def test_many_patterns(self):
+        # more groups than fit in one regex
+        for i in xrange(500):
+            self.router.add(r'/r{0}/(\w+)/(\d+)'.format(i), i, kind='regex')
+        for i in (0, 33, 34, 499):
+            func, match = self.router.lookup('/r{0}/x/1'.format(i), 'GET')
+            self.assertEqual((func, match.groups()), (i, ('x', '1')))
+        self.router.remove(r'/r33/(\w+)/(\d+)', kind='regex')
+        self.assertIsNone(self.lookup('/r33/x/1'))
+        self.assertEqual(self.lookup('/r34/x/1'), 34)
+
+    def test_many_paths(self):
+        for i in xrange(20000):
+            self.router.add('/exact/{0}'.format(i), i)
+            self.router.add('/prefix/{0}/'.format(i), -i, kind='prefix')
+        self.assertEqual(self.lookup('/exact/12345'), 12345)
+        self.assertEqual(self.lookup('/prefix/12345/foo'), -12345)
+        self.assertEqual(len(self.router), 40000)
+
+    def test_methods(self):
+        self.router.add('/a', 'get', methods=['get'])
+        self.router.add('/a', 'post', methods=['POST'])
+        self.router.add('/a*', 'glob', methods=['PUT'], kind='glob')
+        self.router.add('/', 'fallback', methods=['DELETE'], kind='prefix')
+        self.assertEqual(self.lookup('/a', 'GET'), 'get')
+        self.assertEqual(self.lookup('/a', 'HEAD'), 'get')
+        self.assertEqual(self.lookup('/a', 'POST'), 'post')
+        # falls through to the other kinds of patterns
+        self.assertEqual(self.lookup('/a', 'PUT'), 'glob')
+        self.assertEqual(self.lookup('/a', 'DELETE'), 'fallback')
+        with self.assertRaises(tsqa.routing.MethodNotAllowed) as context:
+            self.lookup('/a', 'PATCH')
+        self.assertEqual(context.exception.allowed, set(['GET', 'POST', 'PUT', 'DELETE']))
+
+        self.router.remove('/a', methods=['GET'])
+        self.assertRaises(tsqa.routing.MethodNotAllowed, self.lookup, '/a', 'GET')
+
+    def test_patterns_in_order(self):
+        self.router.add('/a/*', 'first', methods=['POST'], kind='glob')
+        self.router.add('/a/b', 'second', kind='regex')
+        self.router.add('/a/.', 'third', kind='regex')
+        self.assertEqual(self.lookup('/a/b', 'POST'), 'first')
+        # the first doesn't handle GET
+        self.assertEqual(self.lookup('/a/b', 'GET'), 'second')
+        self.assertEqual(self.lookup('/a/c', 'GET'), 'third')
+
+    def test_named_groups(self):
+        self.router.add(r'/a/(?P<id>\d+)', 'a', kind='regex')
+        self.router.add(r'/b/(?P<id>\d+)', 'b', kind='regex')
+        self.router.add(r'/c/(\d+)', 'c', kind='regex')
+        for path, handler in (('/a/1', 'a'), ('/b/2', 'b'), ('/c/3', 'c')):
+            func, match = self.router.lookup(path, 'GET')
+            self.assertEqual((func, match.group(1)), (handler, path[-1]))
+        self.assertEqual(self.router.lookup('/b/2', 'GET')[1].group('id'), '2')
+
+    def test_backreferences(self):
+        self.router.add(r'/x/(\d)', 'x', kind='regex')
+        self.router.add(r'/y/(\w)\1', 'y', kind='regex')
+        self.assertEqual(self.lookup('/y/aa'), 'y')
+        self.assertIsNone(self.lookup('/y/ab'))
+
+    def test_inline_flags(self):
+        self.router.add('/Lower', 'lower', kind='regex')
+        self.router.add('(?i)/upper', 'upper', kind='regex')
+        self.assertEqual(self.lookup('/UPPER'), 'upper')
+        self.assertEqual(self.lookup('/Lower'), 'lower')
+        self.assertIsNone(self.lookup('/lower'))
+
+    def test_invalid_regex(self):
+        self.assertRaises(Exception, self.router.add, '/(unclosed', 'bad', kind='regex')
+        self.assertEqual(len(self.router), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
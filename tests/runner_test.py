@@ -0,0 +1,116 @@
+'''
+Test the parallel runner against some generated test modules
+'''
+
+import tsqa.utils
+unittest = tsqa.utils.import_unittest()
+import tsqa.runner
+
+import tempfile
+import shutil
+import os
+import sys
+import json
+import xml.etree.ElementTree as ET
+
+TEST_MODULE = '''
+import unittest
+
+
+class SharedA(unittest.TestCase):
+    @classmethod
+    def environmentKey(cls):
+        return 'shared'
+
+    def test_pass(self):
+        pass
+
+    def test_fail(self):
+        self.fail('expected')
+
+
+class SharedB(SharedA):
+    def test_fail(self):
+        pass
+
+
+class Alone(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        raise Exception('broken fixture')
+
+    def test_never_runs(self):
+        pass
+'''
+
+
+class TestRunner(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.test_dir = os.path.join(self.tmp_dir, 'tests')
+        os.makedirs(self.test_dir)
+        with open(os.path.join(self.test_dir, 'tsqa_runner_fake_test.py'), 'w') as fh:
+            fh.write(TEST_MODULE)
+        with open(os.path.join(self.test_dir, 'tsqa_runner_broken_test.py'), 'w') as fh:
+            fh.write('import tsqa_no_such_module\n')
+
+    def tearDown(self):
+        # discovery imports the modules from (and adds) the test dir
+        if self.test_dir in sys.path:
+            sys.path.remove(self.test_dir)
+        for name in sys.modules.keys():
+            if name.startswith('tsqa_runner_'):
+                del sys.modules[name]
+        shutil.rmtree(self.tmp_dir)
+
+    def test_discover(self):
+        groups = tsqa.runner.discover([self.test_dir])
+        self.assertEqual(sorted(groups), [
+            ['tsqa_runner_broken_test'],
+            ['tsqa_runner_fake_test.Alone'],
+            ['tsqa_runner_fake_test.SharedA', 'tsqa_runner_fake_test.SharedB'],
+        ])
+
+    def test_split_groups(self):
+        groups = [['a', 'b', 'c', 'd', 'e'], ['f']]
+        self.assertEqual(tsqa.runner.split_groups(groups, 1), groups)
+        self.assertEqual(tsqa.runner.split_groups(groups, 3), [['a', 'b'], ['c', 'd', 'e'], ['f']])
+        self.assertEqual(len(tsqa.runner.split_groups(groups, 10)), 6)
+
+    def test_run_split(self):
+        groups = [['tsqa_runner_fake_test.SharedA', 'tsqa_runner_fake_test.SharedB']]
+        sys.path.insert(0, self.test_dir)
+        records = tsqa.runner.run(groups, workers=2)
+        self.assertEqual(len(set(record['pid'] for record in records)), 2)
+        records = tsqa.runner.run(groups, workers=2, split=False)
+        self.assertEqual(len(set(record['pid'] for record in records)), 1)
+
+    def test_run(self):
+        records = tsqa.runner.run(tsqa.runner.discover([self.test_dir]), workers=2)
+        by_id = dict((record['id'], record) for record in records)
+        self.assertEqual(by_id['tsqa_runner_fake_test.SharedA.test_fail']['status'], 'failure')
+        self.assertEqual(by_id['tsqa_runner_fake_test.SharedB.test_fail']['status'], 'success')
+        # grouped classes run in the same worker
+        self.assertEqual(by_id['tsqa_runner_fake_test.SharedA.test_pass']['pid'],
+                         by_id['tsqa_runner_fake_test.SharedB.test_pass']['pid'])
+        self.assertEqual(by_id['setUpClass (tsqa_runner_fake_test.Alone)']['status'], 'error')
+        self.assertIn('tsqa_no_such_module', by_id['tsqa_runner_broken_test']['message'])
+
+        self.assertEqual(tsqa.runner.summarize(records),
+                         {'tests': 6, 'success': 3, 'failure': 1, 'error': 2, 'skipped': 0})
+
+        json_path = os.path.join(self.tmp_dir, 'report.json')
+        tsqa.runner.write_json(records, json_path)
+        with open(json_path) as fh:
+            self.assertEqual(json.load(fh)['summary']['tests'], 6)
+
+        junit_path = os.path.join(self.tmp_dir, 'report.xml')
+        tsqa.runner.write_junit(records, junit_path)
+        suites = dict((suite.get('name'), suite) for suite in ET.parse(junit_path).getroot())
+        self.assertEqual(suites['tsqa_runner_fake_test.SharedA'].get('failures'), '1')
+        self.assertEqual(suites['tsqa_runner_fake_test.Alone'].get('errors'), '1')
+        self.assertEqual(suites['tsqa_runner_fake_test.Alone'][0].get('name'), 'setUpClass')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+'''
+Test the synthetic origin
+'''
+import helpers
+
+import tsqa.utils
+unittest = tsqa.utils.import_unittest()
+import tsqa.endpoint
+import tsqa.synthetic
+
+import httplib
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import requests
+
+
+class TestSyntheticBody(unittest.TestCase):
+    def test_deterministic(self):
+        body = tsqa.synthetic.SyntheticBody('/a', 300000, seed=1)
+        data = body.read()
+        self.assertEqual(len(data), 300000)
+        self.assertEqual(data, tsqa.synthetic.SyntheticBody('/a', 300000, seed=1).read())
+        self.assertNotEqual(data, tsqa.synthetic.SyntheticBody('/a', 300000, seed=2).read())
+        self.assertNotEqual(data, tsqa.synthetic.SyntheticBody('/b', 300000, seed=1).read())
+        for start, end in ((0, 1), (65530, 65550), (70000, 300000), (299999, 400000)):
+            self.assertEqual(body.read(start, end), data[start:end])
+        # every block is different
+        blocks = set(data[i:i + body.block_size] for i in xrange(0, len(data), body.block_size))
+        self.assertEqual(len(blocks), 5)
+
+    def test_parse_range(self):
+        parse = tsqa.synthetic.parse_range
+        self.assertEqual(parse('bytes=0-9', 100), (0, 10))
+        self.assertEqual(parse('bytes=90-', 100), (90, 100))
+        self.assertEqual(parse('bytes=90-200', 100), (90, 100))
+        self.assertEqual(parse('bytes=-10', 100), (90, 100))
+        self.assertEqual(parse('bytes=-200', 100), (0, 100))
+        # ignored
+        self.assertIsNone(parse(None, 100))
+        self.assertIsNone(parse('bytes=0-1,5-6', 100))
+        self.assertIsNone(parse('bytes=5-1', 100))
+        self.assertIsNone(parse('items=0-1', 100))
+        self.assertIsNone(parse('bytes=a-b', 100))
+        # unsatisfiable
+        self.assertRaises(ValueError, parse, 'bytes=100-', 100)
+        self.assertRaises(ValueError, parse, 'bytes=-0', 100)
+
+
+class TestSyntheticOrigin(unittest.TestCase):
+    backend = 'thread'
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.corpus = os.path.join(tmp_dir, 'corpus')
+        os.mkdir(self.corpus)
+        self.file_data = os.urandom(200000)
+        with open(os.path.join(self.corpus, 'file'), 'wb') as fh:
+            fh.write(self.file_data)
+        # outside of the corpus
+        with open(os.path.join(tmp_dir, 'secret'), 'wb') as fh:
+            fh.write('secret')
+
+        self.endpoint = tsqa.endpoint.DynamicHTTPEndpoint(backend=self.backend)
+        self.endpoint.start()
+        self.endpoint.ready.wait()
+        self.endpoint.add_handler('/objects/', tsqa.synthetic.SyntheticOrigin(headers={'Cache-Control': 'max-age=60'}),
+                                  match='prefix')
+        self.endpoint.add_handler('/corpus/', tsqa.synthetic.SyntheticOrigin(corpus=self.corpus, strip_prefix='/corpus/'),
+                                  match='prefix')
+
+    def tearDown(self):
+        self.endpoint.server.shutdown()
+        self.endpoint.server.server_close()
+
+    def test_get(self):
+        ret = requests.get(self.endpoint.url('/objects/a?size=300K&seed=5'))
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(ret.headers['content-length'], str(300 * 1024))
+        self.assertEqual(ret.headers['cache-control'], 'max-age=60')
+        self.assertEqual(ret.content, tsqa.synthetic.SyntheticBody('/objects/a', 300 * 1024, seed=5).read())
+
+        ret = requests.head(self.endpoint.url('/objects/a?size=1G'))
+        self.assertEqual(ret.headers['content-length'], str(1024 ** 3))
+
+    def test_range(self):
+        body = tsqa.synthetic.SyntheticBody('/objects/a', 1024 * 1024)
+        ret = requests.get(self.endpoint.url('/objects/a'), headers={'Range': 'bytes=100000-199999'})
+        self.assertEqual(ret.status_code, 206)
+        self.assertEqual(ret.headers['content-range'], 'bytes 100000-199999/1048576')
+        self.assertEqual(ret.content, body.read(100000, 200000))
+
+        # If-Range with a different etag gets the whole thing
+        ret = requests.get(self.endpoint.url('/objects/a'), headers={'Range': 'bytes=0-0', 'If-Range': '"nope"'})
+        self.assertEqual((ret.status_code, len(ret.content)), (200, 1024 * 1024))
+
+        ret = requests.get(self.endpoint.url('/objects/a'), headers={'Range': 'bytes=2000000-'})
+        self.assertEqual(ret.status_code, 416)
+        self.assertEqual(ret.headers['content-range'], 'bytes */1048576')
+
+    def test_chunked(self):
+        ret = requests.get(self.endpoint.url('/objects/a?size=100K&chunked=1'))
+        self.assertNotIn('content-length', ret.headers)
+        self.assertEqual(ret.content, tsqa.synthetic.SyntheticBody('/objects/a', 100 * 1024).read())
+
+    def test_corpus(self):
+        ret = requests.get(self.endpoint.url('/corpus/file'))
+        self.assertEqual(ret.content, self.file_data)
+        ret = requests.get(self.endpoint.url('/corpus/file'), headers={'Range': 'bytes=-1000'})
+        self.assertEqual(ret.content, self.file_data[-1000:])
+        self.assertEqual(requests.get(self.endpoint.url('/corpus/missing')).status_code, 404)
+
+    def test_corpus_traversal(self):
+        # (requests would normalize the path)
+        conn = httplib.HTTPConnection('127.0.0.1', self.endpoint.address[1])
+        self.addCleanup(conn.close)
+        conn.request('GET', '/corpus/../secret')
+        ret = conn.getresponse()
+        self.assertEqual((ret.status, ret.read()), (404, ''))
+
+    def test_throttle(self):
+        start = time.time()
+        ret = requests.get(self.endpoint.url('/objects/a?size=50K&rate=100K'))
+        self.assertEqual(len(ret.content), 50 * 1024)
+        self.assertGreaterEqual(time.time() - start, 0.4)
+
+    def test_memory(self):
+        # streaming 256M shouldn't grow our memory by anything like that
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ret = requests.get(self.endpoint.url('/objects/a?size=256M'), stream=True)
+        self.assertEqual(sum(len(chunk) for chunk in ret.iter_content(1024 * 1024)), 256 * 1024 * 1024)
+        # (ru_maxrss is in KB)
+        self.assertLess(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before, 64 * 1024)
+
+
+class TestSyntheticOriginEvent(TestSyntheticOrigin):
+    backend = 'event'
+
+    def test_throttle(self):
+        # throttling would stall the event loop
+        ret = requests.get(self.endpoint.url('/objects/a?size=50K&rate=100K'))
+        self.assertEqual(ret.status_code, 400)
+        self.assertIn('rate is not supported', ret.text)
+
+
+class TestSyntheticOriginSimple(TestSyntheticOrigin):
+    backend = 'simple'
+
+    def test_memory(self):
+        raise unittest.SkipTest('too slow through wsgiref')
+
+
+if __name__ == "__main__":
+    unittest.main()
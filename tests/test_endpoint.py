@@ -5,12 +5,18 @@ import helpers
 import tsqa.utils
 unittest = tsqa.utils.import_unittest()
 import tsqa.endpoint
+import tsqa.tracking
 
+import flask
 import requests
 
 class TestDynamicHTTPEndpoint(unittest.TestCase):
+    backend = None
+    # whether the backend keeps connections alive
+    keep_alive = False
+
     def setUp(self):
-        self.endpoint = tsqa.endpoint.DynamicHTTPEndpoint()
+        self.endpoint = tsqa.endpoint.DynamicHTTPEndpoint(backend=self.backend)
         self.endpoint.start()
         self.endpoint.ready.wait()
 
@@ -59,6 +65,36 @@ class TestDynamicHTTPEndpoint(unittest.TestCase):
         ret = requests.get(self.endpoint.url('/echo'))
         self.assertEqual(ret.status_code, 404)
 
+    def test_patterns(self):
+        self.endpoint.add_handler('/objects/', lambda r: 'object ' + r.path, match='prefix')
+        self.endpoint.add_handler(r'/id/(\d+)', lambda r: 'id ' + flask.g.route_match.group(1),
+                                  methods=['POST'], match='regex')
+        self.assertEqual(requests.get(self.endpoint.url('/objects/a/b')).text, 'object /objects/a/b')
+        self.assertEqual(requests.post(self.endpoint.url('/id/42')).text, 'id 42')
+        ret = requests.get(self.endpoint.url('/id/42'))
+        self.assertEqual((ret.status_code, ret.headers['allow']), (405, 'POST'))
+        self.endpoint.remove_handler('objects/', match='prefix')
+        self.assertEqual(requests.get(self.endpoint.url('/objects/a/b')).status_code, 404)
+
+    def test_counters(self):
+        self.endpoint.add_handler('/echo', lambda r: 'echo')
+        session = requests.Session()
+        for _ in xrange(3):
+            self.assertEqual(session.get(self.endpoint.url('/echo')).text, 'echo')
+        counters = self.endpoint.counters()
+        self.assertEqual(counters['requests'], 3)
+        self.assertEqual(counters['connections'], 1 if self.keep_alive else 3)
+
+
+class TestDynamicHTTPEndpointThread(TestDynamicHTTPEndpoint):
+    backend = 'thread'
+    keep_alive = True
+
+
+class TestDynamicHTTPEndpointEvent(TestDynamicHTTPEndpoint):
+    backend = 'event'
+    keep_alive = True
+
 
 class TestTrackingRequests(unittest.TestCase):
     def setUp(self):
@@ -75,3 +111,42 @@ class TestTrackingRequests(unittest.TestCase):
         ret = self.track.get(self.endpoint.url('/echo'))
         # TODO: test the request?? This requires some intermediate objects
         self.assertEqual(ret['client_response'].status_code, ret['server_response'].status_code)
+
+    def test_records(self):
+        self.endpoint.add_handler('/echo', lambda r: 'echo')
+        ret = self.track.post(self.endpoint.url('/echo?a=b'), data='body')
+        self.assertEqual(ret['server_request'].method, 'POST')
+        self.assertEqual(ret['server_request'].path, '/echo')
+        self.assertEqual(ret['server_request'].query, 'a=b')
+        self.assertEqual(ret['server_request'].body_digest, tsqa.tracking.digest('body'))
+        self.assertEqual(ret['server_response'].body_length, 4)
+        self.assertEqual(ret['server_response'].headers['content-length'], '4')
+        # TrackingRequests is done with it
+        self.assertEqual(len(self.endpoint.tracking), 0)
+
+
+class TestTrackingWSGIServer(unittest.TestCase):
+    def setUp(self):
+        app = flask.Flask(__name__)
+
+        @app.route('/hello')
+        def hello():
+            return 'hello'
+
+        self.endpoint = tsqa.endpoint.TrackingWSGIServer(app, tracking=tsqa.tracking.TrackingStore(capacity=2))
+        self.endpoint.start()
+        self.endpoint.ready.wait()
+
+    def tearDown(self):
+        self.endpoint.server.shutdown()
+
+    def test_tracking(self):
+        url = 'http://127.0.0.1:{0}/hello'.format(self.endpoint.address[1])
+        keys = []
+        for _ in xrange(3):
+            keys.append(self.endpoint.get_tracking_key())
+            requests.get(url, headers={self.endpoint.TRACKING_HEADER: keys[-1]})
+        self.assertEqual(self.endpoint.get_tracking_by_key(keys[2])['request'].path, '/hello')
+        self.assertEqual(self.endpoint.get_tracking_by_key(keys[2]).response.status_code, 200)
+        # only the last 2 are kept
+        self.assertRaises(Exception, self.endpoint.get_tracking_by_key, keys[0])
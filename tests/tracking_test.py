@@ -0,0 +1,68 @@
+'''
+Test the request tracking store
+'''
+
+import tsqa.utils
+unittest = tsqa.utils.import_unittest()
+import tsqa.tracking
+
+import threading
+
+
+class TestTrackingStore(unittest.TestCase):
+    def test_keys(self):
+        store = tsqa.tracking.TrackingStore(capacity=100000)
+        keys = []
+
+        def take():
+            for _ in xrange(1000):
+                keys.append(store.new_key())
+
+        threads = [threading.Thread(target=take) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(keys)), 8000)
+        self.assertEqual(len(store), 8000)
+
+    def test_ring(self):
+        store = tsqa.tracking.TrackingStore(capacity=3)
+        keys = [store.new_key() for _ in xrange(3)]
+        store.get(keys[0])
+        store.new_key()
+        # the oldest goes, even though it was just used
+        self.assertNotIn(keys[0], store)
+        self.assertIn(keys[1], store)
+        self.assertEqual(store.evicted, 1)
+        self.assertRaises(Exception, store.get, keys[0])
+
+    def test_lru(self):
+        store = tsqa.tracking.TrackingStore(capacity=3, policy='lru')
+        keys = [store.new_key() for _ in xrange(3)]
+        store.get(keys[0])
+        store.add_response(keys[1], tsqa.tracking.ResponseRecord(status_code=200))
+        store.new_key()
+        self.assertEqual(sorted(store.keys()), sorted([keys[0], keys[1], '3']))
+
+    def test_records(self):
+        store = tsqa.tracking.TrackingStore()
+        request = tsqa.tracking.RequestRecord(method='GET', path='/', headers=tsqa.tracking.Headers({'X-Foo': 'bar'}))
+        # unknown keys are tracked too (the header may not come from new_key)
+        store.add_request('mine', request)
+        tracked = store.pop('mine')
+        self.assertIs(tracked['request'], request)
+        self.assertIsNone(tracked.response)
+        self.assertNotIn('mine', store)
+
+        self.assertEqual(request.headers['x-foo'], 'bar')
+        self.assertIn('X-FOO', request.headers)
+        self.assertEqual(request.headers[0], ('X-Foo', 'bar'))
+        self.assertIsNone(request.body_digest)
+        self.assertRaises(AttributeError, setattr, request, 'method', 'POST')
+        self.assertRaises(AttributeError, setattr, request, 'extra', 1)
+        self.assertRaises(TypeError, tsqa.tracking.RequestRecord, bogus=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -25,8 +25,7 @@ class TestBuildCache(unittest.TestCase):
     def test_base(self):
         cache = tsqa.utils.BuildCache(self.tmp_dir)
         self.assertEqual(cache, {})
-        cache.save_cache()
-        self.assertTrue(os.path.exists(self.cache_map_file))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, cache.cache_db_filename)))
         cache.load_cache()
         self.assertEqual(cache, {})
 
@@ -42,9 +41,131 @@ class TestBuildCache(unittest.TestCase):
         cache = tsqa.utils.BuildCache(self.tmp_dir)
         cache['foo'] = {'a': 'somepath'}
 
-        with open(self.cache_map_file) as fh:
-            json_cache = json.load(fh)
-        self.assertEqual(json_cache, {'foo': {'a': 'somepath'}})
+        self.assertEqual(tsqa.utils.BuildCache(self.tmp_dir), {'foo': {'a': 'somepath'}})
 
+    def test_nested_update(self):
+        cache = tsqa.utils.BuildCache(self.tmp_dir)
+        cache['foo'] = {}
+        cache['foo']['a'] = {'path': self.tmp_dir}
+        cache['bar'] = {'a': {'path': self.tmp_dir}}
+
+        cache = tsqa.utils.BuildCache(self.tmp_dir)
+        self.assertEqual(cache['foo'], {'a': {'path': self.tmp_dir}})
+        self.assertEqual(sorted(cache.by_key('a')), ['bar', 'foo'])
+
+        del cache['foo']['a']
+        self.assertEqual(cache['foo'], {})
+
+    def test_import_map_file(self):
+        with open(self.cache_map_file, 'w') as fh:
+            fh.write(json.dumps({'foo': {'a': {'path': self.tmp_dir}}}))
+
+        cache = tsqa.utils.BuildCache(self.tmp_dir)
+        self.assertEqual(cache, {'foo': {'a': {'path': self.tmp_dir}}})
+        self.assertFalse(os.path.exists(self.cache_map_file))
+
+    def test_concurrent_writers(self):
+        # two caches (think processes) sharing the same map file
+        os.makedirs(os.path.join(self.tmp_dir, 'a'))
+        os.makedirs(os.path.join(self.tmp_dir, 'b'))
+        cache_a = tsqa.utils.BuildCache(self.tmp_dir)
+        cache_b = tsqa.utils.BuildCache(self.tmp_dir)
+        cache_a['foo'] = {'a': {'path': os.path.join(self.tmp_dir, 'a')}}
+        cache_b['bar'] = {'b': {'path': os.path.join(self.tmp_dir, 'b')}}
+
+        # both see each other's entries
+        self.assertIn('foo', cache_b)
+        self.assertIn('bar', cache_a)
+
+        del cache_a['bar']
+        self.assertEqual(tsqa.utils.BuildCache(self.tmp_dir).keys(), ['foo'])
+
+    def test_setdefault(self):
+        # another process adding the source_hash first doesn't lose its entries
+        os.makedirs(os.path.join(self.tmp_dir, 'a'))
+        cache_a = tsqa.utils.BuildCache(self.tmp_dir)
+        cache_b = tsqa.utils.BuildCache(self.tmp_dir)
+        cache_a.setdefault('foo')['a'] = {'path': os.path.join(self.tmp_dir, 'a')}
+        self.assertEqual(cache_b.setdefault('foo', {'b': {}}).keys(), ['a'])
+
+        self.assertEqual(cache_b.setdefault('bar', {'b': {}}).keys(), ['b'])
+        self.assertEqual(sorted(cache_a), ['bar', 'foo'])
+
+    def _make_layout(self, name, size):
+        path = os.path.join(self.tmp_dir, name)
+        os.makedirs(path)
+        with open(os.path.join(path, 'data'), 'w') as fh:
+            fh.write('x' * size)
+        return path
+
+    def test_evict(self):
+        cache = tsqa.utils.BuildCache(self.tmp_dir, max_bytes=250)
+        cache['foo'] = {}
+        for i, key in enumerate(('a', 'b', 'c')):
+            cache['foo'][key] = {'path': self._make_layout(key, 100)}
+            cache._conn.execute('UPDATE layouts SET last_used = ? WHERE key = ?', (i, key))
+
+        # a is the least recently used, but it is pinned
+        token = cache.pin('foo', 'a')
+        self.assertEqual(cache.evict(), [os.path.join(self.tmp_dir, 'b')])
+        self.assertEqual(sorted(cache['foo']), ['a', 'c'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'b')))
+
+        cache.unpin(token)
+        cache.max_entries = 0
+        cache.max_bytes = None
+        self.assertEqual(len(cache.evict()), 2)
+        self.assertEqual(cache, {})
+        self.assertIsNone(cache.pin('foo', 'a'))
+
+    def test_evict_shared(self):
+        # layouts hardlinking the same (100 byte) object, with 10 bytes each of their own
+        shared = os.path.join(self.tmp_dir, 'object')
+        with open(shared, 'w') as fh:
+            fh.write('x' * 100)
+        cache = tsqa.utils.BuildCache(self.tmp_dir, max_bytes=130)
+        cache['foo'] = {}
+        for i, key in enumerate(('a', 'b', 'c')):
+            path = self._make_layout(key, 10)
+            os.link(shared, os.path.join(path, 'shared'))
+            cache['foo'][key] = {'path': path}
+            cache._conn.execute('UPDATE layouts SET last_used = ? WHERE key = ?', (i, key))
+
+        # 130 bytes in all, the object only counts once
+        self.assertEqual(cache.evict(), [])
+        cache.max_bytes = 125
+        self.assertEqual(cache.evict(), [os.path.join(self.tmp_dir, 'a')])
+        # the object is only freed along with the last layout
+        cache.max_bytes = 50
+        self.assertEqual(len(cache.evict()), 2)
+        self.assertEqual(cache, {})
+
+    def test_evict_build_dirs(self):
+        cache = tsqa.utils.BuildCache(self.tmp_dir, max_bytes=150)
+        build_dir = self._make_layout('build', 100)
+        cache.unpin(cache.pin_build_dir(build_dir))
+        cache.update_build_dir(build_dir)
+        cache['foo'] = {'a': {'path': self._make_layout('a', 10)}}
+
+        # build dirs count towards max_bytes, but not max_entries
+        self.assertEqual(cache.evict(), [])
+        cache.max_entries = 1
+        self.assertEqual(cache.evict(), [])
 
+        # pinned while building in it
+        cache.max_entries = None
+        token = cache.pin_build_dir(build_dir)
+        cache['foo']['b'] = {'path': self._make_layout('b', 50)}
+        self.assertEqual(cache.evict(), [os.path.join(self.tmp_dir, 'a')])
+        cache.unpin(token)
+        cache.max_bytes = 100
+        self.assertEqual(cache.evict(), [build_dir])
+        self.assertFalse(os.path.exists(build_dir))
 
+    def test_dead_pins(self):
+        cache = tsqa.utils.BuildCache(self.tmp_dir, max_entries=0)
+        cache['foo'] = {'a': {'path': self._make_layout('a', 1)}}
+        cache.pin('foo', 'a')
+        # pretend the pin was made by a process that has since exited
+        cache._conn.execute('UPDATE pins SET pid = ?', (2 ** 22 + 1,))
+        self.assertEqual(len(cache.evict()), 1)
@@ -5,6 +5,13 @@ Test the utils
 import tsqa.utils
 unittest = tsqa.utils.import_unittest()
 
+import tempfile
+import shutil
+import os
+import time
+import threading
+import socket
+
 class TestUtils(unittest.TestCase):
     def test_merge_dicts(self):
         '''
@@ -28,3 +35,347 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(tsqa.utils.configure_string_to_dict('--a=b'), {'a': 'b'})
         self.assertEqual(tsqa.utils.configure_string_to_dict('--a=b --c'), {'a': 'b', 'c': None})
 
+class TestFileLock(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lock(self):
+        path = os.path.join(self.tmp_dir, 'locks', 'foo.lock')
+        lock = tsqa.utils.FileLock(path)
+        other = tsqa.utils.FileLock(path)
+        with lock:
+            self.assertTrue(lock.locked)
+            # a second open of the lock file conflicts, even in our process
+            self.assertFalse(other.acquire(blocking=False))
+        self.assertFalse(lock.locked)
+        self.assertTrue(other.acquire(blocking=False))
+        other.release()
+
+
+class TestObjectStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = tsqa.utils.ObjectStore(os.path.join(self.tmp_dir, 'objects'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_tree(self, name, contents):
+        path = os.path.join(self.tmp_dir, name)
+        os.makedirs(os.path.join(path, 'bin'))
+        for relpath, data in contents.iteritems():
+            with open(os.path.join(path, relpath), 'w') as fh:
+                fh.write(data)
+        os.symlink('bin', os.path.join(path, 'sbin'))
+        return path
+
+    def test_ingest(self):
+        src_a = self._make_tree('src_a', {'bin/foo': 'foo', 'bar': 'bar'})
+        src_b = self._make_tree('src_b', {'bin/foo': 'foo', 'bar': 'changed'})
+        os.chmod(os.path.join(src_b, 'bin', 'foo'), 0755)
+
+        self.assertEqual(self.store.ingest(src_a, os.path.join(self.tmp_dir, 'a')), 6)
+        self.assertEqual(self.store.ingest(src_a, os.path.join(self.tmp_dir, 'a2')), 0)
+        self.store.ingest(src_b, os.path.join(self.tmp_dir, 'b'))
+
+        a = lambda *p: os.path.join(self.tmp_dir, 'a', *p)
+        a2 = lambda *p: os.path.join(self.tmp_dir, 'a2', *p)
+        b = lambda *p: os.path.join(self.tmp_dir, 'b', *p)
+        self.assertTrue(os.path.samefile(a('bar'), a2('bar')))
+        self.assertFalse(os.path.samefile(a('bar'), b('bar')))
+        # same contents, but the mode is part of the object
+        self.assertFalse(os.path.samefile(a('bin', 'foo'), b('bin', 'foo')))
+        self.assertEqual(os.readlink(a('sbin')), 'bin')
+
+        # nothing to collect while the trees are around
+        shutil.rmtree(src_a)
+        shutil.rmtree(src_b)
+        self.assertEqual(self.store.gc(), 0)
+        shutil.rmtree(a2())
+        self.assertEqual(self.store.gc(), 0)
+        shutil.rmtree(b())
+        self.assertEqual(self.store.gc(), len('foo') + len('changed'))
+        with open(a('bar')) as fh:
+            self.assertEqual(fh.read(), 'bar')
+
+
+class TestTreeCloner(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'src')
+        os.makedirs(os.path.join(self.src, 'lib'))
+        with open(os.path.join(self.src, 'lib', 'libfoo.so'), 'w') as fh:
+            fh.write('foo')
+        os.symlink('libfoo.so', os.path.join(self.src, 'lib', 'libfoo.so.1'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_copy(self):
+        dst = os.path.join(self.tmp_dir, 'dst')
+        tsqa.utils.TreeCloner().clone(self.src, dst)
+        path = os.path.join(dst, 'lib', 'libfoo.so')
+        self.assertFalse(os.path.islink(path))
+        self.assertFalse(os.path.samefile(path, os.path.join(self.src, 'lib', 'libfoo.so')))
+        self.assertEqual(os.readlink(os.path.join(dst, 'lib', 'libfoo.so.1')), 'libfoo.so')
+
+    def test_link(self):
+        dst = os.path.join(self.tmp_dir, 'dst')
+        cloner = tsqa.utils.TreeCloner()
+        cloner.clone(self.src, dst, link=True)
+        with open(os.path.join(dst, 'lib', 'libfoo.so')) as fh:
+            self.assertEqual(fh.read(), 'foo')
+
+        # without reflinks or hardlinks, we fall back to symlinks
+        cloner.reflink_ok = cloner.hardlink_ok = False
+        dst = os.path.join(self.tmp_dir, 'dst2')
+        cloner.clone(self.src, dst, link=True)
+        self.assertEqual(os.readlink(os.path.join(dst, 'lib', 'libfoo.so')),
+                         os.path.join(self.src, 'lib', 'libfoo.so'))
+
+
+class TestLogTail(unittest.TestCase):
+    def test_lines(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'diags.log')
+        tail = tsqa.utils.LogTail(path)
+        self.assertEqual(tail.lines(), [])
+
+        with open(path, 'w') as fh:
+            fh.write('first\nsec')
+        self.assertEqual(tail.lines(), ['first'])
+        with open(path, 'a') as fh:
+            fh.write('ond\n')
+        self.assertEqual(tail.lines(), ['second'])
+
+        # truncated (or rotated) logs are read from the start
+        with open(path, 'w') as fh:
+            fh.write('new\n')
+        self.assertEqual(tail.lines(), ['new'])
+
+        # rotated: the rest of the old file, then the new one
+        with open(path, 'a') as fh:
+            fh.write('before')
+        os.rename(path, path + '.old')
+        with open(path + '.old', 'a') as fh:
+            fh.write(' rotation')
+        with open(path, 'w') as fh:
+            fh.write('after rotation\n')
+        self.assertEqual(tail.lines(), ['before rotation', 'after rotation'])
+        tail.close()
+
+        self.assertEqual(tsqa.utils.LogTail(path, from_end=True).lines(), [])
+
+
+class TestLogFollower(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'diags.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def log_later(self, line, delay=0.1):
+        def write():
+            time.sleep(delay)
+            with open(self.path, 'a') as fh:
+                fh.write(line + '\n')
+        thread = threading.Thread(target=write)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def check_follower(self, follower):
+        self.addCleanup(follower.close)
+        with open(self.path, 'w') as fh:
+            fh.write('old line\n')
+        follower.checkpoint()
+
+        self.log_later('NOTE: traffic server running')
+        match = follower.wait_for('traffic (\w+) running', timeout=5)
+        self.assertEqual(match.group(1), 'server')
+        self.assertRaises(Exception, follower.wait_for, 'never logged', timeout=0.1)
+
+        with open(self.path, 'a') as fh:
+            fh.write('one\ntwo\n')
+        self.assertEqual(follower.lines(), ['one', 'two'])
+        self.assertEqual(follower.lines(), [])
+
+    def test_inotify(self):
+        follower = tsqa.utils.LogFollower(self.path)
+        if follower._inotify is None:
+            self.skipTest('no inotify')
+        self.check_follower(follower)
+
+    def test_polling(self):
+        follower = tsqa.utils.LogFollower(self.path)
+        if follower._inotify is not None:
+            follower._inotify.close()
+            follower._inotify = None
+        self.check_follower(follower)
+
+
+class TestParseSize(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(tsqa.utils.parse_size(1024), 1024)
+        self.assertEqual(tsqa.utils.parse_size('1024'), 1024)
+        self.assertEqual(tsqa.utils.parse_size('256M'), 256 * 1024 * 1024)
+        self.assertEqual(tsqa.utils.parse_size('2g'), 2 * 1024 ** 3)
+        self.assertRaises(ValueError, tsqa.utils.parse_size, '12X')
+
+
+class TestPortAllocator(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def allocator(self):
+        return tsqa.utils.PortAllocator(registry_dir=self.tmp_dir, port_range=(20000, 20000 + 4 * 32 - 1))
+
+    def test_reserve(self):
+        a = self.allocator()
+        b = self.allocator()
+        ports_a = a.reserve(40)
+        ports_b = b.reserve(40)
+        self.assertEqual(len(set(ports_a)), 40)
+        self.assertEqual(set(ports_a) & set(ports_b), set())
+        # each "process" owns its own blocks
+        self.assertEqual(len(a._blocks), 2)
+        self.assertEqual(len(b._blocks), 2)
+        self.assertRaises(Exception, b.reserve, 40)
+        self.assertEqual(len(b.reserved), 40)
+
+        a.release(ports_a)
+        self.assertEqual(a.reserved, set())
+        self.assertEqual(len(a._blocks), 2)
+
+    def test_busy_port(self):
+        # a port someone else is using is skipped, but kept for later
+        a = self.allocator()
+        a.release(a.reserve(1))
+        busy = a._free[0]
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', busy))
+        try:
+            self.assertNotIn(busy, a.reserve(1))
+        finally:
+            sock.close()
+        self.assertEqual(a._free[-1], busy)
+        self.assertEqual(len(a._free), 32 - 1)
+
+    def test_dead_owner(self):
+        a = self.allocator()
+        a.reserve(4 * 32)
+        # when the owner goes away (the kernel drops its locks), the blocks are free again
+        for lock in a._blocks:
+            lock.release()
+        b = self.allocator()
+        self.assertEqual(len(b.reserve(4 * 32)), 4 * 32)
+
+    def test_shared_allocator(self):
+        # threads reserving at once share one (slow to create) allocator
+        created = []
+        test = self
+
+        class SlowAllocator(tsqa.utils.PortAllocator):
+            def __init__(self):
+                created.append(self)
+                time.sleep(0.1)
+                super(SlowAllocator, self).__init__(registry_dir=test.tmp_dir,
+                                                    port_range=(20000, 20000 + 4 * 32 - 1))
+
+        old = tsqa.utils.PortAllocator, tsqa.utils._port_allocator
+        tsqa.utils.PortAllocator, tsqa.utils._port_allocator = SlowAllocator, None
+        try:
+            ports = []
+            threads = [threading.Thread(target=lambda: ports.extend(tsqa.utils.reserve_ports(3)))
+                       for _ in xrange(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            tsqa.utils.PortAllocator, tsqa.utils._port_allocator = old
+        self.assertEqual(len(created), 1)
+        self.assertEqual(len(set(ports)), 12)
+
+    def test_skip_used(self):
+        a = self.allocator()
+        sock, port = tsqa.utils.bind_unused_port()
+        sock.listen(1)
+        a._free = [port]
+        self.assertNotEqual(a.reserve(1), [port])
+        sock.close()
+
+
+class TestPollInterfaces(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_up(self):
+        socks = [tsqa.utils.bind_unused_port('127.0.0.1') for _ in xrange(3)]
+        for sock, _ in socks:
+            sock.listen(5)
+        start = time.time()
+        tsqa.utils.poll_interfaces([('127.0.0.1', port) for _, port in socks])
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_timeout(self):
+        sock, port = tsqa.utils.bind_unused_port('127.0.0.1')
+        sock.close()
+        start = time.time()
+        self.assertRaises(Exception, tsqa.utils.poll_interfaces, [('127.0.0.1', port)], timeout_sec=0.3)
+        self.assertLess(time.time() - start, 1)
+
+    def test_late_listener(self):
+        sock, port = tsqa.utils.bind_unused_port('127.0.0.1')
+        timer = threading.Timer(0.2, sock.listen, (5,))
+        timer.start()
+        tsqa.utils.poll_interfaces([('127.0.0.1', port)], timeout_sec=2)
+        timer.join()
+        sock.close()
+
+    def test_log_marker(self):
+        sock, port = tsqa.utils.bind_unused_port('127.0.0.1')
+        sock.listen(5)
+        log_file = os.path.join(self.tmp_dir, 'diags.log')
+        with open(log_file, 'w') as fh:
+            fh.write('[Oct 16 12:00:00.000] Server {0x1} NOTE: traffic server')
+
+        self.assertRaises(Exception, tsqa.utils.poll_interfaces, [('127.0.0.1', port)],
+                          timeout_sec=0.2, log_file=log_file)
+
+        def finish_line():
+            with open(log_file, 'a') as fh:
+                fh.write(' running\n')
+        timer = threading.Timer(0.1, finish_line)
+        timer.start()
+        tsqa.utils.poll_interfaces([('127.0.0.1', port)], timeout_sec=2, log_file=log_file)
+        timer.join()
+        sock.close()
+
+    def test_log_watcher_from_end(self):
+        sock, port = tsqa.utils.bind_unused_port('127.0.0.1')
+        sock.listen(5)
+        log_file = os.path.join(self.tmp_dir, 'diags.log')
+        # left over from a previous run
+        with open(log_file, 'w') as fh:
+            fh.write('NOTE: traffic server running\n')
+
+        watcher = tsqa.utils.LogMarkerWatcher(log_file, 'traffic server running', from_end=True)
+        self.assertRaises(Exception, tsqa.utils.poll_interfaces, [('127.0.0.1', port)],
+                          timeout_sec=0.2, log_watcher=watcher)
+
+        watcher = tsqa.utils.LogMarkerWatcher(log_file, 'traffic server running', from_end=True)
+        with open(log_file, 'a') as fh:
+            fh.write('NOTE: traffic server running\n')
+        tsqa.utils.poll_interfaces([('127.0.0.1', port)], timeout_sec=2, log_watcher=watcher)
+        sock.close()
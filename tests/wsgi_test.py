@@ -0,0 +1,260 @@
+'''
+Test the http servers behind the endpoints
+'''
+
+import tsqa.utils
+unittest = tsqa.utils.import_unittest()
+import tsqa.wsgi
+
+import httplib
+import socket
+import threading
+import time
+
+
+class TestRequestParser(unittest.TestCase):
+    def test_pipelined(self):
+        parser = tsqa.wsgi.RequestParser()
+        parser.feed('GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+                    'POST /b HTTP/1.1\r\nContent-Length: 5\r\n\r\nhel')
+        request = parser.next_request()
+        self.assertEqual((request.method, request.target, request.header('host')), ('GET', '/a', 'x'))
+        self.assertIsNone(parser.next_request())
+        parser.feed('lo')
+        request = parser.next_request()
+        self.assertEqual((request.method, request.body), ('POST', 'hello'))
+        self.assertIsNone(parser.next_request())
+
+    def test_chunked(self):
+        parser = tsqa.wsgi.RequestParser()
+        data = ('PUT / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                '5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\nTrailer: x\r\n\r\n')
+        # one byte at a time, to hit every partial state
+        for char in data[:-1]:
+            parser.feed(char)
+            self.assertIsNone(parser.next_request())
+        parser.feed(data[-1] + 'GET /next HTTP/1.1\r\n\r\n')
+        self.assertEqual(parser.next_request().body, 'hello world')
+        self.assertEqual(parser.next_request().target, '/next')
+
+    def test_bad(self):
+        parser = tsqa.wsgi.RequestParser()
+        parser.feed('NONSENSE\r\n\r\n')
+        self.assertRaises(tsqa.wsgi.HTTPError, parser.next_request)
+
+        parser = tsqa.wsgi.RequestParser(max_header_bytes=10)
+        parser.feed('GET / HTTP/1.1\r\nHost: somewhere')
+        self.assertRaises(tsqa.wsgi.HTTPError, parser.next_request)
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+    body = '{0} {1}?{2} {3}'.format(environ['REQUEST_METHOD'], environ['PATH_INFO'],
+                                     environ['QUERY_STRING'], body)
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+
+def stream_app(environ, start_response):
+    start_response('200 OK', [])
+    return ('x' * 1024 for _ in xrange(1024))
+
+
+class ServerTestCase(unittest.TestCase):
+    backend = None
+    app = staticmethod(echo_app)
+    server_kwargs = {}
+
+    def setUp(self):
+        self.server = tsqa.wsgi.make_server('127.0.0.1', 0, self.app, backend=self.backend, **self.server_kwargs)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def connect(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.server_port))
+        self.addCleanup(sock.close)
+        return sock
+
+    def read_all(self, sock):
+        data = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return ''.join(data)
+            data.append(chunk)
+
+    def read_response(self, sock):
+        '''
+        Read one response off sock (leaving anything after it)
+        '''
+        response = httplib.HTTPResponse(sock)
+        response.begin()
+        response.body = response.read()
+        return response
+
+
+class BackendTests(object):
+    def test_request(self):
+        sock = self.connect()
+        sock.sendall('POST /foo%20bar?x=1 HTTP/1.1\r\nHost: localhost\r\nContent-Length: 4\r\n'
+                     'Connection: close\r\n\r\nbody')
+        response = self.read_all(sock)
+        self.assertTrue(response.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertIn('\r\nConnection: close\r\n', response)
+        self.assertTrue(response.endswith('\r\n\r\nPOST /foo bar?x=1 body'))
+
+    def test_head(self):
+        sock = self.connect()
+        sock.sendall('HEAD / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        head, _, body = self.read_all(sock).partition('\r\n\r\n')
+        self.assertIn('\r\nContent-Length: 8\r\n', head)
+        self.assertEqual(body, '')
+
+    def test_bad_request(self):
+        sock = self.connect()
+        sock.sendall('NONSENSE\r\n\r\n')
+        self.assertTrue(self.read_all(sock).startswith('HTTP/1.1 400 Bad Request\r\n'))
+
+    def test_concurrent(self):
+        # open all the connections before sending anything
+        socks = [self.connect() for _ in xrange(200)]
+        for i, sock in enumerate(socks):
+            sock.sendall('GET /{0} HTTP/1.0\r\n\r\n'.format(i))
+        for i, sock in enumerate(socks):
+            self.assertTrue(self.read_all(sock).endswith('GET /{0}? '.format(i)))
+        self.assertEqual(self.server.counters(), {'connections': 200, 'requests': 200})
+
+
+class KeepAliveTests(object):
+    server_kwargs = {'idle_timeout': 0.5, 'max_requests': 3}
+
+    def test_keep_alive(self):
+        sock = self.connect()
+        for i in xrange(2):
+            sock.sendall('GET /{0} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(i))
+            response = self.read_response(sock)
+            self.assertIsNone(response.getheader('Connection'))
+            self.assertEqual(response.body, 'GET /{0}? '.format(i))
+        self.assertEqual(self.server.counters(), {'connections': 1, 'requests': 2})
+
+    def test_pipelined(self):
+        sock = self.connect()
+        sock.sendall(''.join('POST /{0} HTTP/1.1\r\nContent-Length: 1\r\n\r\n{0}'.format(i) for i in xrange(3)))
+        for i in xrange(3):
+            self.assertEqual(self.read_response(sock).body, 'POST /{0}? {0}'.format(i))
+
+    def test_max_requests(self):
+        sock = self.connect()
+        sock.sendall('GET / HTTP/1.1\r\n\r\n' * 4)
+        responses = [self.read_response(sock) for _ in xrange(3)]
+        self.assertEqual(responses[2].getheader('Connection'), 'close')
+        self.assertEqual(sock.recv(1), '')
+        self.assertEqual(self.server.counters(), {'connections': 1, 'requests': 3})
+
+    def test_http10(self):
+        sock = self.connect()
+        sock.sendall('GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')
+        self.assertEqual(self.read_response(sock).getheader('Connection'), 'keep-alive')
+        sock.sendall('GET / HTTP/1.0\r\n\r\n')
+        self.assertEqual(self.read_response(sock).getheader('Connection'), 'close')
+        self.assertEqual(sock.recv(1), '')
+
+    def test_idle_timeout(self):
+        sock = self.connect()
+        sock.sendall('GET / HTTP/1.1\r\n\r\n')
+        self.read_response(sock)
+        start = time.time()
+        sock.settimeout(10)
+        self.assertEqual(sock.recv(1), '')
+        self.assertGreaterEqual(time.time() - start, 0.4)
+
+
+class StreamTests(object):
+    app = staticmethod(stream_app)
+
+    def test_stream(self):
+        sock = self.connect()
+        sock.sendall('GET / HTTP/1.0\r\n\r\n')
+        head, _, body = self.read_all(sock).partition('\r\n\r\n')
+        # no Content-Length, so delimited by the close
+        self.assertIn('Connection: close', head)
+        self.assertEqual(len(body), 1024 * 1024)
+
+    def test_chunked(self):
+        sock = self.connect()
+        sock.sendall('GET / HTTP/1.1\r\n\r\n' * 2)
+        for _ in xrange(2):
+            response = self.read_response(sock)
+            self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+            self.assertEqual(len(response.body), 1024 * 1024)
+
+
+def slow_app(environ, start_response):
+    start_response('200 OK', [])
+
+    def body():
+        for _ in xrange(100):
+            time.sleep(0.1)
+            yield 'x'
+    return body()
+
+
+class TestThreadServer(BackendTests, ServerTestCase):
+    backend = 'thread'
+
+
+class TestThreadShutdown(ServerTestCase):
+    backend = 'thread'
+    app = staticmethod(slow_app)
+
+    def test_shutdown_in_flight(self):
+        sock = self.connect()
+        sock.sendall('GET / HTTP/1.1\r\n\r\n')
+        self.assertTrue(sock.recv(1024).startswith('HTTP/1.1 200 OK'))
+        # a response taking 10s doesn't hold up shutdown
+        start = time.time()
+        self.server.shutdown()
+        self.assertLess(time.time() - start, 1)
+        sock.settimeout(5)
+        self.read_all(sock)
+
+
+class TestEventServer(BackendTests, ServerTestCase):
+    backend = 'event'
+
+
+class TestThreadKeepAlive(KeepAliveTests, ServerTestCase):
+    backend = 'thread'
+
+
+class TestEventKeepAlive(KeepAliveTests, ServerTestCase):
+    backend = 'event'
+
+
+class TestSimpleServer(ServerTestCase):
+    backend = 'simple'
+
+    def test_counters(self):
+        for _ in xrange(2):
+            sock = self.connect()
+            sock.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            self.read_all(sock)
+        self.assertEqual(self.server.counters(), {'connections': 2, 'requests': 2})
+
+
+class TestThreadStream(StreamTests, ServerTestCase):
+    backend = 'thread'
+
+
+class TestEventStream(StreamTests, ServerTestCase):
+    backend = 'event'
+
+
+if __name__ == "__main__":
+    unittest.main()
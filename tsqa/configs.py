@@ -89,6 +89,21 @@ class RecordsConfig(Config, dict):
             for line in fh:
                 self._load_line(line)
 
+    @classmethod
+    def parse(cls, contents):
+        '''
+        Return a flat dict of name -> value for the records in contents
+        '''
+        ret = {}
+        for line in contents.splitlines():
+            line = line.strip()
+            # skip comments
+            if not line or line.startswith('#'):
+                continue
+            top_kind, name, kind, val = line.split(' ', 3)
+            ret[name] = cls.kind_map[kind](val)
+        return ret
+
     def add_line(self, line):
         self._load_line(line)
 
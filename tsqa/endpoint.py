@@ -16,6 +16,7 @@
 
 import os
 import threading
+import time
 import requests
 import flask
 import socket
@@ -23,7 +24,10 @@ import SocketServer
 import ssl
 
 from collections import defaultdict
-from wsgiref.simple_server import make_server
+
+import tsqa.routing
+import tsqa.tracking
+import tsqa.wsgi
 
 # dict of testid -> {client_request, client_response}
 REQUESTS = defaultdict(dict)
@@ -61,19 +65,65 @@ class TrackingRequests():
             ret = {}
             resp = func(*args, **kwargs)
 
-            server_resp = self.endpoint.get_tracking_by_key(key)
+            # we're the only ones interested in it, so don't leave it around
+            server_resp = self.endpoint.tracking.pop(key)
 
             # TODO: create intermediate objects that you can compare
             ret['client_request'] = resp.request
             ret['client_response'] = resp
-            ret['server_request'] = server_resp['request']
-            ret['server_response'] = server_resp['response']
+            # (see tsqa.tracking.RequestRecord and ResponseRecord)
+            ret['server_request'] = server_resp.request
+            ret['server_response'] = server_resp.response
 
             return ret
 
         return handlerFunction
 
 
+def track_app(app, store, header):
+    '''
+    Record (see tsqa.tracking) the requests to the flask app which have the
+    tracking header set, and the responses to them, in store
+    '''
+    @app.before_request
+    def save_request():
+        '''
+        If the tracking header is set, save the request
+        '''
+        key = flask.request.headers.get(header)
+        if key:
+            flask.g.tracking_start = time.time()
+            body = flask.request.get_data()
+            store.add_request(key, tsqa.tracking.RequestRecord(
+                method=flask.request.method,
+                path=flask.request.path,
+                query=flask.request.query_string,
+                headers=tsqa.tracking.Headers(flask.request.headers),
+                body_length=len(body),
+                body_digest=tsqa.tracking.digest(body),
+                time=flask.g.tracking_start,
+            ))
+
+    @app.after_request
+    def save_response(response):
+        '''
+        If the tracking header is set, save the response
+        '''
+        key = flask.request.headers.get(header)
+        if key:
+            # don't consume streamed bodies
+            body = None if response.is_streamed else response.get_data()
+            store.add_response(key, tsqa.tracking.ResponseRecord(
+                status_code=response.status_code,
+                headers=tsqa.tracking.Headers(response.headers),
+                body_length=None if body is None else len(body),
+                body_digest=tsqa.tracking.digest(body),
+                elapsed=time.time() - getattr(flask.g, 'tracking_start', time.time()),
+            ))
+
+        return response
+
+
 class DynamicHTTPEndpoint(threading.Thread):
     '''
     A threaded webserver which allows you to dynamically add/remove handlers.
@@ -105,6 +155,26 @@ class DynamicHTTPEndpoint(threading.Thread):
     (2): Now that we have a function, we can add it as a handler to a context path
         http_endpoint.add_handler('/hello', handler_func)
 
+    Handlers can also be limited to some methods, and match more than one path
+    (see tsqa.routing), for example:
+        http_endpoint.add_handler('/objects/', handler_func, match='prefix')
+        http_endpoint.add_handler('/*.txt', handler_func, methods=['GET'], match='glob')
+        http_endpoint.add_handler(r'/id/(\d+)', handler_func, match='regex')
+    For regexes the match object is available as flask.g.route_match. Paths
+    with handlers, but not for the request's method, get a 405.
+
+    By default requests are served by wsgiref, one connection at a time. For
+    concurrent traffic pass backend='thread' or backend='event' (or set
+    TSQA_HTTP_BACKEND), see tsqa.wsgi. Any other kwargs go to the server, for
+    those two idle_timeout and max_requests control how connections are kept
+    alive. counters() tells how many connections and requests the endpoint
+    has seen, to check the proxy reuses its origin connections:
+
+        before = http_endpoint.counters()
+        ... send some requests through the proxy ...
+        after = http_endpoint.counters()
+        self.assertLess(after['connections'] - before['connections'],
+                        after['requests'] - before['requests'])
     '''
     TRACKING_HEADER = '__cool_test_header__'  # TODO: better name?
 
@@ -115,48 +185,37 @@ class DynamicHTTPEndpoint(threading.Thread):
         '''
         return (self.server.server_address, self.server.server_port)
 
-    def __init__(self, port=0):
+    def __init__(self, port=0, backend=None, tracking=None, **server_kwargs):
         threading.Thread.__init__(self)
-        # dict to store request data in
-        self._tracked_requests = {}
+        # tracked requests (see tsqa.tracking)
+        self.tracking = tracking if tracking is not None else tsqa.tracking.TrackingStore()
         # error in startup
         self.error = None
 
         self.daemon = True
         self.port = port
+        self.backend = backend
+        self.server_kwargs = server_kwargs
         self.ready = threading.Event()
 
-        # dict of pathname (no starting /) -> function
-        self._handlers = {}
+        # handlers by path (see tsqa.routing)
+        self.router = tsqa.routing.Router()
 
         self.app = flask.Flask(__name__)
         self.app.debug = True
 
-
-        @self.app.before_request
-        def save_request():
-            '''
-            If the tracking header is set, save the request
-            '''
-            if flask.request.headers.get(self.TRACKING_HEADER):
-                self._tracked_requests[flask.request.headers[self.TRACKING_HEADER]] = {'request': flask.request}
-
-        @self.app.after_request
-        def save_response(response):
-            '''
-            If the tracking header is set, save the response
-            '''
-            if flask.request.headers.get(self.TRACKING_HEADER):
-                self._tracked_requests[flask.request.headers[self.TRACKING_HEADER]]['response'] = response
-
-            return response
+        track_app(self.app, self.tracking, self.TRACKING_HEADER)
 
         @self.app.route('/', defaults={'path': ''})
         @self.app.route('/<path:path>')
         def catch_all(path=''):
-            # get path key
-            if path in self._handlers:
-                return self._handlers[path](flask.request)
+            try:
+                route = self.router.lookup('/' + path, flask.request.method)
+            except tsqa.routing.MethodNotAllowed as e:
+                return ('', 405, {'Allow': ', '.join(sorted(e.allowed))})
+            if route is not None:
+                func, flask.g.route_match = route
+                return func(flask.request)
 
             # return a 404 since we didn't find it
             return ('', 404)
@@ -170,17 +229,14 @@ class DynamicHTTPEndpoint(threading.Thread):
         '''
         Return a new key for tracking a request by key
         '''
-        key = str(len(self._tracked_requests))
-        self._tracked_requests[key] = {}
-        return key
+        return self.tracking.new_key()
 
     def get_tracking_by_key(self, key):
         '''
-        Return tracking data by key
+        Return tracking data by key (a tsqa.tracking.Tracked, with the request
+        and response records)
         '''
-        if key not in self._tracked_requests:
-            raise Exception()
-        return self._tracked_requests[key]
+        return self.tracking.get(key)
 
     def normalize_path(self, path):
         '''
@@ -190,29 +246,39 @@ class DynamicHTTPEndpoint(threading.Thread):
             return path[1:]
         return path
 
-    def add_handler(self, path, func):
+    def _pattern(self, path, match):
         '''
-        Add a new handler attached to a specific path
+        Return the pattern the router should use for path (exact, prefix and
+        glob paths are relative to /, like in normalize_path)
         '''
-        path = self.normalize_path(path)
-        if path in self._handlers:
-            raise Exception()
-        self._handlers[path] = func
+        if match == 'regex':
+            return path
+        return '/' + self.normalize_path(path)
 
-    def remove_handler(self, path):
+    def add_handler(self, path, func, methods=None, match='exact'):
         '''
-        remove a handler attached to a specific path
+        Add a new handler attached to a specific path (or pattern, where match
+        is exact, prefix, glob or regex), for methods (default all of them)
         '''
-        path = self.normalize_path(path)
-        if path not in self._handlers:
-            raise Exception()
-        del self._handlers[path]
+        self.router.add(self._pattern(path, match), func, methods=methods, kind=match)
+
+    def remove_handler(self, path, methods=None, match='exact'):
+        '''
+        remove a handler attached to a specific path (for methods, default all)
+        '''
+        self.router.remove(self._pattern(path, match), methods=methods, kind=match)
 
     def clear_handlers(self):
         '''
         Clear all handlers that have been registered
         '''
-        self._handlers = {}
+        self.router.clear()
+
+    def counters(self):
+        '''
+        Return a dict of the connections accepted and requests served so far
+        '''
+        return self.server.counters()
 
     def url(self, path=''):
         '''
@@ -224,9 +290,11 @@ class DynamicHTTPEndpoint(threading.Thread):
 
     def run(self):
         try:
-            self.server = make_server('',
-                                      self.port,
-                                      self.app.wsgi_app)
+            self.server = tsqa.wsgi.make_server('',
+                                                self.port,
+                                                self.app.wsgi_app,
+                                                backend=self.backend,
+                                                **self.server_kwargs)
             # mark the socket as SO_REUSEADDR
             self.server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         except Exception as e:
@@ -250,6 +318,9 @@ class TrackingWSGIServer(threading.Thread):
         http_endpoint.start()
         # wait for the webserver to listen
         http_endpoint.ready.wait()
+
+    Like DynamicHTTPEndpoint, backend picks the server (see tsqa.wsgi), and
+    counters() returns the connections and requests it has seen
     '''
     TRACKING_HEADER = '__cool_test_header__'  # TODO: better name?
 
@@ -260,57 +331,47 @@ class TrackingWSGIServer(threading.Thread):
         '''
         return (self.server.server_address, self.server.server_port)
 
-    def __init__(self, app, port=0):
+    def __init__(self, app, port=0, backend=None, tracking=None, **server_kwargs):
         threading.Thread.__init__(self)
-        # dict to store request data in
-        self._tracked_requests = {}
+        # tracked requests (see tsqa.tracking)
+        self.tracking = tracking if tracking is not None else tsqa.tracking.TrackingStore()
 
         self.daemon = True
         self.port = port
+        self.backend = backend
+        self.server_kwargs = server_kwargs
         self.ready = threading.Event()
 
         self.app = app
         self.app.debug = True
 
-        @self.app.before_request
-        def save_request():
-            '''
-            If the tracking header is set, save the request
-            '''
-            if flask.request.headers.get(self.TRACKING_HEADER):
-                self._tracked_requests[flask.request.headers[self.TRACKING_HEADER]] = {'request': request.copy()}
-
-
-        @self.app.after_request
-        def save_response(response):
-            '''
-            If the tracking header is set, save the response
-            '''
-            if flask.request.headers.get(self.TRACKING_HEADER):
-                self._tracked_requests[flask.request.headers[self.TRACKING_HEADER]]['response'] = response
-
-            return response
+        track_app(self.app, self.tracking, self.TRACKING_HEADER)
 
     def get_tracking_key(self):
         '''
         Return a new key for tracking a request by key
         '''
-        key = str(len(self._tracked_requests))
-        self._tracked_requests[key] = {}
-        return key
+        return self.tracking.new_key()
 
     def get_tracking_by_key(self, key):
         '''
-        Return tracking data by key
+        Return tracking data by key (a tsqa.tracking.Tracked, with the request
+        and response records)
+        '''
+        return self.tracking.get(key)
+
+    def counters(self):
+        '''
+        Return a dict of the connections accepted and requests served so far
         '''
-        if key not in self._tracked_requests:
-            raise Exception()
-        return self._tracked_requests[key]
+        return self.server.counters()
 
     def run(self):
-        self.server = make_server('',
-                                  self.port,
-                                  self.app.wsgi_app)
+        self.server = tsqa.wsgi.make_server('',
+                                            self.port,
+                                            self.app.wsgi_app,
+                                            backend=self.backend,
+                                            **self.server_kwargs)
         # mark it as ready
         self.ready.set()
         # serve it
@@ -23,10 +23,17 @@ import tsqa.utils
 import sys
 import time
 import multiprocessing
+import multiprocessing.pool
+import threading
 import hashlib
 import json
+import atexit
+import signal
+import errno
+import re
 
 import tsqa.configs
+import tsqa.proc
 import tsqa.utils
 import logging
 
@@ -44,15 +51,37 @@ class EnvironmentFactory(object):
     # key -> exception
     negative_cache = {}
 
+    # key -> AsyncResult of a build started by schedule_builds()
+    pending_builds = {}
+
+    # (env_cache_dir, source_hash, key) -> EnvironmentPool
+    environment_pools = {}
+
+    # builds finish on worker threads, so serialize updates to the stash
+    stash_lock = threading.RLock()
+
     def __init__(self,
                  source_dir,
                  env_cache_dir,
                  default_configure=None,
                  default_env=None,
-                 build_dir=None):
+                 build_dir=None,
+                 incremental=None,
+                 cache_max_bytes=None,
+                 cache_max_entries=None,
+                 dedupe=None,
+                 pool_size=None):
+        # budget for cached layouts, the least recently used ones are evicted
+        if cache_max_bytes is None and 'TSQA_CACHE_MAX_BYTES' in os.environ:
+            cache_max_bytes = int(os.environ['TSQA_CACHE_MAX_BYTES'])
+        if cache_max_entries is None and 'TSQA_CACHE_MAX_ENTRIES' in os.environ:
+            cache_max_entries = int(os.environ['TSQA_CACHE_MAX_ENTRIES'])
+
         # if no one made the cache class, make it
         if self.class_environment_stash is None:
-            self.class_environment_stash = tsqa.utils.BuildCache(env_cache_dir)
+            self.class_environment_stash = tsqa.utils.BuildCache(env_cache_dir,
+                                                                 max_bytes=cache_max_bytes,
+                                                                 max_entries=cache_max_entries)
 
         # TODO: ensure this directory exists? (and is git?)
         self.source_dir = source_dir
@@ -70,10 +99,142 @@ class EnvironmentFactory(object):
 
         self.build_dir = build_dir
 
+        # store installs in a content addressed store, and hardlink layouts from it
+        if dedupe is None:
+            dedupe = os.environ.get('TSQA_DEDUPE_LAYOUTS', '1') != '0'
+        self.object_store = tsqa.utils.ObjectStore(os.path.join(env_cache_dir, 'objects')) if dedupe else None
+
+        # number of environments per layout to keep ready in an EnvironmentPool
+        if pool_size is None:
+            pool_size = int(os.environ.get('TSQA_ENV_POOL_SIZE', 0))
+        self.pool_size = pool_size
+
+        # keep a build tree per key under env_cache_dir and rebuild in it
+        if incremental is None:
+            incremental = os.environ.get('TSQA_INCREMENTAL_BUILD', '0') != '0'
+        self.incremental = incremental
+
+    def _get_build_dir(self, key):
+        '''
+        Return the persistent build dir for key (used in incremental mode), a
+        configured tree only works for the source_dir it was configured from
+        '''
+        source_key = hashlib.md5(os.path.realpath(self.source_dir)).hexdigest()
+        return os.path.join(self.env_cache_dir, 'builds', source_key, key)
+
+    # directories under source_dir that are never autoreconf inputs or outputs
+    autoreconf_skip_dirs = ('.git', 'autom4te.cache')
+
+    def _walk_source(self):
+        '''
+        Yield the relative path of every file in source_dir
+        '''
+        for dirpath, dirnames, filenames in os.walk(self.source_dir):
+            dirnames[:] = [d for d in dirnames if d not in self.autoreconf_skip_dirs]
+            for filename in filenames:
+                yield os.path.relpath(os.path.join(dirpath, filename), self.source_dir)
+
+    def _autoreconf_hash(self, generated=()):
+        '''
+        Hash everything autoreconf's output depends on: configure.ac, all of the
+        Makefile.am files, the m4 macros and the version of the autotools
+        themselves. Files autoreconf generated (generated, and aclocal.m4) are
+        skipped, as autoreconf -i installs some m4 macros itself (libtool.m4 etc.)
+        '''
+        generated = set(generated)
+        hval = hashlib.sha1()
+        hval.update(tsqa.utils.run_sync_command(['autoreconf', '--version'],
+                                                env=self.default_env,
+                                                stdout=subprocess.PIPE,
+                                                )[0])
+        inputs = []
+        for relpath in self._walk_source():
+            filename = os.path.basename(relpath)
+            if relpath in generated:
+                continue
+            if filename in ('configure.ac', 'configure.in', 'Makefile.am') or \
+                    (filename.endswith('.m4') and relpath != 'aclocal.m4'):
+                inputs.append(relpath)
+        for relpath in sorted(inputs):
+            hval.update(relpath)
+            with open(os.path.join(self.source_dir, relpath), 'rb') as fh:
+                hval.update(fh.read())
+        return hval.hexdigest()
+
     def autoreconf(self):
         '''
         Autoreconf to make the configure script
+
+        The generated files are cached in env_cache_dir by a hash of the build
+        system inputs, so autoreconf only runs when those actually change. This
+        is safe to call from concurrent builders (threads or processes)
         '''
+        autoreconf_dir = os.path.join(self.env_cache_dir, 'autoreconf')
+        source_id = hashlib.md5(os.path.realpath(self.source_dir)).hexdigest()
+        # what we last generated in this source_dir
+        stamp_file = os.path.join(autoreconf_dir, source_id + '.json')
+
+        with tsqa.utils.FileLock(os.path.join(autoreconf_dir, source_id + '.lock')):
+            try:
+                with open(stamp_file) as fh:
+                    stamp = json.load(fh)
+            except (IOError, ValueError):
+                stamp = {}
+
+            inputs_hash = self._autoreconf_hash(stamp.get('files', []))
+            output_dir = os.path.join(autoreconf_dir, inputs_hash)
+            manifest_file = os.path.join(output_dir, 'manifest.json')
+
+            if stamp.get('hash') == inputs_hash and \
+                    all(os.path.isfile(os.path.join(self.source_dir, f)) for f in stamp['files']):
+                log.debug('autoreconf output is up to date ({0})'.format(inputs_hash))
+                return
+
+            if os.path.isfile(manifest_file):
+                # we have generated this before, just put the files back
+                log.debug('Restoring cached autoreconf output ({0})'.format(inputs_hash))
+                with open(manifest_file) as fh:
+                    files = json.load(fh)
+                for relpath in files:
+                    dst = os.path.join(self.source_dir, relpath)
+                    if not os.path.isdir(os.path.dirname(dst)):
+                        os.makedirs(os.path.dirname(dst))
+                    # copy (not copy2) so the files are newer than anything
+                    # they were generated from
+                    shutil.copy(os.path.join(output_dir, 'files', relpath), dst)
+            else:
+                files = self._run_autoreconf(stamp.get('files', []))
+                # what autoreconf installed isn't an input, so (on a tree
+                # which had some of it already) the hash can change
+                inputs_hash = self._autoreconf_hash(files)
+                output_dir = os.path.join(autoreconf_dir, inputs_hash)
+                tmp_dir = tempfile.mkdtemp(dir=autoreconf_dir)
+                for relpath in files:
+                    dst = os.path.join(tmp_dir, 'files', relpath)
+                    if not os.path.isdir(os.path.dirname(dst)):
+                        os.makedirs(os.path.dirname(dst))
+                    shutil.copy2(os.path.join(self.source_dir, relpath), dst)
+                with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fh:
+                    json.dump(files, fh)
+                # move it in to place in one go, so we never have a partial entry
+                shutil.rmtree(output_dir, ignore_errors=True)
+                os.rename(tmp_dir, output_dir)
+
+            with open(stamp_file, 'w') as fh:
+                json.dump({'hash': inputs_hash, 'files': files}, fh)
+
+    def _run_autoreconf(self, previous_files):
+        '''
+        Run autoreconf in source_dir and return the list of files it generated
+
+        Some tools (autoheader for example) leave their output alone if it did
+        not change, so anything we generated last time is still considered
+        output if it is still around.
+        '''
+        before = {}
+        for relpath in self._walk_source():
+            before[relpath] = os.lstat(os.path.join(self.source_dir, relpath)).st_mtime
+
         kwargs = {
             'cwd': self.source_dir,
             'env': self.default_env,
@@ -89,6 +250,15 @@ class EnvironmentFactory(object):
 
         tsqa.utils.run_sync_command(['autoreconf', '-if'], **kwargs)
 
+        files = set(f for f in previous_files if os.path.isfile(os.path.join(self.source_dir, f)))
+        for relpath in self._walk_source():
+            path = os.path.join(self.source_dir, relpath)
+            if os.path.islink(path):
+                continue
+            if before.get(relpath) != os.lstat(path).st_mtime:
+                files.add(relpath)
+        return sorted(files)
+
     @property
     def source_hash(self):
         '''
@@ -108,10 +278,7 @@ class EnvironmentFactory(object):
         '''
         Return your source_dir's section of the cache
         '''
-        if self.source_hash not in self.class_environment_stash:
-            self.class_environment_stash[self.source_hash] = {}
-
-        return self.class_environment_stash[self.source_hash]
+        return self.class_environment_stash.setdefault(self.source_hash)
 
     def _get_key(self, *args):
         '''
@@ -125,9 +292,11 @@ class EnvironmentFactory(object):
                 hval.update(str(arg[k]))
         return hval.hexdigest()
 
-    def get_environment(self, configure=None, env=None):
+    def _resolve(self, configure=None, env=None):
         '''
-        Build (or return cached) environment with configure/env
+        Merge configure/env with the defaults and compute the build key
+
+        Returns a tuple of (key, configure, env, env_key)
         '''
         # set defaults, if none where passed in
         if configure is None:
@@ -147,62 +316,442 @@ class EnvironmentFactory(object):
 
         key = self._get_key(configure, env_key)
         log.debug('Key is: %s, args are: %s %s' % (key, configure, env_key))
+        return key, configure, env, env_key
 
-        # if we don't have it built already, lets build it
-        if key not in self.environment_stash:
-            if key in EnvironmentFactory.negative_cache:
-                raise EnvironmentFactory.negative_cache[key]
-            try:
-                self.autoreconf()
-                # if we have a build dir configured, lets use thatm otherwise
-                # lets use a tmp one
-                builddir = self.build_dir or tempfile.mkdtemp()
-
-                kwargs = {
-                    'cwd': builddir,
-                    'env': env,
-                    'stdout': subprocess.PIPE,
-                    'stderr': subprocess.PIPE
-                }
-
-                if log.isEnabledFor(logging.DEBUG):
-                    # if this is debug, lets not capture the output and let it go to
-                    # stdout and stderr
-                    kwargs['stdout'] = None
-                    kwargs['stderr'] = None
-                log.info('Starting build ({0}): configure {1}'.format(key, configure))
-
-                # configure
-                args = [os.path.join(self.source_dir, 'configure'), '--prefix=/'] + tsqa.utils.configure_list(configure)
-                tsqa.utils.run_sync_command(args, **kwargs)
+    def _build(self, key, configure, env, env_key, make_jobs=None):
+        '''
+        Build key, unless another process beats us to it
 
-                # make
-                tsqa.utils.run_sync_command(['make', '-j{0}'.format(multiprocessing.cpu_count())], **kwargs)
-                installdir = tempfile.mkdtemp(dir=self.env_cache_dir)
+        Only one process builds a given key at a time, the others wait on the
+        lock and then pick up the layout that was stashed
+        '''
+        with tsqa.utils.FileLock(os.path.join(self.env_cache_dir, 'locks', key + '.lock')):
+            if key in self.environment_stash:
+                log.info('Build ({0}) was completed by another process'.format(key))
+                return
+            self._build_locked(key, configure, env, env_key, make_jobs=make_jobs)
 
-                # make install
+    def _build_locked(self, key, configure, env, env_key, make_jobs=None):
+        '''
+        Configure, make and install a single build, and stash the resulting layout
+        '''
+        if make_jobs is None:
+            make_jobs = multiprocessing.cpu_count()
+        build_pin = None
+        try:
+            # if we have a build dir configured, lets use thatm otherwise
+            # lets use a tmp one (or the persistent one for this key)
+            if self.build_dir is not None:
+                builddir = self.build_dir
+            elif self.incremental:
+                builddir = self._get_build_dir(key)
+                if not os.path.isdir(builddir):
+                    os.makedirs(builddir)
+                # keep it from being evicted while we use it
+                build_pin = self.class_environment_stash.pin_build_dir(builddir)
+            else:
+                builddir = tempfile.mkdtemp()
+
+            kwargs = {
+                'cwd': builddir,
+                'env': env,
+                'stdout': subprocess.PIPE,
+                'stderr': subprocess.PIPE
+            }
+
+            if log.isEnabledFor(logging.DEBUG):
+                # if this is debug, lets not capture the output and let it go to
+                # stdout and stderr
+                kwargs['stdout'] = None
+                kwargs['stderr'] = None
+            log.info('Starting build ({0}): configure {1}'.format(key, configure))
+
+            # configure, unless we are reusing an already configured build
+            # tree. The generated Makefile reruns config.status itself if
+            # configure has changed since.
+            args = [os.path.join(self.source_dir, 'configure'), '--prefix=/'] + tsqa.utils.configure_list(configure)
+            if self.incremental and os.path.isfile(os.path.join(builddir, 'Makefile')):
+                log.info('Reusing build tree {0} for incremental build'.format(builddir))
+            else:
+                try:
+                    tsqa.utils.run_sync_command(args, **kwargs)
+                except Exception:
+                    # don't leave a half configured tree around to be reused
+                    if self.incremental and self.build_dir is None:
+                        shutil.rmtree(builddir, ignore_errors=True)
+                    raise
+
+            # make
+            tsqa.utils.run_sync_command(['make', '-j{0}'.format(make_jobs)], **kwargs)
+            installdir = tempfile.mkdtemp(dir=self.env_cache_dir)
+
+            # make install
+            if self.object_store is None:
                 tsqa.utils.run_sync_command(['make', 'install', 'DESTDIR={0}'.format(installdir)], **kwargs)
-
-                # if we had to create a tmp dir, we should delete it
-                if self.build_dir is None:
-                    shutil.rmtree(builddir)
-                # stash the env
+            else:
+                # install somewhere else, and build the layout from the store
+                stagingdir = tempfile.mkdtemp(prefix='staging.', dir=self.env_cache_dir)
+                try:
+                    tsqa.utils.run_sync_command(['make', 'install', 'DESTDIR={0}'.format(stagingdir)], **kwargs)
+                    added = self.object_store.ingest(stagingdir, installdir)
+                    log.info('Build ({0}) added {1} new bytes to the object store'.format(key, added))
+                finally:
+                    shutil.rmtree(stagingdir, ignore_errors=True)
+
+            # if we had to create a tmp dir, we should delete it
+            if self.build_dir is None and not self.incremental:
+                shutil.rmtree(builddir)
+            # stash the env
+            with EnvironmentFactory.stash_lock:
                 self.environment_stash[key] = {
                         'path': installdir,
                         'configuration': args,
                         'env': env_key,
                 }
-                log.info('Build completed ({0}): configure {1}'.format(key, configure))
-            except Exception as e:
-                EnvironmentFactory.negative_cache[key] = e
-                raise
+            log.info('Build completed ({0}): configure {1}'.format(key, configure))
+        except Exception as e:
+            EnvironmentFactory.negative_cache[key] = e
+            raise
+        finally:
+            if build_pin is not None:
+                # the build tree counts towards TSQA_CACHE_MAX_BYTES
+                self.class_environment_stash.update_build_dir(builddir)
+                self.class_environment_stash.unpin(build_pin)
+
+    def _scheduled_build(self, key, *args):
+        '''
+        Worker side of schedule_builds(), the result is dropped from
+        pending_builds once the build is stashed (or has failed)
+        '''
+        try:
+            self._build(key, *args)
+        finally:
+            EnvironmentFactory.pending_builds.pop(key, None)
+
+    def schedule_builds(self, variants, cpu_budget=None, max_concurrent=None):
+        '''
+        Build a set of configure/env variants in parallel
+
+        variants is an iterable of dicts in the same format as
+        EnvironmentFactoryCase.environment_factory ({'configure': ..., 'env': ...}).
+        Duplicate variants (same build key) are only built once, and cpu_budget
+        (defaults to the number of cpus) is split between the concurrent builds.
+
+        Returns a dict of key -> AsyncResult, get_environment will block on
+        these results if it is asked for a key that is still building.
+        '''
+        if cpu_budget is None:
+            cpu_budget = int(os.environ.get('TSQA_BUILD_CPUS', multiprocessing.cpu_count()))
+
+        ret = {}
+        pending = {}
+        for variant in variants:
+            key, configure, env, env_key = self._resolve(variant.get('configure'), variant.get('env'))
+            if key in ret or key in pending:
+                continue
+            if key in EnvironmentFactory.pending_builds:
+                ret[key] = EnvironmentFactory.pending_builds[key]
+            elif key not in self.environment_stash and key not in EnvironmentFactory.negative_cache:
+                pending[key] = (configure, env, env_key)
+
+        if not pending:
+            return ret
+
+        concurrent = len(pending)
+        if max_concurrent is not None:
+            concurrent = min(concurrent, max_concurrent)
+        # builds in a user specified build_dir would step on each other
+        if self.build_dir is not None:
+            concurrent = 1
+        concurrent = max(1, min(concurrent, cpu_budget))
+        make_jobs = max(1, cpu_budget // concurrent)
+
+        # autoreconf once up front, so the builds don't race on the source dir
+        self.autoreconf()
+
+        log.info('Scheduling {0} builds, {1} at a time with make -j{2}'.format(len(pending), concurrent, make_jobs))
+        pool = multiprocessing.pool.ThreadPool(concurrent)
+        for key, (configure, env, env_key) in pending.iteritems():
+            result = pool.apply_async(self._scheduled_build, (key, configure, env, env_key, make_jobs))
+            EnvironmentFactory.pending_builds[key] = result
+            ret[key] = result
+        # no more work will be added, the workers exit once the builds finish
+        pool.close()
+
+        return ret
+
+    def get_environment(self, configure=None, env=None):
+        '''
+        Build (or return cached) environment with configure/env
+        '''
+        key, configure, env, env_key = self._resolve(configure, env)
+
+        # if the build was scheduled, wait for it to finish
+        pending = EnvironmentFactory.pending_builds.get(key)
+        if pending is not None:
+            pending.get()
+
+        # if we don't have it built already, lets build it
+        if key not in self.environment_stash:
+            if key in EnvironmentFactory.negative_cache:
+                raise EnvironmentFactory.negative_cache[key]
+            self.autoreconf()
+            self._build(key, configure, env, env_key)
+
+        if self.pool_size:
+            pool_key = (self.env_cache_dir, self.source_hash, key)
+            with EnvironmentFactory.stash_lock:
+                if pool_key not in EnvironmentFactory.environment_pools:
+                    EnvironmentFactory.environment_pools[pool_key] = EnvironmentPool(
+                        lambda: self._clone_environment(key),
+                        self.pool_size,
+                    )
+            return EnvironmentFactory.environment_pools[pool_key].get()
+
+        return self._clone_environment(key)
+
+    def _clone_environment(self, key):
+        '''
+        Return an environment cloned from the cached layout for key
+        '''
+        # pin the layout while we have an environment cloned from it
+        pin = self.class_environment_stash.pin(self.source_hash, key)
+        if pin is None:
+            raise Exception('Layout for {0} was evicted before it could be used'.format(key))
+        # now that ours is pinned, make room in the cache
+        if self.class_environment_stash.evict() and self.object_store is not None:
+            self.object_store.gc()
 
         # create a layout
         layout = Layout(self.environment_stash[key]['path'])
 
         # return an environment cloned from that layout
         ret = Environment()
-        ret.clone(layout=layout)
+        ret.on_destroy.append(lambda: self.class_environment_stash.unpin(pin))
+        try:
+            ret.clone(layout=layout)
+        except:
+            ret.destroy()
+            raise
+        return ret
+
+
+class EnvironmentPool(object):
+    '''
+    Keep a number of ready to use (cloned, with ports and records.config set up)
+    environments around, refilled by a background thread.
+
+    create is a function returning a new environment, for example:
+
+        layout = tsqa.environment.Layout('/opt/ats')
+        def create():
+            env = tsqa.environment.Environment()
+            env.clone(layout=layout)
+            return env
+        pool = tsqa.environment.EnvironmentPool(create, size=2)
+        env = pool.get()
+
+    The daemons are not started, since tests still need to set up configs.
+    Environments which are never handed out are destroyed by close() (which is
+    also called at exit).
+    '''
+    def __init__(self, create, size=1):
+        self.create = create
+        self.size = size
+
+        self._ready = []
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _fill(self):
+        '''
+        Background thread, keeps self.size environments ready
+        '''
+        while True:
+            with self._cond:
+                while not self._closed and len(self._ready) >= self.size:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            try:
+                env = self.create()
+            except Exception:
+                # get() will create its own, and hit the same error in the foreground
+                log.exception('Unable to pre-create environment, stopping pool refills')
+                return
+            with self._cond:
+                if self._closed:
+                    env.destroy()
+                    return
+                self._ready.append(env)
+                self._cond.notify_all()
+
+    def get(self):
+        '''
+        Return a ready environment, if none are ready we make one ourselves
+        '''
+        with self._cond:
+            if self._closed:
+                raise Exception('EnvironmentPool is closed')
+            env = self._ready.pop(0) if self._ready else None
+            # let the background thread make a replacement
+            self._cond.notify_all()
+        if env is None:
+            env = self.create()
+        return env
+
+    def close(self):
+        '''
+        Stop refilling and destroy all environments that weren't handed out
+        '''
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        while self._ready:
+            self._ready.pop().destroy()
+
+
+class StartupProfiler(object):
+    '''
+    Record a timeline of a daemon starting up: processes of its process group
+    appearing in /proc, ports becoming connectable (see port_up) and markers
+    showing up in its logs. Times are seconds since the profiler was created
+    (which should be right before the exec).
+    '''
+    # (event name, log file, regex), every matching line is recorded
+    markers = (
+        ('manager_starting', 'manager.log', r'traffic_manager Starting'),
+        ('server_launched', 'manager.log', r'Launching ts process'),
+        ('server_starting', 'diags.log', r'traffic_server Starting'),
+        ('plugin_loading', 'diags.log', r'loading plugin'),
+        ('cache_enabled', 'diags.log', r'cache enabled'),
+        ('server_running', 'diags.log', r'traffic server running'),
+    )
+
+    def __init__(self, logdir, interval=0.05):
+        self.start_time = time.time()
+        self.interval = interval
+        self.events = []
+        self._pgid = None
+        self._seen_pids = set()
+        self._tails = {}
+        for _, filename, _ in self.markers:
+            if filename not in self._tails:
+                self._tails[filename] = tsqa.utils.LogTail(os.path.join(logdir, filename), from_end=True)
+        self._markers = [(name, filename, re.compile(regex)) for name, filename, regex in self.markers]
+        self._stopping = threading.Event()
+        self._thread = None
+        self.event('exec', 'traffic_cop')
+
+    def event(self, kind, name, **details):
+        details.update({'time': time.time() - self.start_time,
+                        'kind': kind,
+                        'name': name,
+                        })
+        self.events.append(details)
+
+    def port_up(self, hostport):
+        self.event('port', '{0}:{1}'.format(*hostport))
+
+    def start(self, pgid):
+        '''
+        Start watching processes of pgid (and the logs) in the background
+        '''
+        self._pgid = pgid
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _poll(self):
+        # (the leader is the only way into the group, so walk its descendants
+        # instead of all of /proc)
+        for pid, stat in tsqa.proc.group_processes(self._pgid, leader=self._pgid).iteritems():
+            if pid not in self._seen_pids:
+                self._seen_pids.add(pid)
+                self.event('process', stat['comm'], pid=pid)
+        for filename, tail in self._tails.iteritems():
+            for line in tail.lines():
+                for name, marker_file, regex in self._markers:
+                    if marker_file == filename and regex.search(line):
+                        self.event('log', name, line=line.strip())
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self._poll()
+
+    def stop(self, ready=True):
+        '''
+        Stop watching, and return the profile: a dict of start (unix time),
+        total (seconds to ready) and the list of events (sorted by time)
+        '''
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+            # pick up anything that happened since the last poll
+            self._poll()
+        for tail in self._tails.itervalues():
+            tail.close()
+        total = time.time() - self.start_time
+        if ready:
+            self.event('ready', 'traffic_cop')
+        return {'start': self.start_time,
+                'total': total,
+                'ready': ready,
+                'events': sorted(self.events, key=lambda event: event['time']),
+                }
+
+
+class Metrics(dict):
+    '''
+    A snapshot of the metrics of a daemon: a dict of name -> value (int, float
+    or str, depending on what the metric looks like)
+    '''
+    @staticmethod
+    def parse_value(value):
+        for kind in (int, float):
+            try:
+                return kind(value)
+            except ValueError:
+                pass
+        return value
+
+    @classmethod
+    def parse(cls, output):
+        '''
+        Parse "name value" lines (the output of traffic_ctl metric match, or
+        traffic_line -m)
+        '''
+        ret = cls()
+        for line in output.splitlines():
+            parts = line.strip().split(None, 1)
+            if not parts:
+                continue
+            ret[parts[0]] = cls.parse_value(parts[1] if len(parts) > 1 else '')
+        return ret
+
+    def diff(self, before):
+        '''
+        Return a dict of name -> change since the before snapshot, for the
+        numeric metrics which changed (or are new)
+        '''
+        ret = {}
+        for name, value in self.iteritems():
+            if not isinstance(value, (int, long, float)):
+                continue
+            old = before.get(name, 0)
+            if not isinstance(old, (int, long, float)):
+                continue
+            if value != old:
+                ret[name] = value - old
         return ret
 
 
@@ -273,6 +822,60 @@ class Environment(object):
     cause failures in other environments.
 
     '''
+    # records.config entries (or prefixes) which only take effect on restart.
+    # This doesn't need to be complete, after a reload ATS tells us if it
+    # needs a restart anyways (see reconfigure)
+    restart_records = (
+        'proxy.config.http.server_ports',
+        'proxy.config.process_manager.',
+        'proxy.config.admin.',
+        'proxy.config.config_dir',
+        'proxy.config.local_state_dir',
+        'proxy.config.bin_path',
+        'proxy.config.plugin.plugin_dir',
+        'proxy.config.log.logfile_dir',
+        'proxy.config.body_factory.template_sets_dir',
+        'proxy.config.cache.storage_filename',
+        'proxy.config.cache.hosting_filename',
+        'proxy.config.cache.volume_filename',
+        'proxy.config.cache.interim.',
+        'proxy.config.cache.ram_cache.',
+        'proxy.config.cache.min_average_object_size',
+        'proxy.config.cache.target_fragment_size',
+        'proxy.config.cache.threads_per_disk',
+        'proxy.config.cache.max_disk_errors',
+        'proxy.config.cache.permit.pinning',
+        'proxy.config.exec_thread.',
+        'proxy.config.accept_threads',
+        'proxy.config.lm.',
+    )
+
+    # logged to diags.log once a config file has been reloaded, "<file> done
+    # reloading!" (ATS < 9) or "<file> finished loading" ({0} is the filename)
+    reload_log_marker = r'NOTE: {0} (done reloading!|finished loading)'
+
+    # whether to make this (the test runner) process a subreaper when starting
+    # the daemons, so that stop() can reap all of them rather than waiting for
+    # init to. This affects every orphaned descendant of the process (not just
+    # the daemons), which then has to be reaped, so it is opt-in
+    subreaper = os.environ.get('TSQA_SUBREAPER', '0') == '1'
+
+    # files written to the prefix which are worth keeping (see destroy)
+    artifacts = ('startup_profile.json', 'resources.json')
+
+    # smallest cache ATS will accept
+    min_cache_storage_size = 128 * 1024 * 1024
+    # where tmpfs backed cache storage (and layouts) go
+    tmpfs_dir = '/dev/shm'
+
+    # config files which are only read on startup
+    restart_configs = (
+        'storage.config',
+        'volume.config',
+        'plugin.config',
+        'hosting.config',
+    )
+
     def features(self):
         out = subprocess.check_output([
             os.path.join(self.layout.bindir, 'traffic_layout'),
@@ -296,37 +899,80 @@ class Environment(object):
 
         return environ
 
-    def __exec_cop(self):
+    def __exec_cop(self, log_marker=None):
         path = os.path.join(self.layout.bindir, 'traffic_cop')
         cmd = [path, '--debug', '--stdout']
 
         with open(os.path.join(self.layout.logdir, 'cop.log'), 'w+') as logfile:
+            # run the daemons in their own process group, so we can stop all
+            # of them (not just cop) at once. As a subreaper (if enabled) we'll
+            # also be able to wait on cop's children once they are orphaned.
+            if self.subreaper:
+                tsqa.utils.become_subreaper()
+            cmd, preexec_fn = tsqa.utils.new_session(cmd)
+            # only look for the marker in what this run logs
+            watcher = None
+            if log_marker is not None:
+                watcher = tsqa.utils.LogMarkerWatcher(os.path.join(self.layout.logdir, 'diags.log'),
+                                                      log_marker, from_end=True)
+            profiler = StartupProfiler(self.layout.logdir)
             self.cop = subprocess.Popen(
                 cmd,
                 env=self.shell_env,
                 stdout=logfile,
                 stderr=logfile,
+                preexec_fn=preexec_fn,
             )
-            start = time.time()
+            self._pgid = self.cop.pid
+            profiler.start(self._pgid)
             # TODO: more specific exception?
             try:
-                tsqa.utils.poll_interfaces(self.hostports)
+                tsqa.utils.poll_interfaces(self.hostports, log_watcher=watcher, on_up=profiler.port_up)
             except:
+                self._save_startup_profile(profiler.stop(ready=False))
                 self.stop()  # make sure to stop the daemons
                 raise
-            log.debug('traffic_cop took {0}s to start up'.format(time.time() - start))
+            self._save_startup_profile(profiler.stop())
+            log.debug('traffic_cop took {0}s to start up'.format(self.startup_profile['total']))
 
             self.cop.poll()
             if self.cop.returncode is not None:
                 raise Exception(self.cop.returncode, self.layout.prefix)
 
+    def _save_startup_profile(self, profile):
+        '''
+        Keep the profile of the last start (in startup_profile), and save it
+        to startup_profile.json in the prefix
+        '''
+        self.startup_profile = profile
+        with open(os.path.join(self.layout.prefix, 'startup_profile.json'), 'w') as fh:
+            json.dump(profile, fh, indent=2)
+
     def __init__(self, layout=None):
         """
         Initialize a new Environment.
         """
         self.cop = None
+        # process group of the daemons, while any of them may be around
+        self._pgid = None
         # TODO: parse config? Don't like the separate hostports...
         self.hostports = []
+        # functions to call once the environment is destroyed
+        self.on_destroy = []
+        # filename -> contents of the configs the daemon was started/reloaded with
+        self._loaded_configs = {}
+        # sysconfdir as of snapshot(), filename -> [stat key, contents]
+        self._snapshot = None
+        # timeline of the last start (see StartupProfiler)
+        self.startup_profile = None
+        # tsqa.proc.ResourceSampler, if one was started
+        self.sampler = None
+        # log filename -> tsqa.utils.LogFollower
+        self._logs = {}
+        # cache directories created for (and only used by) this environment
+        self._owned_storage = []
+        # where artifacts are kept once the environment is destroyed
+        self.results_dir = os.environ.get('TSQA_RESULTS_DIR')
         if layout:
             self.layout = layout
         else:
@@ -343,27 +989,83 @@ class Environment(object):
         # Make any other directories we need.
         os.makedirs(os.path.join(self.layout.sysconfdir, "body_factory"))
 
-    def clone(self, layout=None):
+    # layout suffixes that tests (and the daemons) write to, the top level
+    # directories containing these are always copied when cloning
+    mutable_suffixes = ('sysconfdir', 'logdir', 'runtimedir')
+    # read-only suffixes whose contents clone() always symlinks
+    symlinked_suffixes = ('bindir', 'libdir')
+
+    def clone(self, layout=None, mode=None, cache_storage_size=None, tmpfs=None):
         """
         Clone the given layout to this environment's prefix
+
+        The contents of the symlinked_suffixes (bindir, libdir) are always
+        symlinked. mode controls how the rest of the read-only parts of the
+        layout (everything outside of the mutable_suffixes) are cloned:
+            - reflink: reflink each file if the filesystem supports it,
+                otherwise copy it. Cheap on btrfs/xfs, and always safe.
+            - link: reflink each file if the filesystem supports it, otherwise
+                hardlink it, otherwise symlink it. This makes cloning very cheap
+                anywhere, but those files must not be modified in place (that
+                would modify the cached layout, and its object store).
+            - copy: copy everything
+        Defaults to TSQA_CLONE_MODE, or reflink. Mutable directories are always
+        copied (using reflinks when possible).
+
+        If cache_storage_size (TSQA_CACHE_STORAGE_SIZE) is set, storage.config
+        is replaced with a cache of that size (see setup_cache_storage). If
+        tmpfs (TSQA_TMPFS_LAYOUT) is set the prefix is created on tmpfs, as
+        long as there is room for it.
         """
+        if mode is None:
+            mode = os.environ.get('TSQA_CLONE_MODE', 'reflink')
+        if mode not in ('reflink', 'link', 'copy'):
+            raise Exception('Unknown clone mode: {0}'.format(mode))
+        if cache_storage_size is None:
+            cache_storage_size = os.environ.get('TSQA_CACHE_STORAGE_SIZE')
+        if tmpfs is None:
+            tmpfs = os.environ.get('TSQA_TMPFS_LAYOUT', '0') == '1'
+
         # First, make the prefix directory.
         if self.layout is None:
+            layout_dir = os.environ.get('TSQA_LAYOUT_DIR', None)
+            if tmpfs:
+                # in link mode only the mutable parts take up space
+                if mode == 'link':
+                    needed = sum(tsqa.utils.disk_usage(getattr(layout, name)) for name in self.mutable_suffixes)
+                else:
+                    needed = tsqa.utils.disk_usage(layout.prefix)
+                if cache_storage_size:
+                    needed += max(tsqa.utils.parse_size(cache_storage_size), self.min_cache_storage_size)
+                if tsqa.utils.free_space(self.tmpfs_dir) > needed:
+                    layout_dir = self.tmpfs_dir
+                else:
+                    log.debug('Not enough room on {0} for the layout ({1} bytes)'.format(self.tmpfs_dir, needed))
             self.layout = Layout(tempfile.mkdtemp(
                 prefix=os.environ.get('TSQA_LAYOUT_PREFIX', 'tsqa.env.'),
-                dir=os.environ.get('TSQA_LAYOUT_DIR', None)),
+                dir=layout_dir),
             )
         else:
             os.makedirs(self.layout.prefix)
         os.chmod(self.layout.prefix, 0777)  # Make the tmp dir readable by all
 
-        # TODO: handle sock files (copytree doesn't like them!)
+        mutable_items = set(layout.suffixes[name].split('/')[0] for name in self.mutable_suffixes)
+        symlinked_items = set(layout.suffixes[name] for name in self.symlinked_suffixes)
+        cloner = tsqa.utils.TreeCloner()
+
         # copy all files from old layout to new one
         for item in os.listdir(layout.prefix):
             src_path = os.path.join(layout.prefix, item)
             dst_path = os.path.join(self.layout.prefix, item)
-            # if its the bindir, lets symlink in everything
-            if item == layout.suffixes['bindir']:
+            if os.path.islink(src_path):
+                linkto = os.readlink(src_path)
+                os.symlink(linkto, dst_path)
+
+            elif item in mutable_items:
+                cloner.clone(src_path, dst_path, link=False)
+
+            # if its the bindir (or libdir), lets symlink in everything
+            elif item in symlinked_items:
                 os.makedirs(dst_path)  # make the dest dir
                 for bin_item in os.listdir(src_path):
                      os.symlink(
@@ -371,20 +1073,8 @@ class Environment(object):
                         os.path.join(dst_path, bin_item),
                      )
 
-            elif os.path.islink(src_path):
-                linkto = os.readlink(src_path)
-                os.symlink(linkto, dst_path)
-
-            elif os.path.isdir(src_path):
-                shutil.copytree(
-                    src_path,
-                    dst_path,
-                    symlinks=True,
-                    ignore=None,
-                )
-
-            elif os.path.isfile(src_path):
-                shutil.copyfile(src_path, dst_path)
+            else:
+                cloner.clone(src_path, dst_path, link=mode == 'link')
 
         # make sure that all suffixes in new layout exist
         for name in self.layout.suffixes:
@@ -394,9 +1084,10 @@ class Environment(object):
             else:
                 os.chmod(dirname, 0777)
 
-        http_server_port = tsqa.utils.bind_unused_port()[1]
-        manager_mgmt_port = tsqa.utils.bind_unused_port()[1]
-        admin_port = tsqa.utils.bind_unused_port()[1]
+        # reserve our ports (so no other environment gets them) until we are destroyed
+        ports = tsqa.utils.reserve_ports(3)
+        self.on_destroy.append(lambda: tsqa.utils.release_ports(ports))
+        http_server_port, manager_mgmt_port, admin_port = ports
 
         self.hostports = [
             ('127.0.0.1', http_server_port),
@@ -445,6 +1136,9 @@ class Environment(object):
         os.chmod(os.path.join(os.path.dirname(self.layout.runtimedir)), 0777)
         os.chmod(os.path.join(self.layout.runtimedir), 0777)
 
+        if cache_storage_size:
+            self.setup_cache_storage(cache_storage_size)
+
         # write out a convenience script to
         with open(os.path.join(self.layout.prefix, 'run'), 'w') as runscript:
             runscript.write('#! /usr/bin/env sh\n\n')
@@ -458,37 +1152,175 @@ class Environment(object):
         os.chmod(os.path.join(self.layout.prefix, 'run'), 0755)
 
 
+    def setup_cache_storage(self, size):
+        """
+        Replace storage.config with a single cache file of size (bytes, or a
+        storage.config style size like 256M). The file is sparse, and on tmpfs
+        if there is room for it (falling back to the layout), which keeps the
+        cost of initializing the cache on startup down.
+        """
+        size = max(tsqa.utils.parse_size(size), self.min_cache_storage_size)
+        if tsqa.utils.free_space(self.tmpfs_dir) > size:
+            cache_dir = tempfile.mkdtemp(prefix='tsqa.cache.', dir=self.tmpfs_dir)
+            self.on_destroy.append(lambda: shutil.rmtree(cache_dir, ignore_errors=True))
+            self._owned_storage.append(os.path.realpath(cache_dir))
+        else:
+            log.debug('Not enough room on {0} for the cache, using the layout'.format(self.tmpfs_dir))
+            # not runtimedir, which is wiped on reset()
+            cache_dir = os.path.join(self.layout.prefix, 'var', 'cache')
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0777)
+        os.chmod(cache_dir, 0777)
+
+        cache_path = os.path.join(cache_dir, 'cache.db')
+        with open(cache_path, 'w') as fh:
+            fh.truncate(size)
+        with open(os.path.join(self.layout.sysconfdir, 'storage.config'), 'w') as fh:
+            fh.write('{0} {1}\n'.format(cache_path, size))
+        return cache_path
+
+    def start_sampler(self, interval=None):
+        '''
+        Start sampling the resource usage (rss, cpu time etc.) of the daemons
+        every interval (TSQA_SAMPLE_INTERVAL, or 1) seconds in the background.
+        The series are available from self.sampler, and keep going across
+        restarts until stop_sampler()
+        '''
+        if self.sampler is not None:
+            raise Exception('sampler already started')
+        if interval is None:
+            interval = float(os.environ.get('TSQA_SAMPLE_INTERVAL', 1))
+        self.sampler = tsqa.proc.ResourceSampler(lambda: self._pgid, interval=interval)
+        self.sampler.start()
+        return self.sampler
+
+    def stop_sampler(self):
+        '''
+        Stop the sampler, dump the samples to resources.json in the prefix and
+        return it
+        '''
+        sampler, self.sampler = self.sampler, None
+        if sampler is None:
+            return None
+        sampler.stop()
+        if self.layout is not None and self.layout.prefix is not None:
+            sampler.dump(os.path.join(self.layout.prefix, 'resources.json'))
+        return sampler
+
+    def log(self, name='diags.log'):
+        '''
+        Return the LogFollower of name (in logdir), to get the lines logged
+        since a checkpoint or wait for a line without re-reading the whole log
+        '''
+        if name not in self._logs:
+            self._logs[name] = tsqa.utils.LogFollower(os.path.join(self.layout.logdir, name))
+        return self._logs[name]
+
+    def log_checkpoint(self, name='diags.log'):
+        '''
+        Skip everything logged to name so far (see wait_for_log)
+        '''
+        self.log(name).checkpoint()
+
+    def wait_for_log(self, regex, timeout=10, name='diags.log'):
+        '''
+        Wait up to timeout seconds for a line matching regex to be logged to
+        name (since the last checkpoint, or wait), and return the match
+        '''
+        return self.log(name).wait_for(regex, timeout=timeout)
+
+    def save_artifacts(self):
+        '''
+        Copy the artifacts in the prefix to a directory (named after the
+        prefix) in results_dir, if it is set. Returns that directory
+        '''
+        if self.results_dir is None or self.layout is None or self.layout.prefix is None:
+            return None
+        dest = os.path.join(self.results_dir, os.path.basename(self.layout.prefix.rstrip('/')))
+        for name in self.artifacts:
+            path = os.path.join(self.layout.prefix, name)
+            if not os.path.isfile(path):
+                continue
+            if not os.path.isdir(dest):
+                os.makedirs(dest)
+            shutil.copy(path, dest)
+        return dest
+
     def destroy(self):
         """
         Tear down the environment. Kill any running processes and remove any
-        installed files.
+        installed files, keeping the artifacts in results_dir (TSQA_RESULTS_DIR)
+        if it is set.
         """
+        self.stop_sampler()
         self.stop()
-        shutil.rmtree(self.layout.prefix, ignore_errors=True)
+        while self._logs:
+            self._logs.popitem()[1].close()
+        if self.layout is not None and self.layout.prefix is not None:
+            self.save_artifacts()
+            shutil.rmtree(self.layout.prefix, ignore_errors=True)
         self.layout = Layout(None)
+        while self.on_destroy:
+            self.on_destroy.pop(0)()
 
-    def start(self):
+    def start(self, log_marker=None):
+        '''
+        Start traffic_cop, and wait for all of our ports to be up. If log_marker
+        (a regex, for example "traffic server running") is set also wait for it
+        to show up in diags.log
+        '''
         if self.running():  # if its already running, don't start another one
             raise Exception('traffic cop already started')
         log.debug("Starting traffic cop")
         assert(os.path.isfile(os.path.join(self.layout.sysconfdir, 'records.config')))
-        self.__exec_cop()
+        # what the daemon is starting with, for reconfigure()
+        self._loaded_configs = self._read_configs()
+        if self.sampler is None and os.environ.get('TSQA_SAMPLE_INTERVAL'):
+            self.start_sampler()
+        self.__exec_cop(log_marker=log_marker)
         log.debug("Started traffic cop: %s", self.cop)
 
     # TODO: exception if already stopped?
-    def stop(self):
+    def stop(self, timeout=2):
+        '''
+        Stop traffic_cop and everything it started, waiting up to timeout
+        seconds for them to exit before killing them
+        '''
         log.debug("Stopping traffic cop: %s", self.cop)
-        if self.running():
-            self.cop.kill()
-            # wait for a max of 2s
-            stoptime = time.time() + 2
-            while time.time() < stoptime:
-                # if we got a returncode, we exited
-                if self.cop.poll() is not None:
+        stop_all([self], timeout=timeout)
+
+    def _kill(self, sig=signal.SIGKILL):
+        '''
+        Send sig (SIGKILL) to every process in our process group
+        '''
+        if self._pgid is None:
+            return
+        try:
+            os.killpg(self._pgid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap(self):
+        '''
+        Block until cop, and any of its children we are the (sub)reaper of, have
+        exited
+        '''
+        self.cop.wait()
+        if not tsqa.utils.is_subreaper():
+            # init reaps the rest of the group, so we can't wait for them. cop
+            # being gone is as good as it gets, make sure the rest go too.
+            self._kill()
+            return
+        while True:
+            try:
+                os.waitpid(-self._pgid, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
                     return
-                time.sleep(0.1)
-            log.error('Unable to stop traffic_cop: {0}'.format(self.cop))
-            self.cop.terminate()  # TODO: remove?? or wait...
+                raise
 
     def running(self):
         if self.cop is None:
@@ -496,6 +1328,295 @@ class Environment(object):
         self.cop.poll()
         return self.cop.returncode is None  # its running if it hasn't died
 
+    def run(self, args, **kwargs):
+        '''
+        Run a command (list of args) in this environment, using the run script.
+        Returns (stdout, stderr)
+        '''
+        kwargs.setdefault('stdout', subprocess.PIPE)
+        kwargs.setdefault('stderr', subprocess.PIPE)
+        return tsqa.utils.run_sync_command([os.path.join(self.layout.prefix, 'run')] + list(args), **kwargs)
+
+    def _has_traffic_ctl(self):
+        # traffic_ctl replaced traffic_line in ATS 6.x
+        return os.path.exists(os.path.join(self.layout.bindir, 'traffic_ctl'))
+
+    def _get_metric(self, name):
+        '''
+        Read a single metric (or record) from the running daemon
+        '''
+        if self._has_traffic_ctl():
+            stdout, _ = self.run([os.path.join(self.layout.bindir, 'traffic_ctl'), 'metric', 'get', name])
+            return stdout.strip().split(' ', 1)[-1]
+        stdout, _ = self.run([os.path.join(self.layout.bindir, 'traffic_line'), '-r', name])
+        return stdout.strip()
+
+    # metrics returned by metrics()
+    metrics_regex = r'proxy\.(process|node)\..*'
+
+    def metrics(self, regex=None):
+        '''
+        Return a Metrics snapshot of all the metrics matching regex (defaults to
+        all the proxy.process.* and proxy.node.* ones), fetched with a single
+        traffic_ctl (or traffic_line) call. To see what some traffic changed:
+
+            before = env.metrics()
+            ...
+            changes = env.metrics().diff(before)
+        '''
+        if regex is None:
+            regex = self.metrics_regex
+        if self._has_traffic_ctl():
+            stdout, _ = self.run([os.path.join(self.layout.bindir, 'traffic_ctl'), 'metric', 'match', regex])
+        else:
+            stdout, _ = self.run([os.path.join(self.layout.bindir, 'traffic_line'), '-m', regex])
+        return Metrics.parse(stdout)
+
+    def _read_configs(self):
+        '''
+        Return a dict of filename -> contents for the files in sysconfdir
+        '''
+        ret = {}
+        for name in os.listdir(self.layout.sysconfdir):
+            path = os.path.join(self.layout.sysconfdir, name)
+            if os.path.isfile(path):
+                with open(path) as fh:
+                    ret[name] = fh.read()
+        return ret
+
+    @staticmethod
+    def _stat_key(path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime, st.st_ino)
+
+    def snapshot(self):
+        '''
+        Record the current configs as the baseline for reset()
+        '''
+        self._snapshot = {}
+        for name in os.listdir(self.layout.sysconfdir):
+            path = os.path.join(self.layout.sysconfdir, name)
+            if os.path.isfile(path):
+                with open(path) as fh:
+                    self._snapshot[name] = [self._stat_key(path), fh.read()]
+        return self._snapshot
+
+    def reset_configs(self):
+        '''
+        Put sysconfdir back the way it was at snapshot(). Files are only read
+        (and rewritten) if their size/mtime changed, so this is cheap when the
+        test only touched a few configs. This is safe while running, but the
+        daemon won't notice until reconfigure()
+        '''
+        if self._snapshot is None:
+            raise Exception('reset without a snapshot')
+        for name in os.listdir(self.layout.sysconfdir):
+            path = os.path.join(self.layout.sysconfdir, name)
+            if name not in self._snapshot and os.path.isfile(path):
+                os.unlink(path)
+        for name, entry in self._snapshot.iteritems():
+            path = os.path.join(self.layout.sysconfdir, name)
+            stat_key, contents = entry
+            if os.path.isfile(path):
+                if self._stat_key(path) == stat_key:
+                    continue
+                with open(path) as fh:
+                    if fh.read() == contents:
+                        entry[0] = self._stat_key(path)
+                        continue
+            # replace the file, in case it is hardlinked somewhere
+            tmp_path = path + '.tsqa-reset'
+            with open(tmp_path, 'w') as fh:
+                fh.write(contents)
+            os.rename(tmp_path, path)
+            entry[0] = self._stat_key(path)
+
+    def _storage_paths(self):
+        '''
+        Return the (absolute) paths of the cache storage in storage.config
+        '''
+        ret = []
+        path = os.path.join(self.layout.sysconfdir, 'storage.config')
+        if not os.path.isfile(path):
+            return ret
+        with open(path) as fh:
+            for line in fh:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    # relative paths are relative to the prefix
+                    ret.append(os.path.join(self.layout.prefix, line.split()[0]))
+        return ret
+
+    def reset(self):
+        '''
+        Reset the (stopped) environment to the state it was in at snapshot():
+        restore the configs, truncate logs, wipe runtimedir and reinitialize
+        the cache. Only state which was actually dirtied is touched.
+        '''
+        if self.running():
+            raise Exception('Cannot reset a running environment, stop it first')
+        self.reset_configs()
+
+        for dirpath, dirnames, filenames in os.walk(self.layout.logdir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.isfile(path) and os.path.getsize(path) > 0:
+                    open(path, 'w').close()
+
+        for name in os.listdir(self.layout.runtimedir):
+            path = os.path.join(self.layout.runtimedir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+
+        # ATS recreates (and initializes) cache storage which doesn't exist, so
+        # remove cache files and the contents of cache directories. Raw devices
+        # are left alone, as is anything outside of the prefix (which might be
+        # shared with other environments) unless setup_cache_storage made it
+        owned = [os.path.join(self.layout.prefix, '')]
+        owned.extend(os.path.join(path, '') for path in self._owned_storage)
+        owned = [os.path.join(os.path.realpath(path), '') for path in owned]
+        for path in self._storage_paths():
+            path = os.path.realpath(path)
+            if not any(path.startswith(prefix) for prefix in owned):
+                log.warning('Not resetting cache storage {0}, it is outside of {1}'.format(path, self.layout.prefix))
+                continue
+            if os.path.isdir(path):
+                for name in os.listdir(path):
+                    item = os.path.join(path, name)
+                    if os.path.isdir(item) and not os.path.islink(item):
+                        shutil.rmtree(item)
+                    else:
+                        os.unlink(item)
+            elif os.path.isfile(path):
+                os.unlink(path)
+
+    def needs_restart(self):
+        '''
+        Return whether the configs on disk have changed (since the daemon
+        loaded them) in a way that requires a restart
+        '''
+        current = self._read_configs()
+        changed = set(name for name in set(current) | set(self._loaded_configs)
+                      if current.get(name) != self._loaded_configs.get(name))
+        if changed & set(self.restart_configs):
+            return True
+        if 'records.config' in changed:
+            old = tsqa.configs.RecordsConfig.parse(self._loaded_configs.get('records.config', ''))
+            new = tsqa.configs.RecordsConfig.parse(current.get('records.config', ''))
+            for name in set(old) | set(new):
+                if old.get(name) != new.get(name) and name.startswith(self.restart_records):
+                    return True
+        return False
+
+    def reconfigure(self, timeout=10):
+        '''
+        Apply the configs on disk to the running daemon
+
+        If nothing changed since the daemon (re)loaded its configs this is a
+        no-op. Changes that can be reloaded are applied with a config reload
+        (waiting for it to complete), otherwise the daemon is restarted.
+        Returns one of None (nothing to do), 'reload' or 'restart'
+        '''
+        if not self.running():
+            raise Exception('traffic cop is not running')
+        if self._read_configs() == self._loaded_configs:
+            return None
+
+        if self.needs_restart():
+            log.debug('Config changes require a restart')
+            self.stop()
+            self.start()
+            return 'restart'
+
+        log.debug('Reloading configs')
+        # ATS logs when it has reloaded a config file, except for records.config
+        current = self._read_configs()
+        changed = [name for name in current
+                   if name != 'records.config' and current[name] != self._loaded_configs.get(name)]
+        marker = None
+        if changed:
+            marker = re.compile(self.reload_log_marker.format(
+                '({0})'.format('|'.join(re.escape(name) for name in changed))))
+        # otherwise we wait for the reconfigure time to be updated, which only
+        # has a resolution of a second: make sure it will change
+        before = self._get_metric('proxy.node.config.reconfigure_time')
+        try:
+            wait = int(before) + 1 - time.time()
+        except ValueError:
+            wait = 0
+        if marker is None and wait > 0:
+            time.sleep(wait)
+        self.log_checkpoint()
+        if self._has_traffic_ctl():
+            self.run([os.path.join(self.layout.bindir, 'traffic_ctl'), 'config', 'reload'])
+        else:
+            self.run([os.path.join(self.layout.bindir, 'traffic_line'), '-x'])
+        # done once ATS logs the reload, or the reconfigure time changes
+        deadline = time.time() + timeout
+        while marker is None or not any(marker.search(line) for line in self.log().lines()):
+            if self._get_metric('proxy.node.config.reconfigure_time') != before:
+                break
+            if time.time() > deadline:
+                raise Exception('Timeout waiting for config reload in {0}'.format(self.layout.prefix))
+            time.sleep(0.05)
+
+        # ATS knows better than our list whether a record requires a restart
+        for name in ('proxy.node.config.restart_required.proxy',
+                     'proxy.node.config.restart_required.manager'):
+            if self._get_metric(name) == '1':
+                log.debug('{0} is set, restarting'.format(name))
+                self.stop()
+                self.start()
+                return 'restart'
+
+        self._loaded_configs = self._read_configs()
+        return 'reload'
+
+
+# how long stop_all() waits for processes to go after SIGKILL
+stop_kill_timeout = 1
+
+
+def stop_all(environments, timeout=2):
+    '''
+    Stop the daemons of many environments at once
+
+    All process groups are sent SIGTERM first, then reaped in parallel, so this
+    takes about as long as the slowest one to exit. Whatever is still around
+    after timeout seconds is sent SIGKILL.
+    '''
+    environments = [env for env in environments if env._pgid is not None]
+    for env in environments:
+        env._kill(signal.SIGTERM)
+
+    reapers = []
+    for env in environments:
+        reaper = threading.Thread(target=env._reap)
+        reaper.daemon = True
+        reaper.start()
+        reapers.append((env, reaper))
+
+    deadline = time.time() + timeout
+    for env, reaper in reapers:
+        reaper.join(max(0, deadline - time.time()))
+
+    # escalate for the ones which didn't exit in time
+    stuck = [(env, reaper) for env, reaper in reapers if reaper.is_alive()]
+    for env, reaper in stuck:
+        log.warning('traffic_cop did not exit within {0}s, killing it: {1}'.format(timeout, env.cop))
+        env._kill()
+    deadline = time.time() + stop_kill_timeout
+    for env, reaper in stuck:
+        reaper.join(max(0, deadline - time.time()))
+
+    for env, reaper in reapers:
+        if reaper.is_alive():
+            log.error('Unable to stop traffic_cop: {0}'.format(env.cop))
+        else:
+            env._pgid = None
+
 
 if __name__ == '__main__':
     SOURCE_DIR = os.getenv('TSQA_SRC_DIR', '~/trafficserver')
@@ -0,0 +1,337 @@
+'''
+Helpers for looking at processes through /proc (linux only)
+'''
+#  Licensed to the Apache Software Foundation (ASF) under one
+#  or more contributor license agreements.  See the NOTICE file
+#  distributed with this work for additional information
+#  regarding copyright ownership.  The ASF licenses this file
+#  to you under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance
+#  with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import array
+import itertools
+import json
+import math
+import os
+import threading
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+PROC = '/proc'
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+# fields of /proc/<pid>/stat (after comm) that we care about, by index
+# (see proc(5), these are field number - 3)
+STAT_FIELDS = {
+    'state': 0,
+    'ppid': 1,
+    'pgrp': 2,
+    'utime': 11,
+    'stime': 12,
+    'num_threads': 17,
+    'starttime': 19,
+}
+
+
+def read_stat(pid):
+    '''
+    Return a dict of the interesting fields of /proc/<pid>/stat, or None if
+    the process is gone
+    '''
+    try:
+        with open(os.path.join(PROC, str(pid), 'stat')) as fh:
+            data = fh.read()
+    except IOError:
+        return None
+    # comm is in parens, and may contain spaces or parens itself
+    comm_start = data.index('(')
+    comm_end = data.rindex(')')
+    fields = data[comm_end + 2:].split()
+    ret = {'pid': pid, 'comm': data[comm_start + 1:comm_end]}
+    for name, index in STAT_FIELDS.iteritems():
+        if name == 'state':
+            ret[name] = fields[index]
+        else:
+            ret[name] = int(fields[index])
+    return ret
+
+
+def pids():
+    '''
+    Return the pids of all running processes
+    '''
+    return [int(name) for name in os.listdir(PROC) if name.isdigit()]
+
+
+def children(pid):
+    '''
+    Return the pids of the children of pid (from /proc/<pid>/task/*/children,
+    which needs linux >= 3.5 built with CONFIG_PROC_CHILDREN), [] if pid is
+    gone or None if that isn't available
+    '''
+    task_dir = os.path.join(PROC, str(pid), 'task')
+    try:
+        tasks = os.listdir(task_dir)
+    except OSError:
+        return []
+    ret = []
+    for task in tasks:
+        try:
+            with open(os.path.join(task_dir, task, 'children')) as fh:
+                ret.extend(int(child) for child in fh.read().split())
+        except IOError:
+            # the task may have exited, or there are no children files at all
+            if not os.path.exists(os.path.join(task_dir, task)):
+                continue
+            return None
+    return ret
+
+
+def group_processes(pgid, leader=None):
+    '''
+    Return a dict of pid -> stat (see read_stat) of the processes in the
+    process group pgid. If its leader (pid) is given, and the kernel has
+    children files (see children), only the leader and its descendants are
+    read, which is much cheaper than scanning all of /proc (orphans which were
+    reparented out of the tree are missed though)
+    '''
+    ret = {}
+    if leader is not None:
+        pending = [leader]
+        while pending:
+            pid = pending.pop()
+            kids = children(pid)
+            if kids is None:
+                return group_processes(pgid)
+            stat = read_stat(pid)
+            if stat is None:
+                continue
+            if stat['pgrp'] == pgid:
+                ret[pid] = stat
+            pending.extend(kids)
+        return ret
+    for pid in pids():
+        stat = read_stat(pid)
+        if stat is not None and stat['pgrp'] == pgid:
+            ret[pid] = stat
+    return ret
+
+
+def read_status(pid):
+    '''
+    Return a dict of the fields of /proc/<pid>/status (values as strings), or
+    None if the process is gone
+    '''
+    ret = {}
+    try:
+        with open(os.path.join(PROC, str(pid), 'status')) as fh:
+            for line in fh:
+                name, _, value = line.partition(':')
+                ret[name] = value.strip()
+    except IOError:
+        return None
+    return ret
+
+
+def read_pss(pid):
+    '''
+    Return the proportional set size (in bytes) of pid, or None if we can't
+    '''
+    # smaps_rollup is much cheaper, but only exists since linux 4.14
+    for name in ('smaps_rollup', 'smaps'):
+        try:
+            total = 0
+            with open(os.path.join(PROC, str(pid), name)) as fh:
+                for line in fh:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1]) * 1024
+            return total
+        except IOError:
+            continue
+    return None
+
+
+def count_fds(pid):
+    '''
+    Return the number of open fds of pid, or None if we can't
+    '''
+    try:
+        return len(os.listdir(os.path.join(PROC, str(pid), 'fd')))
+    except OSError:
+        return None
+
+
+def resource_usage(pid):
+    '''
+    Return a dict of resource usage of pid (see ResourceSampler.metrics), or
+    None if the process is gone
+    '''
+    stat = read_stat(pid)
+    status = read_status(pid)
+    if stat is None or status is None:
+        return None
+    ret = {
+        'comm': stat['comm'],
+        'cpu': float(stat['utime'] + stat['stime']) / CLK_TCK,
+        'threads': stat['num_threads'],
+        'rss': int(status.get('VmRSS', '0 kB').split()[0]) * 1024,
+        'pss': read_pss(pid),
+        'fds': count_fds(pid),
+        'ctx_voluntary': int(status.get('voluntary_ctxt_switches', 0)),
+        'ctx_involuntary': int(status.get('nonvoluntary_ctxt_switches', 0)),
+    }
+    return ret
+
+
+class TimeSeries(object):
+    '''
+    A series of (time, value) samples, stored in arrays of doubles
+    '''
+    def __init__(self):
+        self.times = array.array('d')
+        self.values = array.array('d')
+
+    def append(self, t, value):
+        self.times.append(t)
+        self.values.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def peak(self):
+        return max(self.values) if self.values else None
+
+    def percentile(self, percent):
+        '''
+        Return the (nearest rank) percentile of the values, percent being 0-100
+        '''
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        rank = int(math.ceil(percent / 100.0 * len(values)))
+        return values[min(max(rank - 1, 0), len(values) - 1)]
+
+    def slope(self):
+        '''
+        Return the (least squares) change in value per second, for example the
+        cpu use of a cpu time series, or the rate a memory leak grows at
+        '''
+        count = len(self.values)
+        if count < 2:
+            return None
+        mean_t = sum(self.times) / count
+        mean_v = sum(self.values) / count
+        var_t = sum((t - mean_t) ** 2 for t in self.times)
+        if var_t == 0:
+            return None
+        return sum((t - mean_t) * (v - mean_v) for t, v in itertools.izip(self.times, self.values)) / var_t
+
+    def to_dict(self):
+        return {'times': self.times.tolist(), 'values': self.values.tolist()}
+
+
+class ResourceSampler(object):
+    '''
+    Sample the resource usage of the processes in a process group from a
+    background thread, every interval seconds. Samples of processes with the
+    same name (comm, like traffic_server) are summed and go into one series
+    per metric, so a series continues when a process is restarted.
+    '''
+    metrics = ('rss', 'pss', 'cpu', 'threads', 'fds', 'ctx_voluntary', 'ctx_involuntary')
+
+    def __init__(self, get_pgid, interval=1.0):
+        '''
+        get_pgid is a function which returns the process group to sample (or
+        None if it isn't running), since that changes when the daemons restart
+        '''
+        self.get_pgid = get_pgid
+        self.interval = interval
+        self.start_time = time.time()
+        # (comm, metric) -> TimeSeries
+        self._series = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception:
+                log.exception('Error sampling resources')
+            if self._stopping.wait(self.interval):
+                break
+
+    def sample(self):
+        '''
+        Take one sample of all the processes in the group
+        '''
+        pgid = self.get_pgid()
+        if pgid is None:
+            return
+        now = time.time() - self.start_time
+        totals = {}
+        for pid in group_processes(pgid):
+            usage = resource_usage(pid)
+            if usage is None:
+                continue
+            total = totals.setdefault(usage['comm'], dict((metric, 0) for metric in self.metrics))
+            for metric in self.metrics:
+                if usage[metric] is not None:
+                    total[metric] += usage[metric]
+        with self._lock:
+            for comm, total in totals.iteritems():
+                for metric in self.metrics:
+                    if (comm, metric) not in self._series:
+                        self._series[(comm, metric)] = TimeSeries()
+                    self._series[(comm, metric)].append(now, total[metric])
+
+    def processes(self):
+        '''
+        Return the names of the processes we have samples of
+        '''
+        with self._lock:
+            return sorted(set(comm for comm, _ in self._series))
+
+    def series(self, comm, metric):
+        '''
+        Return the TimeSeries of metric for processes named comm
+        '''
+        with self._lock:
+            return self._series.get((comm, metric), TimeSeries())
+
+    def to_dict(self):
+        ret = {'start': self.start_time, 'interval': self.interval, 'processes': {}}
+        with self._lock:
+            for (comm, metric), series in self._series.iteritems():
+                ret['processes'].setdefault(comm, {})[metric] = series.to_dict()
+        return ret
+
+    def dump(self, path):
+        '''
+        Write all the series out as json
+        '''
+        with open(path, 'w') as fh:
+            json.dump(self.to_dict(), fh)
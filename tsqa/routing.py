@@ -0,0 +1,356 @@
+'''
+Routing of request paths (and methods) to handlers, for tsqa.endpoint
+
+Patterns are one of:
+    - exact: the whole path, looked up in a dict
+    - prefix: anything starting with it, looked up in a trie of the prefixes,
+        so a lookup costs the length of the path however many there are
+    - glob: * matches anything but /, ** anything, ? any one character
+    - regex: must match the whole path
+
+Globs and regexes are compiled into combined regexes (alternations of up to
+~100 groups, the most python's re supports), so a lookup is a handful of
+regex matches rather than one per pattern. Regexes which wouldn't mean the same
+as part of an alternation (named groups, backreferences, inline flags) are
+matched on their own.
+
+Lookups try exact patterns first, then globs/regexes (in the order they were
+added) and then the longest matching prefix.
+'''
+#  Licensed to the Apache Software Foundation (ASF) under one
+#  or more contributor license agreements.  See the NOTICE file
+#  distributed with this work for additional information
+#  regarding copyright ownership.  The ASF licenses this file
+#  to you under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance
+#  with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import re
+import sre_parse
+import threading
+
+# python's re allows at most 100 groups per regex
+MAX_GROUPS = 99
+
+
+class MethodNotAllowed(Exception):
+    '''
+    The path has handlers, but none for the method (allowed is the set of
+    methods which do)
+    '''
+    def __init__(self, allowed):
+        super(MethodNotAllowed, self).__init__('Method not allowed, allowed: {0}'.format(', '.join(sorted(allowed))))
+        self.allowed = allowed
+
+
+def _references(parsed):
+    '''
+    Return whether the parsed regex has backreferences
+    '''
+    for op, av in parsed:
+        if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            return True
+        for arg in (av if isinstance(av, (tuple, list)) else (av,)):
+            if isinstance(arg, sre_parse.SubPattern):
+                if _references(arg):
+                    return True
+            elif isinstance(arg, (tuple, list)):
+                if any(isinstance(sub, sre_parse.SubPattern) and _references(sub) for sub in arg):
+                    return True
+    return False
+
+
+def combinable(regex):
+    '''
+    Return whether regex can be combined with others into one alternation: it
+    mustn't have named groups (which would clash), backreferences (which would
+    be renumbered) or inline flags (which would apply to the whole alternation)
+    '''
+    parsed = sre_parse.parse(regex)
+    flags = parsed.pattern.flags & ~getattr(sre_parse, 'SRE_FLAG_UNICODE', 0)
+    return not (flags or parsed.pattern.groupdict or _references(parsed))
+
+
+def glob_to_regex(glob):
+    '''
+    Return the regex for glob (see the module docstring)
+    '''
+    ret = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith('**', i):
+            ret.append('.*')
+            i += 2
+            continue
+        char = glob[i]
+        if char == '*':
+            ret.append('[^/]*')
+        elif char == '?':
+            ret.append('[^/]')
+        else:
+            ret.append(re.escape(char))
+        i += 1
+    return ''.join(ret)
+
+
+class Route(object):
+    '''
+    The handlers of one pattern, by method (None for any method)
+    '''
+    __slots__ = ('pattern', 'kind', 'handlers', 'regex', 'compiled', 'combinable')
+
+    def __init__(self, pattern, kind):
+        self.pattern = pattern
+        self.kind = kind
+        self.handlers = {}
+        self.regex = None
+        self.compiled = None
+        self.combinable = False
+        if kind == 'glob':
+            self.regex = glob_to_regex(pattern)
+            self.combinable = True
+        elif kind == 'regex':
+            self.regex = pattern
+            self.combinable = combinable(pattern)
+        if self.regex is not None:
+            self.compiled = re.compile('(?:{0})\\Z'.format(self.regex))
+            if self.compiled.groups >= MAX_GROUPS:
+                raise Exception('Too many groups ({0}) in {1}'.format(self.compiled.groups, pattern))
+
+    def handler(self, method):
+        '''
+        Return the handler for method, or None
+        '''
+        func = self.handlers.get(method)
+        if func is None and method == 'HEAD':
+            func = self.handlers.get('GET')
+        if func is None:
+            func = self.handlers.get(None)
+        return func
+
+    def methods(self):
+        return set(method for method in self.handlers if method is not None)
+
+
+def _compile(routes):
+    '''
+    Compile routes (globs/regexes) into a list of (regex, {marker group: route}),
+    each regex matching the first of its routes which matches the whole path.
+    The empty group after each alternative tells which one matched, as it's
+    the last group to close. Routes which aren't combinable get a chunk of
+    their own.
+    '''
+    chunks = []
+    alternatives = []
+    markers = {}
+    groups = 0
+    previous = None
+    for route in routes:
+        route_groups = route.compiled.groups
+        if alternatives and (groups + route_groups + 1 > MAX_GROUPS or
+                             not route.combinable or not previous.combinable):
+            chunks.append((re.compile('|'.join(alternatives)), markers))
+            alternatives = []
+            markers = {}
+            groups = 0
+        alternatives.append('(?:{0})\\Z()'.format(route.regex))
+        groups += route_groups + 1
+        markers[groups] = route
+        previous = route
+    if alternatives:
+        chunks.append((re.compile('|'.join(alternatives)), markers))
+    return chunks
+
+
+class Router(object):
+    '''
+    Thread safe index of handlers by pattern and method
+    '''
+    kinds = ('exact', 'prefix', 'glob', 'regex')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        '''
+        Remove all handlers
+        '''
+        with self._lock:
+            # path -> Route
+            self._exact = {}
+            # trie of dicts of char -> node, with the Route (if any) under None
+            self._prefixes = {}
+            # Routes of the globs and regexes, in the order they were added,
+            # and by (kind, pattern)
+            self._patterns = []
+            self._pattern_index = {}
+            # self._patterns compiled (see _compile), None when that's stale
+            self._chunks = None
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(route.handlers) for route in self._routes())
+
+    def _routes(self):
+        for route in self._exact.itervalues():
+            yield route
+        for route in self._patterns:
+            yield route
+        nodes = [self._prefixes]
+        while nodes:
+            node = nodes.pop()
+            for char, child in node.iteritems():
+                if char is None:
+                    yield child
+                else:
+                    nodes.append(child)
+
+    def _find(self, pattern, kind, create=False):
+        '''
+        Return the Route of pattern (must hold the lock)
+        '''
+        if kind not in self.kinds:
+            raise Exception('Unknown kind of pattern {0}, must be one of {1}'.format(kind, self.kinds))
+        if kind == 'exact':
+            route = self._exact.get(pattern)
+            if route is None and create:
+                route = self._exact[pattern] = Route(pattern, kind)
+            return route
+        if kind == 'prefix':
+            node = self._prefixes
+            for char in pattern:
+                if char not in node:
+                    if not create:
+                        return None
+                    node[char] = {}
+                node = node[char]
+            if None not in node and create:
+                node[None] = Route(pattern, kind)
+            return node.get(None)
+        route = self._pattern_index.get((kind, pattern))
+        if route is None and create:
+            route = self._pattern_index[(kind, pattern)] = Route(pattern, kind)
+            self._patterns.append(route)
+            self._chunks = None
+        return route
+
+    def add(self, pattern, func, methods=None, kind='exact'):
+        '''
+        Route requests for pattern (with one of methods, or any if None) to func
+        '''
+        methods = [None] if methods is None else [method.upper() for method in methods]
+        with self._lock:
+            route = self._find(pattern, kind, create=True)
+            for method in methods:
+                if method in route.handlers:
+                    raise Exception('There is already a {0} handler for {1} {2}'.format(kind, method or '*', pattern))
+            for method in methods:
+                route.handlers[method] = func
+
+    def remove(self, pattern, methods=None, kind='exact'):
+        '''
+        Remove the handlers of pattern (for methods, or all of them if None)
+        '''
+        with self._lock:
+            route = self._find(pattern, kind)
+            if route is None:
+                raise Exception('No {0} handler for {1}'.format(kind, pattern))
+            if methods is None:
+                route.handlers.clear()
+            else:
+                for method in methods:
+                    if method.upper() not in route.handlers:
+                        raise Exception('No {0} handler for {1} {2}'.format(kind, method, pattern))
+                    del route.handlers[method.upper()]
+            if not route.handlers:
+                self._forget(route)
+
+    def _forget(self, route):
+        if route.kind == 'exact':
+            del self._exact[route.pattern]
+        elif route.kind == 'prefix':
+            # remove the route, and any nodes left empty
+            path = [self._prefixes]
+            for char in route.pattern:
+                path.append(path[-1][char])
+            del path[-1][None]
+            for i in reversed(xrange(len(route.pattern))):
+                if path[i + 1]:
+                    break
+                del path[i][route.pattern[i]]
+        else:
+            del self._pattern_index[(route.kind, route.pattern)]
+            self._patterns.remove(route)
+            self._chunks = None
+
+    def lookup(self, path, method):
+        '''
+        Return (func, match) of the handler for method on path, match being the
+        regex match object for globs/regexes (otherwise None). Returns None if
+        nothing matches path, raises MethodNotAllowed if the matches don't
+        handle method
+        '''
+        method = method.upper()
+        allowed = set()
+        with self._lock:
+            route = self._exact.get(path)
+            if route is not None:
+                func = route.handler(method)
+                if func is not None:
+                    return func, None
+                allowed |= route.methods()
+
+            if self._chunks is None:
+                self._chunks = _compile(self._patterns)
+            for regex, markers in self._chunks:
+                match = regex.match(path)
+                if match is None:
+                    continue
+                route = markers[match.lastindex]
+                func = route.handler(method)
+                if func is not None:
+                    return func, route.compiled.match(path)
+                # the uncommon case, when the route which matched doesn't
+                # handle the method: check the rest of the chunk one by one
+                allowed |= route.methods()
+                for marker in sorted(markers):
+                    if marker <= match.lastindex:
+                        continue
+                    route = markers[marker]
+                    route_match = route.compiled.match(path)
+                    if route_match is None:
+                        continue
+                    func = route.handler(method)
+                    if func is not None:
+                        return func, route_match
+                    allowed |= route.methods()
+
+            # the prefixes of path, to try the longest first
+            candidates = []
+            node = self._prefixes
+            if None in node:
+                candidates.append(node[None])
+            for char in path:
+                node = node.get(char)
+                if node is None:
+                    break
+                if None in node:
+                    candidates.append(node[None])
+            for route in reversed(candidates):
+                func = route.handler(method)
+                if func is not None:
+                    return func, None
+                allowed |= route.methods()
+
+        if allowed:
+            raise MethodNotAllowed(allowed)
+        return None
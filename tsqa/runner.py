@@ -0,0 +1,350 @@
+'''
+Run test cases across a pool of worker processes
+'''
+#  Licensed to the Apache Software Foundation (ASF) under one
+#  or more contributor license agreements.  See the NOTICE file
+#  distributed with this work for additional information
+#  regarding copyright ownership.  The ASF licenses this file
+#  to you under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance
+#  with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import atexit
+import json
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import re
+import sys
+import time
+import traceback
+import xml.etree.ElementTree as ET
+
+import tsqa.utils
+unittest = tsqa.utils.import_unittest()
+
+log = logging.getLogger(__name__)
+
+# memory to budget for each worker (and the environments it runs)
+DEFAULT_WORKER_MEMORY = 1024 * 1024 * 1024
+
+
+def iter_test_cases(suite):
+    '''
+    Yield all the test cases in a (nested) suite
+    '''
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for sub_test in iter_test_cases(test):
+                yield sub_test
+        else:
+            yield test
+
+
+def discover(paths, pattern='*test*.py'):
+    '''
+    Find test classes in paths (directories, or dotted module/class names).
+
+    Returns a list of groups, each a list of "module.Class" names. Classes with
+    the same environmentKey() (for EnvironmentFactoryCase the configure/env it
+    builds) are grouped together so they run in the same worker and share the
+    build (unless run() has to split them up to use all of its workers),
+    everything else gets a group to itself.
+    '''
+    loader = unittest.TestLoader()
+    classes = []
+    for path in paths:
+        if os.path.isdir(path):
+            suite = loader.discover(path, pattern=pattern)
+        else:
+            suite = loader.loadTestsFromName(path)
+        for test in iter_test_cases(suite):
+            # modules which fail to import show up as a fake test named after
+            # the module, load that in the worker so the error gets reported
+            if type(test).__name__ == 'ModuleImportFailure':
+                classes.append((None, test._testMethodName))
+            elif type(test) not in [cls for cls, _ in classes]:
+                classes.append((type(test), '{0}.{1}'.format(type(test).__module__, type(test).__name__)))
+
+    groups = []
+    group_keys = {}
+    for cls, name in classes:
+        key = None
+        if cls is not None and hasattr(cls, 'environmentKey'):
+            key = cls.environmentKey()
+        if key is None:
+            groups.append([name])
+            continue
+        if key not in group_keys:
+            group_keys[key] = len(groups)
+            groups.append([])
+        groups[group_keys[key]].append(name)
+    return groups
+
+
+def split_groups(groups, workers):
+    '''
+    Split the largest groups in half until there are enough to keep workers
+    workers busy (or every group is a single class). Builds are single flight
+    across processes, so classes sharing an environmentKey can run in different
+    workers; they just don't share environments between classes then
+    '''
+    groups = [list(names) for names in groups]
+    while len(groups) < workers:
+        largest = max(groups, key=len) if groups else []
+        if len(largest) < 2:
+            break
+        i = groups.index(largest)
+        half = len(largest) // 2
+        groups[i:i + 1] = [largest[:half], largest[half:]]
+    return groups
+
+
+def _meminfo(field):
+    '''
+    Return a field (in bytes) from /proc/meminfo, or None if we can't
+    '''
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                name, value = line.split(':', 1)
+                if name == field:
+                    return int(value.split()[0]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def default_workers(worker_memory=None):
+    '''
+    Number of workers this machine can run at once: one per cpu, as long as
+    there is worker_memory (TSQA_WORKER_MEMORY) available for each
+    '''
+    if worker_memory is None:
+        worker_memory = int(os.environ.get('TSQA_WORKER_MEMORY', DEFAULT_WORKER_MEMORY))
+    workers = multiprocessing.cpu_count()
+    available = _meminfo('MemAvailable')
+    if available is not None and worker_memory > 0:
+        workers = min(workers, available // worker_memory)
+    return max(1, workers)
+
+
+class RecordingResult(unittest.TestResult):
+    '''
+    TestResult which keeps a (picklable) record of every test that ran
+    '''
+    def __init__(self, *args, **kwargs):
+        super(RecordingResult, self).__init__(*args, **kwargs)
+        self.records = []
+        self._start_time = None
+
+    def startTest(self, test):
+        super(RecordingResult, self).startTest(test)
+        self._start_time = time.time()
+
+    def _record(self, test, status, message=None):
+        # class/module fixture errors don't go through startTest
+        if self._start_time is None:
+            duration = 0
+        else:
+            duration = time.time() - self._start_time
+            self._start_time = None
+        self.records.append({'id': test.id(),
+                             'status': status,
+                             'time': duration,
+                             'message': message,
+                             'pid': os.getpid(),
+                             })
+
+    def _exc_info_to_string(self, err, test):
+        return ''.join(traceback.format_exception(*err))
+
+    def addSuccess(self, test):
+        super(RecordingResult, self).addSuccess(test)
+        self._record(test, 'success')
+
+    def addError(self, test, err):
+        super(RecordingResult, self).addError(test, err)
+        self._record(test, 'error', self._exc_info_to_string(err, test))
+
+    def addFailure(self, test, err):
+        super(RecordingResult, self).addFailure(test, err)
+        self._record(test, 'failure', self._exc_info_to_string(err, test))
+
+    def addSkip(self, test, reason):
+        super(RecordingResult, self).addSkip(test, reason)
+        self._record(test, 'skipped', reason)
+
+    def addExpectedFailure(self, test, err):
+        super(RecordingResult, self).addExpectedFailure(test, err)
+        self._record(test, 'success')
+
+    def addUnexpectedSuccess(self, test):
+        super(RecordingResult, self).addUnexpectedSuccess(test)
+        self._record(test, 'failure', 'unexpected success')
+
+
+def _init_worker():
+    # pool workers leave with os._exit(), which skips atexit-- and that is
+    # where shared environments and environment pools are torn down
+    multiprocessing.util.Finalize(None, atexit._run_exitfuncs, exitpriority=0)
+
+
+def run_group(names):
+    '''
+    Run a group of test classes (by name) in this process, returning the records
+    '''
+    result = RecordingResult()
+    try:
+        suite = unittest.TestLoader().loadTestsFromNames(names)
+        suite.run(result)
+    except Exception:
+        result.records.append({'id': ','.join(names),
+                               'status': 'error',
+                               'time': 0,
+                               'message': traceback.format_exc(),
+                               'pid': os.getpid(),
+                               })
+    return result.records
+
+
+def run(groups, workers=None, split=True):
+    '''
+    Run groups (as returned by discover()) across a pool of workers, and return
+    the records of all the tests that ran (in group order). With split, groups
+    are split up if there are fewer of them than workers (see split_groups)
+    '''
+    if workers is None:
+        workers = default_workers()
+    if split:
+        groups = split_groups(groups, workers)
+    workers = max(1, min(workers, len(groups)))
+    log.info('Running {0} groups with {1} workers'.format(len(groups), workers))
+
+    # each worker runs one group, so every group gets fresh environments
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, maxtasksperchild=1)
+    try:
+        results = [pool.apply_async(run_group, (names,)) for names in groups]
+        records = []
+        for result in results:
+            records.extend(result.get())
+    finally:
+        pool.close()
+        pool.join()
+    return records
+
+
+def summarize(records):
+    '''
+    Return a dict of status -> count (and the total in "tests")
+    '''
+    ret = {'tests': len(records), 'success': 0, 'failure': 0, 'error': 0, 'skipped': 0}
+    for record in records:
+        ret[record['status']] += 1
+    return ret
+
+
+def _split_id(test_id):
+    # class/module fixture errors look like "setUpClass (module.Class)"
+    match = re.match(r'^(\w+) \((.*)\)$', test_id)
+    if match:
+        return match.group(2), match.group(1)
+    if '.' not in test_id:
+        return test_id, test_id
+    return test_id.rsplit('.', 1)
+
+
+def write_junit(records, path):
+    '''
+    Write records out as a JUnit xml report
+    '''
+    suites = {}
+    order = []
+    for record in records:
+        classname, name = _split_id(record['id'])
+        if classname not in suites:
+            suites[classname] = []
+            order.append(classname)
+        suites[classname].append((name, record))
+
+    root = ET.Element('testsuites')
+    for classname in order:
+        cases = suites[classname]
+        counts = summarize([record for _, record in cases])
+        suite = ET.SubElement(root, 'testsuite', {
+            'name': classname,
+            'tests': str(counts['tests']),
+            'failures': str(counts['failure']),
+            'errors': str(counts['error']),
+            'skipped': str(counts['skipped']),
+            'time': '{0:.3f}'.format(sum(record['time'] for _, record in cases)),
+        })
+        for name, record in cases:
+            case = ET.SubElement(suite, 'testcase', {
+                'classname': classname,
+                'name': name,
+                'time': '{0:.3f}'.format(record['time']),
+            })
+            if record['status'] == 'success':
+                continue
+            message = record['message'] or ''
+            child = ET.SubElement(case, record['status'], {'message': message.strip().split('\n')[-1]})
+            child.text = message
+    ET.ElementTree(root).write(path, encoding='utf-8', xml_declaration=True)
+
+
+def write_json(records, path):
+    '''
+    Write records (and a summary) out as json
+    '''
+    with open(path, 'w') as fh:
+        json.dump({'summary': summarize(records), 'tests': records}, fh, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run tsqa test cases in parallel')
+    parser.add_argument('paths', nargs='*', default=['.'],
+                        help='directories to discover tests in, or dotted names of modules/classes')
+    parser.add_argument('-p', '--pattern', default='*test*.py',
+                        help='pattern of test files to discover (default: %(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: based on cpus and memory)')
+    parser.add_argument('--no-split', dest='split', action='store_false',
+                        help="always run classes with the same environment key in one worker, even if "
+                             "that leaves workers idle")
+    parser.add_argument('--junit-xml', help='write a JUnit xml report to this path')
+    parser.add_argument('--json', help='write a json report to this path')
+    args = parser.parse_args(argv)
+
+    # discovery (like unittest) imports relative to the cwd
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+
+    groups = discover(args.paths, pattern=args.pattern)
+    records = run(groups, workers=args.workers, split=args.split)
+
+    if args.junit_xml:
+        write_junit(records, args.junit_xml)
+    if args.json:
+        write_json(records, args.json)
+
+    for record in records:
+        if record['status'] in ('failure', 'error'):
+            print '{0}: {1}\n{2}'.format(record['status'].upper(), record['id'], record['message'])
+    summary = summarize(records)
+    print 'Ran {tests} tests: {success} passed, {failure} failed, {error} errors, {skipped} skipped'.format(**summary)
+    return 0 if summary['failure'] == summary['error'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+'''
+A synthetic origin for large objects, as a DynamicHTTPEndpoint handler
+
+Bodies are generated lazily (64K at a time) from (path, size, seed), so any
+size of object can be served (and checked, see SyntheticBody.read) without
+having it in memory. Each block starts with its index, so data from the wrong
+offset doesn't look right. Bodies can also come from the files of a corpus
+directory.
+
+    http_endpoint.add_handler('/objects/', tsqa.synthetic.SyntheticOrigin(), match='prefix')
+
+Then GET /objects/foo?size=2G returns 2GB. The query string can override
+any of the SyntheticOrigin settings for a request:
+    size: object size (like 100, 64K or 2G)
+    seed: changes the content of the object
+    chunked: 1 to send the body chunked instead of with a Content-Length
+    rate: bytes/second to throttle the body to (like 1M)
+Ranges (a single one) are supported, and file bodies are sent with
+sendfile() by the thread and event servers (see tsqa.wsgi).
+
+Throttling sleeps between blocks, which the event server can't do without
+stalling every other connection, so throttled requests to a server which
+isn't multithreaded (wsgi.multithread) get a 400: use the thread server for
+them.
+'''
+#  Licensed to the Apache Software Foundation (ASF) under one
+#  or more contributor license agreements.  See the NOTICE file
+#  distributed with this work for additional information
+#  regarding copyright ownership.  The ASF licenses this file
+#  to you under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance
+#  with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import binascii
+import hashlib
+import mmap
+import os
+import random
+import time
+
+import flask
+
+import tsqa.utils
+import tsqa.wsgi
+
+BLOCK_SIZE = 64 * 1024
+# bytes at the start of each block with its index
+BLOCK_HEADER = 16
+
+
+class SyntheticBody(object):
+    '''
+    The (deterministic) body of size bytes for path and seed
+    '''
+    block_size = BLOCK_SIZE
+
+    def __init__(self, path, size, seed=0):
+        self.path = path
+        self.size = size
+        self.seed = seed
+        self._digest = hashlib.sha1('{0}\0{1}'.format(seed, path)).hexdigest()
+        self._base = None
+
+    @property
+    def etag(self):
+        return '"{0}-{1:x}"'.format(self._digest[:16], self.size)
+
+    def _block(self, index):
+        if self._base is None:
+            bits = random.Random(self._digest).getrandbits(self.block_size * 8)
+            self._base = binascii.unhexlify('{0:0{1}x}'.format(bits, self.block_size * 2))
+        return '{0:0{1}x}'.format(index, BLOCK_HEADER)[-BLOCK_HEADER:] + self._base[BLOCK_HEADER:]
+
+    def iter_range(self, start=0, end=None):
+        '''
+        Iterate over the body from start up to (not including) end, a block at
+        a time
+        '''
+        end = self.size if end is None else min(end, self.size)
+        while start < end:
+            index, offset = divmod(start, self.block_size)
+            data = self._block(index)[offset:offset + end - start]
+            start += len(data)
+            yield data
+
+    def read(self, start=0, end=None):
+        '''
+        Return the body from start up to end (for checking a response)
+        '''
+        return ''.join(self.iter_range(start, end))
+
+
+class CorpusBody(object):
+    '''
+    The body of a file in a corpus, read through mmap (or sent with sendfile)
+    '''
+    block_size = BLOCK_SIZE
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'rb')
+        stat = os.fstat(self.fh.fileno())
+        self.size = stat.st_size
+        self.etag = '"{0:x}-{1:x}-{2:x}"'.format(stat.st_ino, self.size, int(stat.st_mtime))
+        # (you can't mmap an empty file)
+        self._map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def iter_range(self, start=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        try:
+            while start < end:
+                data = self._map[start:min(start + self.block_size, end)]
+                start += len(data)
+                yield data
+        finally:
+            self.close()
+
+    def file_wrapper(self, start=0, end=None):
+        '''
+        Return a tsqa.wsgi.FileWrapper for the range (which servers sendfile())
+        '''
+        end = self.size if end is None else min(end, self.size)
+        return tsqa.wsgi.FileWrapper(self, self.block_size, offset=start, length=end - start)
+
+    # file-like, for FileWrapper
+    def fileno(self):
+        return self.fh.fileno()
+
+    def seek(self, offset):
+        self.fh.seek(offset)
+
+    def read(self, size):
+        return self.fh.read(size)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.fh.close()
+
+
+def parse_range(header, size):
+    '''
+    Return the (start, end) (end exclusive) of the Range header, or None if
+    there isn't one we support (a single range of bytes). Raises ValueError if
+    it can't be satisfied
+    '''
+    if not header:
+        return None
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = [part.strip() for part in ranges.partition('-')]
+    if not sep:
+        return None
+    if not first:
+        # the last bytes
+        if not last.isdigit():
+            return None
+        if int(last) == 0 or size == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - int(last), 0), size
+    if not first.isdigit() or (last and not last.isdigit()):
+        return None
+    start = int(first)
+    end = int(last) + 1 if last else size
+    if end <= start and last:
+        return None
+    if start >= size:
+        raise ValueError('Range starts past the end')
+    return start, min(end, size)
+
+
+def throttle(chunks, rate):
+    '''
+    Iterate over chunks, at (at most) rate bytes/second. Chunks are split
+    into pieces of ~1/10s worth, so slow rates still trickle out smoothly
+    '''
+    piece = max(rate // 10, 1)
+    start = time.time()
+    sent = 0
+    for chunk in chunks:
+        for offset in xrange(0, len(chunk), piece):
+            delay = start + float(sent) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            data = chunk[offset:offset + piece]
+            sent += len(data)
+            yield data
+
+
+class SyntheticOrigin(object):
+    '''
+    A handler (see DynamicHTTPEndpoint.add_handler) serving synthetic objects,
+    or the files in corpus if it's set (paths relative to strip_prefix). The
+    settings are defaults, which the query string can override (see the module
+    docstring). headers are added to every response, like a Cache-Control to
+    make the proxy cache the objects.
+    '''
+    def __init__(self, size=1024 * 1024, seed=0, chunked=False, rate=None, corpus=None, strip_prefix='/',
+                 headers=None):
+        self.size = size
+        self.seed = seed
+        self.chunked = chunked
+        self.rate = rate
+        self.corpus = os.path.realpath(corpus) if corpus is not None else None
+        self.strip_prefix = strip_prefix
+        self.headers = headers or {}
+
+    def settings(self, request):
+        '''
+        Return (size, seed, chunked, rate) for request
+        '''
+        args = request.args
+        size = tsqa.utils.parse_size(args.get('size', self.size))
+        seed = args.get('seed', self.seed)
+        chunked = args.get('chunked', '1' if self.chunked else '0') not in ('0', '', 'false')
+        rate = args.get('rate', self.rate)
+        if rate is not None:
+            rate = tsqa.utils.parse_size(rate)
+        return size, seed, chunked, rate
+
+    def body(self, request, size, seed):
+        '''
+        Return the body for request, or None if there isn't one
+        '''
+        if self.corpus is None:
+            return SyntheticBody(request.path, size, seed)
+        path = request.path
+        if path.startswith(self.strip_prefix):
+            path = path[len(self.strip_prefix):]
+        path = os.path.realpath(os.path.join(self.corpus, path.lstrip('/')))
+        if not path.startswith(self.corpus + os.sep) or not os.path.isfile(path):
+            return None
+        return CorpusBody(path)
+
+    def __call__(self, request):
+        try:
+            size, seed, chunked, rate = self.settings(request)
+        except ValueError as e:
+            return flask.Response('Bad setting: {0}\n'.format(e), 400)
+        if rate is not None and not request.environ.get('wsgi.multithread', True):
+            return flask.Response('rate is not supported by this server, throttling would stall '
+                                  'every other connection (use a multithreaded one)\n', 400)
+        body = self.body(request, size, seed)
+        if body is None:
+            return flask.Response('', 404)
+
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Accept-Ranges': 'bytes',
+            'ETag': body.etag,
+        }
+        headers.update(self.headers)
+        status = 200
+        start, end = 0, body.size
+        if_range = request.headers.get('If-Range')
+        if if_range is None or if_range == body.etag:
+            try:
+                byte_range = parse_range(request.headers.get('Range'), body.size)
+            except ValueError:
+                if isinstance(body, CorpusBody):
+                    body.close()
+                headers['Content-Range'] = 'bytes */{0}'.format(body.size)
+                return flask.Response('', 416, headers)
+            if byte_range is not None:
+                status = 206
+                start, end = byte_range
+                headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end - 1, body.size)
+        if not chunked:
+            headers['Content-Length'] = str(end - start)
+
+        environ = request.environ
+        if request.method == 'HEAD':
+            if isinstance(body, CorpusBody):
+                body.close()
+            data = []
+        elif (isinstance(body, CorpusBody) and rate is None and
+                environ.get('wsgi.file_wrapper') is tsqa.wsgi.FileWrapper):
+            data = body.file_wrapper(start, end)
+        else:
+            data = body.iter_range(start, end)
+            if rate is not None:
+                data = throttle(data, rate)
+        # direct_passthrough, so flask doesn't touch the (maybe huge) body
+        return flask.Response(data, status, headers, direct_passthrough=True)
@@ -17,6 +17,8 @@ Some base test cases that do environment handling for you
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import atexit
+import json
 import logging
 import os
 import warnings
@@ -39,7 +41,27 @@ class BaseEnvironmentCase(unittest.TestCase):
         - setup the environment (setUpEnv())
         - write out the configs
         - start the environment (environment.start())
+
+    If share_environment is set, classes with the same environmentKey() reuse
+    one running environment: its configs are put back to how getEnv() returned
+    them, and after setUpEnv() the changes are applied with a config reload
+    (or a restart, if they require one) instead of a fresh start.
+
+    If reuse_environment is set, the environment of a successful class is
+    stopped and reset() instead of destroyed, and the next class with the same
+    environmentKey() starts it again instead of getting a new one.
     '''
+    share_environment = False
+    reuse_environment = False
+    # size of the cache the tests need (see Environment.setup_cache_storage),
+    # None keeps the storage.config of the environment
+    cache_storage_size = None
+
+    # environmentKey() -> environment, shared between classes
+    shared_environments = {}
+    # environmentKey() -> list of stopped environments, ready to be reused
+    idle_environments = {}
+
     def run(self, result=None):
         unittest.TestCase.run(self, result)
         # we want to keep track of failures at a class level-- not instance level
@@ -54,7 +76,22 @@ class BaseEnvironmentCase(unittest.TestCase):
         cls.log = logging.getLogger(__name__)
 
         # get an environment
-        cls.environment = cls.getEnv()
+        shared_key = cls.environmentKey() if cls.share_environment else None
+        shared = BaseEnvironmentCase.shared_environments.get(shared_key)
+        idle = BaseEnvironmentCase.idle_environments.get(cls.environmentKey() if cls.reuse_environment else None)
+        if shared is not None and shared.running():
+            cls.environment = shared
+            cls.environment.reset_configs()
+        elif idle:
+            shared = None
+            cls.environment = idle.pop()
+        else:
+            shared = None
+            cls.environment = cls.getEnv()
+            if cls.cache_storage_size is not None:
+                cls.environment.setup_cache_storage(cls.cache_storage_size)
+            if shared_key is not None or cls.reuse_environment:
+                cls.environment.snapshot()
         cls.verifyEnv()
         # TODO: better... I dont think this output is captured in each test run
         logging.info('Environment prefix is {0}'.format(cls.environment.layout.prefix))
@@ -77,8 +114,13 @@ class BaseEnvironmentCase(unittest.TestCase):
         for cfg in cls.configs.itervalues():
             cfg.write()
 
-        # start ATS
-        cls.environment.start()
+        # start ATS (or apply our configs to the shared one)
+        if shared is not None:
+            cls.environment.reconfigure()
+        else:
+            cls.environment.start()
+            if shared_key is not None:
+                BaseEnvironmentCase.shared_environments[shared_key] = cls.environment
 
         # we assume the tests passed
         cls.__successful = True
@@ -87,6 +129,14 @@ class BaseEnvironmentCase(unittest.TestCase):
     def verifyEnv(cls):
         pass
 
+    @classmethod
+    def environmentKey(cls):
+        '''
+        Return a key identifying the environment getEnv() returns, classes with
+        the same key can share (or reuse) an environment. None means never share.
+        '''
+        return None
+
     @classmethod
     def getEnv(cls):
         raise NotImplementedError()
@@ -101,16 +151,47 @@ class BaseEnvironmentCase(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        shared = cls.environment in BaseEnvironmentCase.shared_environments.values()
         if not cls.environment.running():
             raise Exception('ATS died during the test run')
+
+        # keep a shared environment running for the next class, unless we failed
+        # (in which case it is left behind for debugging)
+        if shared and cls.__successful:
+            super(BaseEnvironmentCase, cls).tearDownClass()
+            return
+        if shared:
+            for key, env in BaseEnvironmentCase.shared_environments.items():
+                if env is cls.environment:
+                    del BaseEnvironmentCase.shared_environments[key]
+
         # stop ATS
         cls.environment.stop()
 
         # call parent destructor
         super(BaseEnvironmentCase, cls).tearDownClass()
-        # if the test was successful, tear down the env
+        # if the test was successful, tear down (or reset, for reuse) the env
         if cls.__successful:
-            cls.environment.destroy()  # this will tear down any processes that we started
+            key = cls.environmentKey() if cls.reuse_environment else None
+            if key is not None and cls.environment._snapshot is not None:
+                cls.environment.reset()
+                BaseEnvironmentCase.idle_environments.setdefault(key, []).append(cls.environment)
+            else:
+                cls.environment.destroy()  # this will tear down any processes that we started
+
+    @staticmethod
+    def destroySharedEnvironments():
+        '''
+        Stop and destroy all shared (and idle) environments (this is done at exit)
+        '''
+        environments = BaseEnvironmentCase.shared_environments.values()
+        for idle in BaseEnvironmentCase.idle_environments.itervalues():
+            environments.extend(idle)
+        BaseEnvironmentCase.shared_environments.clear()
+        BaseEnvironmentCase.idle_environments.clear()
+        tsqa.environment.stop_all(environments)
+        for env in environments:
+            env.destroy()
 
     # Some helpful properties
     @property
@@ -122,6 +203,9 @@ class BaseEnvironmentCase(unittest.TestCase):
         return {'http': 'http://127.0.0.1:{0}'.format(self.configs['records.config']['CONFIG']['proxy.config.http.server_ports'])}
 
 
+atexit.register(BaseEnvironmentCase.destroySharedEnvironments)
+
+
 class EnvironmentFactoryCase(BaseEnvironmentCase):
     '''TestCase that can build its own trafficserver using EnvironmentFactory
     '''
@@ -129,6 +213,11 @@ class EnvironmentFactoryCase(BaseEnvironmentCase):
     environment_factory = {'configure': None,
                            'env': None,
                            }
+
+    @classmethod
+    def environmentKey(cls):
+        return (cls.getEnv.im_func, json.dumps(cls.environment_factory, sort_keys=True))
+
     @classmethod
     def getEnv(cls):
         '''
@@ -159,6 +248,13 @@ class CloneEnvironmentCase(BaseEnvironmentCase):
                 # TODO: better error
                 raise unittest.SkipTest(e)
 
+    # layout prefix -> EnvironmentPool (if TSQA_ENV_POOL_SIZE is set)
+    environment_pools = {}
+
+    @classmethod
+    def environmentKey(cls):
+        return (cls.getEnv.im_func, os.getenv('TSQA_ATS_ROOT'))
+
     @classmethod
     def getEnv(cls):
         '''Clone an existing environment at `TSQA_ATS_ROOT`
@@ -169,10 +265,18 @@ class CloneEnvironmentCase(BaseEnvironmentCase):
             os.path.expanduser(os.getenv('TSQA_ATS_ROOT'))
         )
 
-        # return an environment cloned from that layout
-        ret = tsqa.environment.Environment()
-        ret.clone(layout=layout)
-        return ret
+        def create():
+            # return an environment cloned from that layout
+            ret = tsqa.environment.Environment()
+            ret.clone(layout=layout)
+            return ret
+
+        pool_size = int(os.environ.get('TSQA_ENV_POOL_SIZE', 0))
+        if not pool_size:
+            return create()
+        if layout.prefix not in cls.environment_pools:
+            cls.environment_pools[layout.prefix] = tsqa.environment.EnvironmentPool(create, pool_size)
+        return cls.environment_pools[layout.prefix].get()
 
 
 class DynamicHTTPEndpointCase(unittest.TestCase):
@@ -180,12 +284,19 @@ class DynamicHTTPEndpointCase(unittest.TestCase):
     This class will set up a dynamic http endpoint that is local to this class
     '''
     endpoint_port = 0
+    # server backend (see tsqa.wsgi), None for TSQA_HTTP_BACKEND or wsgiref
+    endpoint_backend = None
+    # other kwargs for the server, such as idle_timeout or max_requests
+    endpoint_server_kwargs = {}
+
     @classmethod
     def setUpClass(cls):
         # get a logger
         cls.log = logging.getLogger(__name__)
 
-        cls.http_endpoint = tsqa.endpoint.DynamicHTTPEndpoint(port=cls.endpoint_port)
+        cls.http_endpoint = tsqa.endpoint.DynamicHTTPEndpoint(port=cls.endpoint_port,
+                                                              backend=cls.endpoint_backend,
+                                                              **cls.endpoint_server_kwargs)
         cls.http_endpoint.start()
 
         cls.http_endpoint.ready.wait()
@@ -0,0 +1,230 @@
+'''
+Compact, bounded storage of the requests/responses the endpoints track
+
+The endpoints used to keep the live flask request and response objects (and
+everything they reference) forever, keyed on the size of a dict (which
+different threads could hand out twice). Instead we keep small immutable
+snapshots in a TrackingStore, which hands out unique keys and only holds on
+to the most recent capacity entries.
+'''
+#  Licensed to the Apache Software Foundation (ASF) under one
+#  or more contributor license agreements.  See the NOTICE file
+#  distributed with this work for additional information
+#  regarding copyright ownership.  The ASF licenses this file
+#  to you under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance
+#  with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import hashlib
+import itertools
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_CAPACITY = 10000
+
+
+def digest(body):
+    '''
+    Return the digest we keep of a body (None if we didn't see it)
+    '''
+    if body is None:
+        return None
+    return hashlib.sha1(body).hexdigest()
+
+
+class Headers(tuple):
+    '''
+    An immutable tuple of (name, value) pairs, which can also be looked up by
+    (case insensitive) name like a dict
+    '''
+    __slots__ = ()
+
+    def __new__(cls, headers=()):
+        if hasattr(headers, 'items'):
+            headers = headers.items()
+        return tuple.__new__(cls, ((str(name), str(value)) for name, value in headers))
+
+    def get(self, name, default=None):
+        '''
+        Return the value of header name (all values joined by ","), or default
+        '''
+        name = name.lower()
+        values = [value for key, value in self if key.lower() == name]
+        if not values:
+            return default
+        return ', '.join(values)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            value = self.get(key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        if isinstance(key, basestring):
+            return self.get(key) is not None
+        return tuple.__contains__(self, key)
+
+
+class _Record(object):
+    '''
+    Base of the immutable records, fields are set from kwargs (or None)
+    '''
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError('Unknown fields: {0}'.format(', '.join(sorted(kwargs))))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{0} is immutable'.format(type(self).__name__))
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__,
+                                 ', '.join('{0}={1!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class RequestRecord(_Record):
+    '''
+    What the origin saw of a request. time is when it started (time.time())
+    '''
+    __slots__ = ('method', 'path', 'query', 'headers', 'body_length', 'body_digest', 'time')
+
+
+class ResponseRecord(_Record):
+    '''
+    What the origin responded. elapsed is seconds since the request started.
+    The body is only digested if it isn't streamed (otherwise body_length and
+    body_digest are None)
+    '''
+    __slots__ = ('status_code', 'headers', 'body_length', 'body_digest', 'elapsed')
+
+
+class Tracked(object):
+    '''
+    The request and response tracked under one key (either may still be None)
+    '''
+    __slots__ = ('key', 'request', 'response')
+
+    def __init__(self, key):
+        self.key = key
+        self.request = None
+        self.response = None
+
+    def __getitem__(self, name):
+        # so tracking data can still be used like the dicts it used to be
+        if name not in ('request', 'response'):
+            raise KeyError(name)
+        return getattr(self, name)
+
+
+class TrackingStore(object):
+    '''
+    Thread safe store of Tracked entries by key, holding at most capacity of
+    them. With the "ring" policy the oldest entries are dropped first, with
+    "lru" the least recently used (read or written) ones.
+    '''
+    policies = ('ring', 'lru')
+
+    def __init__(self, capacity=None, policy='ring'):
+        if capacity is None:
+            capacity = int(os.environ.get('TSQA_TRACKING_CAPACITY', DEFAULT_CAPACITY))
+        if capacity < 1:
+            raise Exception('Tracking capacity must be positive, not {0}'.format(capacity))
+        if policy not in self.policies:
+            raise Exception('Unknown tracking policy {0}, must be one of {1}'.format(policy, self.policies))
+        self.capacity = capacity
+        self.policy = policy
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._keys = itertools.count()
+        # number of entries dropped to stay under capacity
+        self.evicted = 0
+
+    def new_key(self):
+        '''
+        Return a new (never handed out before) key, and reserve an entry for it
+        '''
+        with self._lock:
+            key = str(next(self._keys))
+            self._entry(key)
+            return key
+
+    def _entry(self, key):
+        '''
+        Return the entry for key (creating it), must hold the lock
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = Tracked(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        elif self.policy == 'lru':
+            self._touch(key)
+        return entry
+
+    def _touch(self, key):
+        self._entries[key] = self._entries.pop(key)
+
+    def add_request(self, key, record):
+        with self._lock:
+            self._entry(key).request = record
+
+    def add_response(self, key, record):
+        with self._lock:
+            self._entry(key).response = record
+
+    def get(self, key):
+        '''
+        Return the Tracked entry for key
+        '''
+        with self._lock:
+            if key not in self._entries:
+                raise Exception('Nothing tracked with key {0!r} (capacity {1}, {2} evicted)'.format(
+                    key, self.capacity, self.evicted))
+            if self.policy == 'lru':
+                self._touch(key)
+            return self._entries[key]
+
+    def pop(self, key):
+        '''
+        Return the Tracked entry for key, and forget it
+        '''
+        with self._lock:
+            if key not in self._entries:
+                raise Exception('Nothing tracked with key {0!r} (capacity {1}, {2} evicted)'.format(
+                    key, self.capacity, self.evicted))
+            return self._entries.pop(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def keys(self):
+        with self._lock:
+            return self._entries.keys()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -21,59 +21,403 @@ import sys
 import subprocess
 import socket
 import time
+import fcntl
+import errno
+import threading
+import contextlib
+import sqlite3
+import shutil
+import uuid
+import stat
+import hashlib
+import tempfile
+import select
+import re
+import ctypes
+import io
 
 import tsqa.log
 import logging
 
 log = logging.getLogger(__name__)
 
+class LogTail(object):
+    '''
+    Incrementally read the lines appended to a (growing) log file. This follows
+    the path across truncation and rotation (the file being moved away and
+    recreated), so close() it when done
+    '''
+    def __init__(self, path, from_end=False):
+        self.path = path
+        self._fh = None
+        self._partial = ''
+        # skip whatever is already in the file
+        if from_end:
+            self._open()
+            if self._fh is not None:
+                self._fh.seek(0, os.SEEK_END)
+
+    def _open(self):
+        try:
+            self._fh = io.open(self.path, 'rb')
+        except IOError:
+            # not created yet
+            self._fh = None
+
+    def _read(self):
+        # truncated in place, start over
+        if os.fstat(self._fh.fileno()).st_size < self._fh.tell():
+            self._fh.seek(0)
+            self._partial = ''
+        return self._fh.read()
+
+    def lines(self):
+        '''
+        Return the (complete) lines appended since the last call
+        '''
+        if self._fh is None:
+            self._open()
+            if self._fh is None:
+                return []
+        data = self._read()
+        try:
+            rotated = os.stat(self.path).st_ino != os.fstat(self._fh.fileno()).st_ino
+        except OSError:
+            # moved away, and not recreated yet
+            rotated = False
+        if rotated:
+            # finish the old file (including an unterminated last line), and
+            # continue with the new one
+            data = self._partial + data + self._fh.read()
+            self._partial = ''
+            if data and not data.endswith('\n'):
+                data += '\n'
+            self._fh.close()
+            self._open()
+            if self._fh is not None:
+                data += self._read()
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        return lines
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class Inotify(object):
+    '''
+    Minimal inotify (linux only) wrapper, to wait for changes in a directory.
+    Raises OSError (or AttributeError) if inotify isn't available
+    '''
+    IN_MODIFY = 0x00000002
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_CLOEXEC = 02000000
+
+    def __init__(self, path, mask=IN_MODIFY | IN_MOVED_TO | IN_CREATE):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, path, mask) < 0:
+            err = ctypes.get_errno()
+            self.close()
+            raise OSError(err, 'inotify_add_watch failed for {0}'.format(path))
+
+    def wait(self, timeout):
+        '''
+        Wait up to timeout seconds for a change, returns whether there was one
+        '''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # we don't care what changed, just that something did
+        while True:
+            try:
+                os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+        return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class LogFollower(object):
+    '''
+    Follow a log file: return the lines appended since the last checkpoint, or
+    wait for a line matching a regex. Waiting is driven by inotify if it is
+    available, otherwise the file is polled every poll_interval seconds.
+    '''
+    poll_interval = 0.05
+
+    def __init__(self, path):
+        self.path = path
+        self._tail = LogTail(path)
+        # lines read, but not returned yet
+        self._lines = []
+        try:
+            self._inotify = Inotify(os.path.dirname(path))
+        except (OSError, AttributeError) as e:
+            log.debug('Polling {0}, no inotify: {1}'.format(path, e))
+            self._inotify = None
+
+    def _read(self):
+        self._lines.extend(self._tail.lines())
+
+    def checkpoint(self):
+        '''
+        Skip everything logged so far
+        '''
+        self._read()
+        self._lines = []
+
+    def lines(self):
+        '''
+        Return the lines logged since the last checkpoint (or call)
+        '''
+        self._read()
+        ret, self._lines = self._lines, []
+        return ret
+
+    def wait_for(self, regex, timeout=10):
+        '''
+        Wait for a line (logged since the last checkpoint) to match regex, and
+        return the match. The lines up to and including it are consumed
+        '''
+        if isinstance(regex, basestring):
+            regex = re.compile(regex)
+        deadline = time.time() + timeout
+        scanned = 0
+        while True:
+            self._read()
+            for i in xrange(scanned, len(self._lines)):
+                match = regex.search(self._lines[i])
+                if match:
+                    del self._lines[:i + 1]
+                    return match
+            scanned = len(self._lines)
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Exception("Timeout waiting for '{0}' in {1}".format(regex.pattern, self.path))
+            if self._inotify is not None:
+                # don't rely on inotify alone, the directory could be replaced
+                self._inotify.wait(min(remaining, 1))
+            else:
+                time.sleep(min(remaining, self.poll_interval))
+
+    def close(self):
+        self._tail.close()
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+
+class LogMarkerWatcher(object):
+    '''
+    Incrementally read a (growing) log file, looking for a regex. With from_end
+    whatever was logged before it was created (say by a previous run of the
+    daemon) is ignored, so create it before starting the daemon
+    '''
+    def __init__(self, path, marker, from_end=False):
+        self.path = path
+        self.marker = re.compile(marker)
+        self.found = False
+        self._tail = LogTail(path, from_end=from_end)
+
+    def check(self):
+        '''
+        Read whatever was appended since the last check, returns whether the
+        marker has been seen
+        '''
+        if self.found:
+            return True
+        for line in self._tail.lines():
+            if self.marker.search(line):
+                self.found = True
+                break
+        return self.found
+
+    def close(self):
+        self._tail.close()
+
+
 def poll_interfaces(hostports, **kwargs):
     '''  Block until we can successfully connect to all ports or timeout
 
-    :param hostports:
+    This starts non-blocking connects to all of the ports at once and waits on
+    them with select(), retrying refused ports with a backoff that starts at a
+    few ms. So it returns as soon as the last port is up.
+
+    :param hostports: list of (host, port)
     :param kwargs: optional timeout_sec
+                   optional log_file and log_marker (a regex, defaults to
+                       "traffic server running"): also wait for the marker to be
+                       logged to log_file
+                   optional log_watcher: a LogMarkerWatcher to wait for instead
+                       of log_file (closed once done)
+                   optional on_up: function called with each (host, port) as
+                       it comes up
     '''
 
     connect_timeout_sec = 1
-    poll_sleep_sec = 0.1
+    min_backoff_sec = 0.005
+    max_backoff_sec = 0.1
 
-    if kwargs.has_key('timeout_sec'):
-        timeout = time.time() + kwargs['timeout_sec']
-    else:
-        timeout = time.time() + 5
+    deadline = time.time() + kwargs.get('timeout_sec', 5)
 
-    hostports = hostports[:] # don't modify the caller's hostports
+    watcher = kwargs.get('log_watcher')
+    if watcher is None and kwargs.get('log_file'):
+        watcher = LogMarkerWatcher(kwargs['log_file'],
+                                   kwargs.get('log_marker', 'traffic server running'))
 
-    while timeout > time.time():
-        for hostport in hostports[:]: # don't modify our hostports copy during iteration
-            hostname = hostport[0]
-            port = hostport[1]
+    pending = list(hostports)  # don't modify the caller's hostports
+    # hostport -> (socket, time the connect was started)
+    connecting = {}
+    # hostport -> time of the next connect attempt
+    next_attempt = dict((hostport, 0) for hostport in pending)
+    backoff = dict((hostport, min_backoff_sec) for hostport in pending)
 
-            log.debug("Checking interface '%s:%d'", hostname, port)
+    def retry_later(hostport, now):
+        next_attempt[hostport] = now + backoff[hostport]
+        backoff[hostport] = min(backoff[hostport] * 2, max_backoff_sec)
 
-            # This supports IPv6
-            try:
-                s = socket.create_connection((hostname, port),
-                                             timeout=connect_timeout_sec,
-                                             )
-                s.close()
-                hostports.remove(hostport)
+    def up(hostport):
+        pending.remove(hostport)
+        log.debug("Interface '%s:%d' is up", hostport[0], hostport[1])
+        if kwargs.get('on_up'):
+            kwargs['on_up'](hostport)
 
-                log.debug("Interface '%s:%d' is up", hostname, port)
-            except:
-                pass
+    try:
+        while True:
+            now = time.time()
+            for hostport in pending[:]:
+                if hostport in connecting or next_attempt[hostport] > now:
+                    continue
+                log.debug("Checking interface '%s:%d'", hostport[0], hostport[1])
+                # This supports IPv6
+                try:
+                    family, socktype, proto, _, sockaddr = socket.getaddrinfo(hostport[0], hostport[1],
+                                                                              0, socket.SOCK_STREAM)[0]
+                except socket.error:
+                    retry_later(hostport, now)
+                    continue
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(0)
+                err = sock.connect_ex(sockaddr)
+                if err == 0:
+                    sock.close()
+                    up(hostport)
+                elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                    connecting[hostport] = (sock, now)
+                else:
+                    sock.close()
+                    retry_later(hostport, now)
 
-        if not hostports:
-            break
+            if not pending and (watcher is None or watcher.check()):
+                break
+            if now >= deadline:
+                break
 
-        time.sleep(poll_sleep_sec)
+            # sleep until a connect finishes, the next retry, or the next log check
+            wakeup = deadline
+            for hostport in pending:
+                if hostport in connecting:
+                    wakeup = min(wakeup, connecting[hostport][1] + connect_timeout_sec)
+                else:
+                    wakeup = min(wakeup, next_attempt[hostport])
+            if watcher is not None and not watcher.found:
+                wakeup = min(wakeup, now + max_backoff_sec)
+            socks = dict((sock, hostport) for hostport, (sock, _) in connecting.iteritems())
+            timeout = max(0, wakeup - time.time())
+            if socks:
+                _, writable, errored = select.select([], socks.keys(), socks.keys(), timeout)
+            else:
+                writable, errored = [], []
+                time.sleep(timeout)
 
-    if hostports:
+            now = time.time()
+            for sock in set(writable + errored):
+                hostport = socks[sock]
+                del connecting[hostport]
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                sock.close()
+                if err == 0:
+                    up(hostport)
+                else:
+                    retry_later(hostport, now)
+            # give up on connects which are taking too long
+            for hostport, (sock, started) in connecting.items():
+                if now - started >= connect_timeout_sec:
+                    del connecting[hostport]
+                    sock.close()
+                    retry_later(hostport, now)
+    finally:
+        for sock, _ in connecting.itervalues():
+            sock.close()
+        if watcher is not None:
+            watcher.close()
+
+    if pending:
         raise Exception("Timeout waiting for interfaces: {0}".format(
-                        reduce(lambda x, y: str(x) + ',' + str(y), hostports)))
+                        reduce(lambda x, y: str(x) + ',' + str(y), pending)))
+    if watcher is not None and not watcher.found:
+        raise Exception("Timeout waiting for '{0}' in {1}".format(watcher.marker.pattern, watcher.path))
 
     log.debug("All interfaces are up")
 
+def become_subreaper():
+    '''
+    Make this process the reaper of its orphaned descendants (instead of init),
+    so it can waitpid() on them. Returns whether that worked, it requires
+    linux >= 3.4
+    '''
+    # this isn't inherited across fork, so keep track of it per pid
+    if os.getpid() not in _subreaper:
+        ret = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                ret = libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+            except (OSError, AttributeError):
+                pass
+        _subreaper[os.getpid()] = ret
+    return _subreaper[os.getpid()]
+
+def is_subreaper():
+    '''
+    Return whether become_subreaper() made this process a subreaper
+    '''
+    return _subreaper.get(os.getpid(), False)
+
+PR_SET_CHILD_SUBREAPER = 36
+# pid -> whether that process is a subreaper
+_subreaper = {}
+
+
+def new_session(cmd):
+    '''
+    Return (cmd, preexec_fn) to pass to subprocess.Popen to run cmd as the
+    leader of a new session (and so process group). This uses setsid(1) if it
+    is installed, as running python code between fork and exec (preexec_fn)
+    isn't safe while other threads are running
+    '''
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        setsid = os.path.join(path, 'setsid')
+        if os.path.isfile(setsid) and os.access(setsid, os.X_OK):
+            # the child isn't a process group leader, so setsid execs cmd
+            # without forking (keeping the pid Popen knows)
+            return [setsid] + list(cmd), None
+    return list(cmd), os.setsid
+
+
 # TODO: test
 def import_unittest():
     '''
@@ -85,6 +429,154 @@ def import_unittest():
         return __import__('unittest')
 
 
+def port_is_free(port, interface=''):
+    '''
+    Return whether we are able to bind to port
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind((interface, port))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class PortAllocator(object):
+    '''
+    Hand out ports that no other tsqa process on this host will hand out
+
+    The port range is split into blocks, which a process claims by holding a
+    flock on the block's file in a registry directory shared by all processes.
+    The kernel drops the lock when the process exits, so the blocks of dead
+    processes are reused automatically. Ports are reserved until they are
+    released, and are checked to be bindable before they are handed out.
+    '''
+    block_size = 32
+
+    def __init__(self, registry_dir=None, port_range=None):
+        if registry_dir is None:
+            registry_dir = os.environ.get('TSQA_PORT_REGISTRY',
+                                          os.path.join(tempfile.gettempdir(), 'tsqa', 'ports'))
+        self.registry_dir = registry_dir
+
+        if port_range is None:
+            port_range = self._default_port_range()
+        self.port_range = port_range
+
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._blocks = []
+        self._free = []
+        self.reserved = set()
+
+    def _default_port_range(self):
+        '''
+        TSQA_PORT_RANGE (low-high), otherwise everything from 10000 up to the
+        kernel's ephemeral port range (so we don't collide with client sockets)
+        '''
+        if 'TSQA_PORT_RANGE' in os.environ:
+            low, high = os.environ['TSQA_PORT_RANGE'].split('-')
+            return int(low), int(high)
+        try:
+            with open('/proc/sys/net/ipv4/ip_local_port_range') as fh:
+                ephemeral_low = int(fh.read().split()[0])
+        except (IOError, ValueError, IndexError):
+            ephemeral_low = 32768
+        return 10000, ephemeral_low - 1
+
+    def _claim_block(self):
+        low, high = self.port_range
+        num_blocks = (high - low + 1) // self.block_size
+        # start looking at a different place in each process, to avoid contention
+        offset = os.getpid() % max(num_blocks, 1)
+        for i in xrange(num_blocks):
+            first = low + ((offset + i) % num_blocks) * self.block_size
+            lock = FileLock(os.path.join(self.registry_dir, 'block.{0}.lock'.format(first)))
+            if lock.acquire(blocking=False):
+                self._blocks.append(lock)
+                self._free.extend(xrange(first, first + self.block_size))
+                return
+        raise Exception('No free port blocks in {0}-{1}'.format(low, high))
+
+    def reserve(self, count=1):
+        '''
+        Reserve count ports, returns a list of them
+        '''
+        with self._lock:
+            if self._pid != os.getpid():
+                # we were forked, the blocks belong to our parent
+                for lock in self._blocks:
+                    lock.detach()
+                self._reset()
+
+            ports = []
+            # ports someone outside of tsqa is using right now, they go to the
+            # back of the queue (they are ours, and may well be free later)
+            skipped = []
+            try:
+                while len(ports) < count:
+                    if not self._free:
+                        try:
+                            self._claim_block()
+                        except:
+                            # don't leak the ones we already got
+                            self._free[:0] = ports
+                            self.reserved.difference_update(ports)
+                            raise
+                    port = self._free.pop(0)
+                    if not port_is_free(port):
+                        skipped.append(port)
+                        continue
+                    ports.append(port)
+                    self.reserved.add(port)
+            finally:
+                self._free.extend(skipped)
+            return ports
+
+    def release(self, ports):
+        '''
+        Return ports to the allocator
+        '''
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            for port in ports:
+                if port in self.reserved:
+                    self.reserved.remove(port)
+                    self._free.append(port)
+
+
+_port_allocator = None
+# guards creating _port_allocator, so threads don't each make their own
+_port_allocator_lock = threading.Lock()
+
+
+def reserve_ports(count=1):
+    '''
+    Reserve count ports from this process's PortAllocator
+    '''
+    global _port_allocator
+    if _port_allocator is None:
+        with _port_allocator_lock:
+            if _port_allocator is None:
+                _port_allocator = PortAllocator()
+    return _port_allocator.reserve(count)
+
+
+def release_ports(ports):
+    '''
+    Release ports returned by reserve_ports()
+    '''
+    if _port_allocator is not None:
+        _port_allocator.release(ports)
+
+
 def bind_unused_port(interface=''):
     '''
     Binds a server socket to an available port on 0.0.0.0.
@@ -158,80 +650,751 @@ def configure_string_to_dict(configure_string):
     return ret
 
 
+def pid_exists(pid):
+    '''
+    Return whether a process with pid is running (on this host)
+    '''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def disk_usage(path):
+    '''
+    Return the number of bytes in all of the files under path, files that are
+    hardlinked more than once are only counted once
+    '''
+    seen = set()
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            st = os.lstat(os.path.join(dirpath, filename))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
+
+def shared_disk_usage(path):
+    '''
+    Return (bytes, shared) for the files under path: bytes of the files only
+    linked there, and a dict of "dev:ino" -> size of the files which are
+    hardlinked from elsewhere as well (like the objects of an ObjectStore),
+    which only take up space once however many trees they are in
+    '''
+    total = 0
+    shared = {}
+    seen = set()
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            st = os.lstat(os.path.join(dirpath, filename))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            if st.st_nlink > 1 and stat.S_ISREG(st.st_mode):
+                shared['{0}:{1}'.format(st.st_dev, st.st_ino)] = st.st_size
+            else:
+                total += st.st_size
+    return total, shared
+
+
+def free_space(path):
+    '''
+    Return the number of bytes available (to us) on the filesystem of path, or
+    0 if path doesn't exist
+    '''
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return 0
+    return st.f_bavail * st.f_frsize
+
+
+def parse_size(size):
+    '''
+    Return size (bytes, or a string with a K/M/G/T suffix like in storage.config)
+    as a number of bytes
+    '''
+    if isinstance(size, (int, long)):
+        return size
+    size = size.strip().upper()
+    for power, suffix in enumerate('KMGT', 1):
+        if size.endswith(suffix):
+            return int(size[:-1]) * (1024 ** power)
+    return int(size)
+
+
+class FileLock(object):
+    '''
+    Exclusive (flock based) lock on a file, for synchronizing processes
+
+    The lock is tied to the open file, so the kernel releases it if the holder
+    dies. This can also be used as a context manager:
+
+        with tsqa.utils.FileLock('/tmp/foo.lock'):
+            ...
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+
+    def acquire(self, blocking=True):
+        '''
+        Acquire the lock, returns whether we got it (always True if blocking)
+        '''
+        if self._fh is not None:
+            raise Exception('Lock {0} is already held'.format(self.path))
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fh = open(self.path, 'a')
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fh, flags)
+        except IOError as e:
+            fh.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._fh = fh
+        return True
+
+    def release(self):
+        '''
+        Release the lock
+        '''
+        if self._fh is None:
+            raise Exception('Lock {0} is not held'.format(self.path))
+        fcntl.flock(self._fh, fcntl.LOCK_UN)
+        self._fh.close()
+        self._fh = None
+
+    def detach(self):
+        '''
+        Forget about the lock without unlocking it. This is for a forked child,
+        which shares the lock with its parent and must not release it.
+        '''
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    @property
+    def locked(self):
+        return self._fh is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class TreeCloner(object):
+    '''
+    Clone files and directory trees as cheaply as the filesystem allows
+
+    Copies are made with reflinks (copy-on-write clones) when the filesystem
+    supports them, falling back to a regular copy. Links (for trees that are
+    only read) are reflinks, then hardlinks, then symlinks. Once a method fails
+    because the filesystem doesn't support it we stop trying it.
+
+    Sockets, fifos and device files are skipped.
+    '''
+    # from linux/fs.h
+    FICLONE = 0x40049409
+
+    # errors meaning a method isn't supported (between these paths)
+    unsupported_errnos = (errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY,
+                          errno.EOPNOTSUPP, errno.EMLINK, errno.ENOSYS)
+
+    # whether we've said that reflinks aren't supported (once per process)
+    reflink_fallback_logged = False
+
+    def __init__(self):
+        self.reflink_ok = sys.platform.startswith('linux')
+        self.hardlink_ok = True
+
+    def reflink(self, src, dst):
+        '''
+        Make dst a copy-on-write clone of src
+        '''
+        with open(src, 'rb') as src_fh:
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+            try:
+                fcntl.ioctl(fd, self.FICLONE, src_fh.fileno())
+            except:
+                os.close(fd)
+                os.unlink(dst)
+                raise
+            os.close(fd)
+        shutil.copystat(src, dst)
+
+    def copy_file(self, src, dst):
+        if self.reflink_ok:
+            try:
+                return self.reflink(src, dst)
+            except (IOError, OSError) as e:
+                if e.errno not in self.unsupported_errnos:
+                    raise
+                self.reflink_ok = False
+                if not TreeCloner.reflink_fallback_logged:
+                    TreeCloner.reflink_fallback_logged = True
+                    log.info('Reflinks are not supported for {0} ({1}), copying instead'.format(dst, e))
+        shutil.copy2(src, dst)
+
+    def link_file(self, src, dst):
+        if self.reflink_ok:
+            try:
+                return self.reflink(src, dst)
+            except (IOError, OSError) as e:
+                if e.errno not in self.unsupported_errnos:
+                    raise
+                self.reflink_ok = False
+        if self.hardlink_ok:
+            try:
+                return os.link(src, dst)
+            except OSError as e:
+                if e.errno not in self.unsupported_errnos:
+                    raise
+                self.hardlink_ok = False
+        os.symlink(os.path.abspath(src), dst)
+
+    def clone(self, src, dst, link=False):
+        '''
+        Clone the file or directory tree at src to dst, if link is set files are
+        linked instead of copied
+        '''
+        clone_file = self.link_file if link else self.copy_file
+        if not os.path.isdir(src):
+            return clone_file(src, dst)
+
+        dirs = []
+        for dirpath, dirnames, filenames in os.walk(src):
+            dst_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+            if not os.path.isdir(dst_dir):
+                os.makedirs(dst_dir)
+            dirs.append((dirpath, dst_dir))
+            for name in dirnames + filenames:
+                src_path = os.path.join(dirpath, name)
+                dst_path = os.path.join(dst_dir, name)
+                st = os.lstat(src_path)
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(src_path), dst_path)
+                elif stat.S_ISREG(st.st_mode):
+                    clone_file(src_path, dst_path)
+        # set directory modes last, in case they are read-only
+        for src_dir, dst_dir in reversed(dirs):
+            shutil.copystat(src_dir, dst_dir)
+
+
+class ObjectStore(object):
+    '''
+    Content addressed store of files on disk
+
+    Trees are ingested file by file, each unique (contents, mode) is stored once
+    under root and hardlinked into every tree that contains it. So disk usage
+    (and ingest cost) scales with the unique bytes, not the number of trees.
+
+    Since the files are shared, trees materialized from the store must be
+    treated as read-only.
+    '''
+    hash_block_size = 1024 * 1024
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def _digest(self, path, mode):
+        hval = hashlib.sha1()
+        hval.update('{0:o}\0'.format(mode))
+        with open(path, 'rb') as fh:
+            while True:
+                block = fh.read(self.hash_block_size)
+                if not block:
+                    break
+                hval.update(block)
+        return hval.hexdigest()
+
+    def object_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def _add(self, src_path, dst_path, mode):
+        '''
+        Add src_path to the store, and link dst_path to the stored object.
+        Returns the number of bytes that were new to the store
+        '''
+        obj_path = self.object_path(self._digest(src_path, mode))
+        added = 0
+        while True:
+            if not os.path.isdir(os.path.dirname(obj_path)):
+                try:
+                    os.makedirs(os.path.dirname(obj_path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            try:
+                os.link(src_path, obj_path)
+                added = os.lstat(obj_path).st_size
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                os.link(obj_path, dst_path)
+                return added
+            except OSError as e:
+                # the object was garbage collected underneath us, add it again
+                if e.errno == errno.ENOENT:
+                    continue
+                # out of links for this object, just give this tree a copy
+                if e.errno == errno.EMLINK:
+                    shutil.copy2(src_path, dst_path)
+                    return os.lstat(dst_path).st_size
+                raise
+
+    def ingest(self, src, dst):
+        '''
+        Materialize the tree at src as dst, with all regular files hardlinked
+        from the store. src must be on the same filesystem as the store, and is
+        left in place. Returns the number of bytes that were new to the store
+        '''
+        added = 0
+        for dirpath, dirnames, filenames in os.walk(src):
+            dst_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+            if not os.path.isdir(dst_dir):
+                os.makedirs(dst_dir)
+            for name in dirnames + filenames:
+                src_path = os.path.join(dirpath, name)
+                dst_path = os.path.join(dst_dir, name)
+                st = os.lstat(src_path)
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(src_path), dst_path)
+                elif stat.S_ISREG(st.st_mode):
+                    added += self._add(src_path, dst_path, stat.S_IMODE(st.st_mode))
+            os.chmod(dst_dir, stat.S_IMODE(os.stat(dirpath).st_mode))
+        return added
+
+    def gc(self):
+        '''
+        Remove objects that are no longer linked into any tree, returns the
+        number of bytes freed
+        '''
+        freed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                st = os.lstat(path)
+                if st.st_nlink == 1:
+                    os.unlink(path)
+                    freed += st.st_size
+        return freed
+
+
 class BuildCache(MutableMapping):
     '''
     Cache layouts on disk
 
-    This is just a mapping of source_hash -> key -> installed_dir
+    This is just a mapping of source_hash -> key -> entry, where the entry is a
+    dict with the 'path' of the installed layout.
+
+    The size of a layout (for max_bytes) is the bytes only it has, files which
+    are hardlinked elsewhere (see ObjectStore) are tracked by inode so they are
+    counted once, and only freed once no layout has them.
+
+    The cache is stored in sqlite, so every change is a single committed row
+    update (safe across processes and crashes) and entries can be looked up by
+    source_hash or key without loading the rest. cache[source_hash] is a live
+    view, so cache[source_hash][key] = entry is persisted as well.
     '''
+    cache_db_filename = 'env_cache.db'
+    # json map used by older versions, imported into the db if we find one
     cache_map_filename = 'env_cache_map.json'
 
-    def __init__(self, cache_dir):
+    schema = (
+        '''CREATE TABLE IF NOT EXISTS source_hashes (
+            source_hash TEXT PRIMARY KEY
+        )''',
+        '''CREATE TABLE IF NOT EXISTS layouts (
+            source_hash TEXT NOT NULL,
+            key TEXT NOT NULL,
+            path TEXT,
+            entry TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            last_used REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (source_hash, key)
+        )''',
+        '''CREATE INDEX IF NOT EXISTS layouts_key ON layouts (key)''',
+        # hardlinked files of the layouts, "dev:ino" -> size
+        '''CREATE TABLE IF NOT EXISTS layout_objects (
+            path TEXT NOT NULL,
+            object TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (path, object)
+        )''',
+        # incremental build trees, which count towards max_bytes as well
+        '''CREATE TABLE IF NOT EXISTS build_dirs (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL DEFAULT 0,
+            last_used REAL NOT NULL DEFAULT 0
+        )''',
+        # layouts (or build dirs) in use by a process can't be evicted
+        '''CREATE TABLE IF NOT EXISTS pins (
+            token TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            pid INTEGER NOT NULL
+        )''',
+    )
+
+    # columns added to the layouts table since it was first created
+    added_columns = (
+        ('size', 'INTEGER NOT NULL DEFAULT 0'),
+        ('last_used', 'REAL NOT NULL DEFAULT 0'),
+    )
+
+    def __init__(self, cache_dir, max_bytes=None, max_entries=None):
+        '''
+        max_bytes and max_entries are the budget for cached layouts, once either
+        is exceeded evict() removes the least recently used layouts
+        '''
         super(BuildCache, self).__init__()
         self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
 
         if not os.path.isdir(self.cache_dir):
             os.makedirs(self.cache_dir)
 
-        self._dict = {}
+        # the connection is shared by the threads of this process
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.cache_db_file,
+                                     timeout=60,
+                                     isolation_level=None,  # we do our own transactions
+                                     check_same_thread=False,
+                                     )
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._transaction() as conn:
+            for statement in self.schema:
+                conn.execute(statement)
+            columns = set(row[1] for row in conn.execute('PRAGMA table_info(layouts)'))
+            for column, definition in self.added_columns:
+                if column not in columns:
+                    conn.execute('ALTER TABLE layouts ADD COLUMN {0} {1}'.format(column, definition))
 
         self.load_cache()
 
+    @property
+    def cache_db_file(self):
+        return os.path.join(self.cache_dir, self.cache_db_filename)
+
     @property
     def cache_map_file(self):
         return os.path.join(self.cache_dir, self.cache_map_filename)
 
-    def load_cache(self):
+    @contextlib.contextmanager
+    def _transaction(self):
+        '''
+        Run a block of statements as one (write) transaction
+        '''
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def _query(self, sql, *args):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def _read_map_file(self):
         '''
-        Load the cache from disk
+        Return the json map file written by older versions (with the usage of
+        its entries), or None
         '''
         try:
             with open(self.cache_map_file) as fh:
                 cache = json.load(fh)
-        except IOError, ValueError:
-            # Just bail if the file is not there, is empty, or does not parse.
+        except (IOError, ValueError):
+            # the file is not there, is empty, or does not parse.
+            return None
+        return dict((source_hash, self._usages(env_map)) for source_hash, env_map in cache.iteritems())
+
+    def _import_map_file(self, conn, cache):
+        '''
+        Import (and retire) the json map file read by _read_map_file()
+        '''
+        if cache is None:
             return
+        for source_hash, env_map in cache.iteritems():
+            conn.execute('INSERT OR IGNORE INTO source_hashes VALUES (?)', (source_hash,))
+            for key, (entry, usage) in env_map.iteritems():
+                self._set_entry(conn, source_hash, key, entry, usage, replace=False)
+        os.rename(self.cache_map_file, self.cache_map_file + '.imported')
+
+    @staticmethod
+    def _usage(entry):
+        '''
+        Return the shared_disk_usage() of an entry's layout. This walks the
+        layout, so do it before taking the (database wide) write lock.
+        '''
+        path = entry.get('path') if isinstance(entry, dict) else None
+        return shared_disk_usage(path) if path is not None else (0, {})
 
-        changed = False  # whether we changed the cache file, and need to write it out
-        # verify that all of those directories exist, clean them out if they don't
-        for source_hash, env_map in cache.items():
-            # if the directory doesn't exist
-            for key, entry in env_map.items():
-                if not os.path.isdir(entry['path']):
-                    del cache[source_hash][key]
-                    changed = True
-            # if the source_hash level key is now empty
-            if len(cache[source_hash]) == 0:
-                del cache[source_hash]
-                changed = True
-
-        self._dict = cache
-        if changed:  # if we changed it, lets write it out to disk
-            self.save_cache()
+    def _usages(self, env_map):
+        '''
+        Return key -> (entry, usage) for the entries of env_map
+        '''
+        return dict((key, (entry, self._usage(entry))) for key, entry in dict(env_map).iteritems())
+
+    def _set_entry(self, conn, source_hash, key, entry, usage, replace=True):
+        path = entry.get('path') if isinstance(entry, dict) else None
+        size, shared = usage
+        if path is not None:
+            conn.execute('DELETE FROM layout_objects WHERE path = ?', (path,))
+            conn.executemany('INSERT INTO layout_objects VALUES (?, ?, ?)',
+                             [(path, obj, obj_size) for obj, obj_size in shared.iteritems()])
+        conn.execute('''INSERT OR {0} INTO layouts (source_hash, key, path, entry, size, last_used)
+                        VALUES (?, ?, ?, ?, ?, ?)'''.format('REPLACE' if replace else 'IGNORE'),
+                     (source_hash, key, path, json.dumps(entry), size, time.time()))
+
+    def load_cache(self):
+        '''
+        Import any old cache file, and drop entries whose layout is gone
+        '''
+        cache = self._read_map_file()
+        with self._transaction() as conn:
+            self._import_map_file(conn, cache)
+
+            # verify that all of those directories exist, clean them out if they don't
+            for source_hash, key, path in conn.execute('SELECT source_hash, key, path FROM layouts').fetchall():
+                if path is not None and not os.path.isdir(path):
+                    conn.execute('DELETE FROM layouts WHERE source_hash = ? AND key = ?', (source_hash, key))
+            # drop any source_hash that is now empty
+            conn.execute('''DELETE FROM source_hashes WHERE source_hash NOT IN
+                            (SELECT DISTINCT source_hash FROM layouts)''')
+            for (path,) in conn.execute('SELECT path FROM build_dirs').fetchall():
+                if not os.path.isdir(path):
+                    conn.execute('DELETE FROM build_dirs WHERE path = ?', (path,))
 
     def save_cache(self):
         '''
-        Write the cache out to disk
+        Every change is committed as it is made, this is kept for compatibility
+        '''
+        pass
+
+    def by_key(self, key):
+        '''
+        Return a dict of source_hash -> entry for all layouts built with key
+        '''
+        return dict((source_hash, json.loads(entry)) for source_hash, entry in
+                    self._query('SELECT source_hash, entry FROM layouts WHERE key = ?', key))
+
+    def touch(self, source_hash, key):
+        '''
+        Mark a layout as used now
         '''
-        with open(self.cache_map_file, 'w') as fh:
-            fh.write(json.dumps(self._dict))
+        with self._transaction() as conn:
+            conn.execute('UPDATE layouts SET last_used = ? WHERE source_hash = ? AND key = ?',
+                         (time.time(), source_hash, key))
 
-    def __setitem__(self, key, val):
-        self._dict[key] = val
-        self.save_cache()
+    def pin(self, source_hash, key):
+        '''
+        Pin a layout so it won't be evicted, returns a token for unpin() or None
+        if the layout is not (or no longer) in the cache
+
+        Pins are dropped automatically once the process that made them is gone.
+        '''
+        token = uuid.uuid4().hex
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT path FROM layouts WHERE source_hash = ? AND key = ?',
+                                (source_hash, key)).fetchall()
+            if not rows or rows[0][0] is None:
+                return None
+            conn.execute('INSERT INTO pins VALUES (?, ?, ?)', (token, rows[0][0], os.getpid()))
+            conn.execute('UPDATE layouts SET last_used = ? WHERE source_hash = ? AND key = ?',
+                         (time.time(), source_hash, key))
+        return token
+
+    def pin_build_dir(self, path):
+        '''
+        Pin a build dir (adding it to the cache) while we build in it, returns
+        a token for unpin()
+        '''
+        token = uuid.uuid4().hex
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO build_dirs (path) VALUES (?)', (path,))
+            conn.execute('UPDATE build_dirs SET last_used = ? WHERE path = ?', (time.time(), path))
+            conn.execute('INSERT INTO pins VALUES (?, ?, ?)', (token, path, os.getpid()))
+        return token
+
+    def update_build_dir(self, path):
+        '''
+        Record the current size of a build dir
+        '''
+        size = disk_usage(path)
+        with self._transaction() as conn:
+            conn.execute('UPDATE build_dirs SET size = ?, last_used = ? WHERE path = ?',
+                         (size, time.time(), path))
+
+    def unpin(self, token):
+        '''
+        Remove a pin returned by pin()
+        '''
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM pins WHERE token = ?', (token,))
+
+    def evict(self):
+        '''
+        Remove least recently used layouts (and their directories) until we are
+        within max_bytes/max_entries. Build dirs only count towards max_bytes.
+        Pinned layouts and build dirs are never evicted.
+
+        Returns the list of paths that were evicted
+        '''
+        if self.max_bytes is None and self.max_entries is None:
+            return []
+
+        evicted = []
+        with self._transaction() as conn:
+            # drop pins of processes which have died
+            for token, pid in conn.execute('SELECT token, pid FROM pins').fetchall():
+                if not pid_exists(pid):
+                    conn.execute('DELETE FROM pins WHERE token = ?', (token,))
+            pinned = set(row[0] for row in conn.execute('SELECT path FROM pins'))
+
+            conn.execute('DELETE FROM layout_objects WHERE path NOT IN (SELECT path FROM layouts)')
+            rows = conn.execute('''SELECT source_hash, key, path, size, last_used FROM layouts''').fetchall()
+            build_dirs = conn.execute('''SELECT NULL, NULL, path, size, last_used FROM build_dirs''').fetchall()
+            # shared objects are counted once, and freed along with the last
+            # layout which has them
+            objects = {}
+            refs = {}
+            sizes = {}
+            for path, obj, obj_size in conn.execute('SELECT path, object, size FROM layout_objects'):
+                objects.setdefault(path, []).append(obj)
+                refs[obj] = refs.get(obj, 0) + 1
+                sizes[obj] = obj_size
+            total_bytes = sum(row[3] for row in rows + build_dirs) + sum(sizes.itervalues())
+            total_entries = len(rows)
+            for source_hash, key, path, size, last_used in sorted(rows + build_dirs, key=lambda row: row[4]):
+                bytes_ok = self.max_bytes is None or total_bytes <= self.max_bytes
+                if bytes_ok and (self.max_entries is None or total_entries <= self.max_entries):
+                    break
+                if path in pinned:
+                    continue
+                if key is None:
+                    # a build dir, which only makes room in bytes
+                    if bytes_ok:
+                        continue
+                    conn.execute('DELETE FROM build_dirs WHERE path = ?', (path,))
+                    total_bytes -= size
+                    evicted.append(path)
+                    continue
+                conn.execute('DELETE FROM layouts WHERE source_hash = ? AND key = ?', (source_hash, key))
+                total_bytes -= size
+                total_entries -= 1
+                if path is not None:
+                    evicted.append(path)
+                    for obj in objects.pop(path, []):
+                        refs[obj] -= 1
+                        if refs[obj] == 0:
+                            total_bytes -= sizes[obj]
+            conn.execute('DELETE FROM layout_objects WHERE path NOT IN (SELECT path FROM layouts)')
+            conn.execute('''DELETE FROM source_hashes WHERE source_hash NOT IN
+                            (SELECT DISTINCT source_hash FROM layouts)''')
+
+        # nothing references these anymore, so we can remove them outside the transaction
+        for path in evicted:
+            log.info('Evicting {0} from the cache'.format(path))
+            shutil.rmtree(path, ignore_errors=True)
+        return evicted
+
+    def __setitem__(self, source_hash, env_map):
+        # setting a view of ourselves back is a no-op
+        if isinstance(env_map, BuildCacheView) and env_map.source_hash == source_hash:
+            with self._transaction() as conn:
+                conn.execute('INSERT OR IGNORE INTO source_hashes VALUES (?)', (source_hash,))
+            return
+        env_map = self._usages(env_map)
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO source_hashes VALUES (?)', (source_hash,))
+            conn.execute('DELETE FROM layouts WHERE source_hash = ?', (source_hash,))
+            for key, (entry, usage) in env_map.iteritems():
+                self._set_entry(conn, source_hash, key, entry, usage)
+
+    def setdefault(self, source_hash, default=None):
+        '''
+        Return the view for source_hash, adding it (with the entries of default)
+        if it isn't there. Unlike cache[source_hash] = {} this never drops
+        entries another process added in the meantime.
+        '''
+        default = self._usages(default or {})
+        with self._transaction() as conn:
+            if conn.execute('INSERT OR IGNORE INTO source_hashes VALUES (?)', (source_hash,)).rowcount:
+                for key, (entry, usage) in default.iteritems():
+                    self._set_entry(conn, source_hash, key, entry, usage, replace=False)
+        return BuildCacheView(self, source_hash)
+
+    def __delitem__(self, source_hash):
+        with self._transaction() as conn:
+            if conn.execute('DELETE FROM source_hashes WHERE source_hash = ?', (source_hash,)).rowcount == 0:
+                raise KeyError(source_hash)
+            conn.execute('DELETE FROM layouts WHERE source_hash = ?', (source_hash,))
+
+    def __getitem__(self, source_hash):
+        if not self._query('SELECT 1 FROM source_hashes WHERE source_hash = ?', source_hash):
+            raise KeyError(source_hash)
+        return BuildCacheView(self, source_hash)
+
+    def __iter__(self):
+        return iter([row[0] for row in self._query('SELECT source_hash FROM source_hashes')])
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM source_hashes')[0][0]
+
+
+class BuildCacheView(MutableMapping):
+    '''
+    Live key -> entry mapping for one source_hash in a BuildCache
+    '''
+    def __init__(self, cache, source_hash):
+        self.cache = cache
+        self.source_hash = source_hash
+
+    def __setitem__(self, key, entry):
+        usage = self.cache._usage(entry)
+        with self.cache._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO source_hashes VALUES (?)', (self.source_hash,))
+            self.cache._set_entry(conn, self.source_hash, key, entry, usage)
 
     def __delitem__(self, key):
-        del self._dict[key]
-        self.save_cache()
+        with self.cache._transaction() as conn:
+            if conn.execute('DELETE FROM layouts WHERE source_hash = ? AND key = ?',
+                            (self.source_hash, key)).rowcount == 0:
+                raise KeyError(key)
 
     def __getitem__(self, key):
-        return self._dict[key]
+        rows = self.cache._query('SELECT entry FROM layouts WHERE source_hash = ? AND key = ?',
+                                 self.source_hash, key)
+        if not rows:
+            raise KeyError(key)
+        return json.loads(rows[0][0])
 
     def __iter__(self):
-        return iter(self._dict)
+        return iter([row[0] for row in self.cache._query('SELECT key FROM layouts WHERE source_hash = ?',
+                                                          self.source_hash)])
 
     def __len__(self):
-        return len(self._dict)
-
-    def __del__(self):
-        self.save_cache()
+        return self.cache._query('SELECT COUNT(*) FROM layouts WHERE source_hash = ?', self.source_hash)[0][0]
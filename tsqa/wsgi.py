@@ -0,0 +1,1146 @@
+'''
+HTTP servers for WSGI apps, used as the origins behind tsqa.endpoint
+
+wsgiref (the "simple" backend) handles one connection at a time, which makes
+the origin the bottleneck as soon as a test pushes concurrent traffic through
+the proxy. This adds two more backends with the same interface (serve_forever,
+shutdown, server_address/server_port):
+    - thread: connections are accepted into a queue, and served by a pool of
+        worker threads
+    - event: one thread multiplexing all connections with epoll (or poll).
+        Thousands of connections cost very little, but the app is called from
+        the event loop, so handlers must not block.
+
+Files returned through wsgi.file_wrapper (see FileWrapper) are sent with
+sendfile(2), so serving them doesn't read them into (python's) memory.
+
+Both speak HTTP/1.1: connections are kept alive (and pipelined requests
+answered in order) until the client closes, max_requests have been served on
+it, or it sits idle for idle_timeout seconds. Each server counts connections
+and requests, so tests can check how well the proxy reuses its origin
+connections.
+'''
+#  Licensed to the Apache Software Foundation (ASF) under one
+#  or more contributor license agreements.  See the NOTICE file
+#  distributed with this work for additional information
+#  regarding copyright ownership.  The ASF licenses this file
+#  to you under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance
+#  with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import ctypes
+import ctypes.util
+import errno
+import itertools
+import logging
+import os
+import Queue
+import select
+import socket
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from cStringIO import StringIO
+from email.utils import formatdate
+from wsgiref.simple_server import WSGIServer, make_server as make_simple_server
+
+log = logging.getLogger(__name__)
+
+# largest request head we'll buffer
+MAX_HEADER_BYTES = 64 * 1024
+RECV_BYTES = 64 * 1024
+# most we sendfile() in one call
+SENDFILE_BYTES = 4 * 1024 * 1024
+
+# default seconds a kept-alive connection may sit idle
+IDLE_TIMEOUT = 30
+
+SERVER_SOFTWARE = 'tsqa'
+CONTINUE = 'HTTP/1.1 100 Continue\r\n\r\n'
+
+
+class HTTPError(Exception):
+    '''
+    Error in a request, which we respond to with status (and then close)
+    '''
+    def __init__(self, status, message=''):
+        super(HTTPError, self).__init__(status, message)
+        self.status = status
+        self.message = message
+
+
+class Request(object):
+    '''
+    A parsed request
+    '''
+    __slots__ = ('method', 'target', 'version', 'headers', 'body')
+
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.target = target
+        self.version = version
+        # list of (name, value)
+        self.headers = headers
+        self.body = body
+
+    def header(self, name, default=None):
+        '''
+        Return the value of header name (all values joined by ","), or default
+        '''
+        name = name.lower()
+        values = [value for key, value in self.headers if key.lower() == name]
+        if not values:
+            return default
+        return ', '.join(values)
+
+
+def parse_head(head):
+    '''
+    Return (method, target, version, headers) of a request head
+    '''
+    lines = head.replace('\r\n', '\n').split('\n')
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+        raise HTTPError('400 Bad Request', 'Bad request line: {0!r}'.format(lines[0]))
+    headers = []
+    for line in lines[1:]:
+        # (obsolete) continuation of the previous header
+        if line[:1] in (' ', '\t') and headers:
+            headers[-1] = (headers[-1][0], headers[-1][1] + ' ' + line.strip())
+            continue
+        name, sep, value = line.partition(':')
+        if not sep or not name or name != name.strip():
+            raise HTTPError('400 Bad Request', 'Bad header: {0!r}'.format(line))
+        headers.append((name, value.strip()))
+    return parts[0], parts[1], parts[2], headers
+
+
+class RequestParser(object):
+    '''
+    Incrementally parse requests out of the bytes read from a connection
+    (there may be more than one in there, if the client pipelines)
+    '''
+    def __init__(self, max_header_bytes=MAX_HEADER_BYTES):
+        self.max_header_bytes = max_header_bytes
+        self._buffer = ''
+        # (method, target, version, headers) while reading the body
+        self._head = None
+        self._body = []
+        # bytes of body left to read (Content-Length), or None if chunked
+        self._remaining = 0
+        # for chunked bodies: bytes left in the current chunk, or None when we
+        # need a chunk size line next
+        self._chunk_remaining = None
+        self._in_trailer = False
+
+    def feed(self, data):
+        self._buffer += data
+
+    def pending(self):
+        '''
+        Return whether we have (part of) another request buffered
+        '''
+        return self._head is not None or bool(self._buffer.lstrip('\r\n'))
+
+    def expects_continue(self):
+        '''
+        Return whether the client is waiting for a 100 Continue to send the body
+        '''
+        return (self._head is not None and
+                any(name.lower() == 'expect' and value.lower() == '100-continue'
+                    for name, value in self._head[3]))
+
+    def _read_head(self):
+        # clients may send extra CRLFs between requests
+        self._buffer = self._buffer.lstrip('\r\n')
+        end = self._buffer.find('\r\n\r\n')
+        sep_len = 4
+        if end < 0:
+            end = self._buffer.find('\n\n')
+            sep_len = 2
+        if end < 0:
+            if len(self._buffer) > self.max_header_bytes:
+                raise HTTPError('431 Request Header Fields Too Large')
+            return False
+        self._head = parse_head(self._buffer[:end])
+        self._buffer = self._buffer[end + sep_len:]
+        self._body = []
+
+        headers = self._head[3]
+        transfer_encoding = ','.join(value for name, value in headers if name.lower() == 'transfer-encoding')
+        content_length = [value for name, value in headers if name.lower() == 'content-length']
+        if 'chunked' in transfer_encoding.lower():
+            self._remaining = None
+            self._chunk_remaining = None
+            self._in_trailer = False
+        elif content_length:
+            try:
+                self._remaining = int(content_length[0])
+            except ValueError:
+                raise HTTPError('400 Bad Request', 'Bad Content-Length')
+            if self._remaining < 0:
+                raise HTTPError('400 Bad Request', 'Bad Content-Length')
+        else:
+            self._remaining = 0
+        return True
+
+    def _read_chunked(self):
+        '''
+        Read as much of a chunked body as we have, returns whether it's done
+        '''
+        while True:
+            if self._in_trailer:
+                end = self._buffer.find('\r\n')
+                if end < 0:
+                    return False
+                line = self._buffer[:end]
+                self._buffer = self._buffer[end + 2:]
+                if not line:
+                    return True
+                continue
+            if self._chunk_remaining is None:
+                end = self._buffer.find('\r\n')
+                if end < 0:
+                    return False
+                try:
+                    size = int(self._buffer[:end].split(';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise HTTPError('400 Bad Request', 'Bad chunk size')
+                self._buffer = self._buffer[end + 2:]
+                if size == 0:
+                    self._in_trailer = True
+                    continue
+                # the chunk, and its CRLF
+                self._chunk_remaining = size + 2
+            data = self._buffer[:self._chunk_remaining]
+            self._buffer = self._buffer[len(data):]
+            # everything but the CRLF is part of the body
+            self._body.append(data[:max(self._chunk_remaining - 2, 0)])
+            self._chunk_remaining -= len(data)
+            if self._chunk_remaining > 0:
+                return False
+            self._chunk_remaining = None
+
+    def next_request(self):
+        '''
+        Return the next complete Request, or None if we need more data
+        '''
+        if self._head is None and not self._read_head():
+            return None
+        if self._remaining is None:
+            if not self._read_chunked():
+                return None
+        else:
+            data = self._buffer[:self._remaining]
+            self._buffer = self._buffer[len(data):]
+            self._remaining -= len(data)
+            self._body.append(data)
+            if self._remaining > 0:
+                return None
+        method, target, version, headers = self._head
+        self._head = None
+        body, self._body = ''.join(self._body), []
+        return Request(method, target, version, headers, body)
+
+
+def _load_sendfile():
+    '''
+    Return libc's sendfile (python 2 has no os.sendfile), or None
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    func.restype = ctypes.c_ssize_t
+    return func
+
+_sendfile = _load_sendfile()
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    '''
+    Send count bytes from offset of the file in_fd to out_fd, returning how
+    many were sent (raises OSError, like EAGAIN if out_fd is non-blocking)
+    '''
+    offset = ctypes.c_int64(offset)
+    sent = _sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+    if sent < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return sent
+
+
+class FileWrapper(object):
+    '''
+    wsgi.file_wrapper: iterate over a file in blksize blocks. Besides the
+    standard (filelike, blksize) this takes an offset and length to send just
+    part of the file. If the file has a fileno (and we have sendfile) the
+    servers sendfile() it instead of iterating.
+    '''
+    def __init__(self, filelike, blksize=64 * 1024, offset=None, length=None):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.offset = offset
+        self.length = length
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def close(self):
+        pass
+
+    def fileno(self):
+        '''
+        Return the fd of the file, or None if it doesn't have one
+        '''
+        try:
+            return self.filelike.fileno()
+        except (AttributeError, IOError, ValueError):
+            return None
+
+    def sendable(self):
+        '''
+        Return whether the servers can sendfile() this
+        '''
+        return _sendfile is not None and self.fileno() is not None
+
+    def range(self):
+        '''
+        Return (offset, length) of the part of the file to send (length None
+        if unknown)
+        '''
+        offset = self.offset
+        if offset is None:
+            offset = self.filelike.tell() if hasattr(self.filelike, 'tell') else 0
+        length = self.length
+        if length is None and self.fileno() is not None:
+            length = max(os.fstat(self.fileno()).st_size - offset, 0)
+        return offset, length
+
+    def __iter__(self):
+        if self.offset is not None:
+            self.filelike.seek(self.offset)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            data = self.filelike.read(self.blksize if remaining is None else min(self.blksize, remaining))
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+
+def make_environ(request, server_address, client_address, multithread=True):
+    '''
+    Return the WSGI environ for request
+    '''
+    target = request.target
+    # absolute-form (from a client talking to us as a proxy)
+    if '://' in target:
+        target = urlparse.urlunsplit(('', '') + urlparse.urlsplit(target)[2:])
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': urllib.unquote(path),
+        'QUERY_STRING': query,
+        'SERVER_NAME': server_address[0],
+        'SERVER_PORT': str(server_address[1]),
+        'SERVER_PROTOCOL': request.version,
+        'SERVER_SOFTWARE': SERVER_SOFTWARE,
+        'REMOTE_ADDR': client_address[0],
+        'REMOTE_PORT': str(client_address[1]),
+        'CONTENT_LENGTH': str(len(request.body)) if request.body else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(request.body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': multithread,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper,
+    }
+    for name, value in request.headers:
+        key = name.upper().replace('-', '_')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        # we already de-chunked the body
+        if key in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):
+            continue
+        key = 'HTTP_' + key
+        if key in environ:
+            environ[key] += ',' + value
+        else:
+            environ[key] = value
+    return environ
+
+
+class Response(object):
+    '''
+    The response of a WSGI app: status, headers and an iterator of the body
+    '''
+    def __init__(self, status, headers, body, close=None, file=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self._close = close
+        # the FileWrapper the app returned (if it did)
+        self.file = file
+
+    @property
+    def code(self):
+        return int(self.status.split(' ', 1)[0])
+
+    def header(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+
+def error_response(status, message=''):
+    return Response(status, [('Content-Type', 'text/plain'), ('Content-Length', str(len(message)))], iter([message]))
+
+
+def call_app(app, environ):
+    '''
+    Call a WSGI app, and return its Response
+    '''
+    started = []
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and started:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        started[:] = [(status, headers)]
+        return written.append
+
+    try:
+        result = app(environ, start_response)
+        body = iter(result)
+        # start_response may be called when the body is first iterated
+        first = []
+        while not started:
+            first.append(next(body))
+    except Exception:
+        log.exception('Error calling {0}'.format(app))
+        return error_response('500 Internal Server Error')
+    status, headers = started[0]
+    # (we can only sendfile the file if nothing was read from it yet)
+    file = result if isinstance(result, FileWrapper) and not first and not written else None
+    return Response(status, list(headers), itertools.chain(written, first, body), getattr(result, 'close', None),
+                    file=file)
+
+
+def frame_response(request, response, keep_alive):
+    '''
+    Return (head, body iterator, keep_alive) to send for response. keep_alive
+    is whether the connection may be kept open (if the response's length can
+    be framed)
+    '''
+    headers = [(name, value) for name, value in response.headers
+               if name.lower() not in ('connection', 'keep-alive', 'transfer-encoding')]
+    names = set(name.lower() for name, _ in headers)
+    body = response.body
+    code = response.code
+    if request.method == 'HEAD' or code < 200 or code in (204, 304):
+        body = None
+    elif 'content-length' not in names:
+        if keep_alive and request.version != 'HTTP/1.0':
+            headers.append(('Transfer-Encoding', 'chunked'))
+            body = _chunked(body)
+        else:
+            # delimit the body by closing the connection
+            keep_alive = False
+
+    if 'date' not in names:
+        headers.append(('Date', formatdate(usegmt=True)))
+    if 'server' not in names:
+        headers.append(('Server', SERVER_SOFTWARE))
+    if not keep_alive:
+        headers.append(('Connection', 'close'))
+    elif request.version == 'HTTP/1.0':
+        headers.append(('Connection', 'keep-alive'))
+
+    head = ['HTTP/1.1 ', response.status, '\r\n']
+    for name, value in headers:
+        head.extend((name, ': ', value, '\r\n'))
+    head.append('\r\n')
+    return ''.join(head), body, keep_alive
+
+
+def _chunked(body):
+    '''
+    Chunked transfer-encode the body iterator
+    '''
+    for chunk in body:
+        if chunk:
+            yield '{0:x}\r\n{1}\r\n'.format(len(chunk), chunk)
+    yield '0\r\n\r\n'
+
+
+class SimpleWSGIServer(WSGIServer):
+    '''
+    wsgiref's server (one request per connection), with the same counters as
+    the other backends
+    '''
+    def __init__(self, *args, **kwargs):
+        WSGIServer.__init__(self, *args, **kwargs)
+        self.connections = 0
+        self.requests = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        self.requests += 1
+        WSGIServer.process_request(self, request, client_address)
+
+    def counters(self):
+        return {'connections': self.connections, 'requests': self.requests}
+
+
+class BaseWSGIServer(object):
+    '''
+    Listening socket and shutdown handling shared by the backends
+    '''
+    multithread = True
+
+    def __init__(self, server_address, app, request_queue_size=1024, idle_timeout=IDLE_TIMEOUT, max_requests=None):
+        '''
+        idle_timeout is how long (in seconds) a connection may be kept open
+        waiting for its next request, and max_requests how many requests may
+        be served on one connection (None for no limit)
+        '''
+        self.app = app
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.socket.bind(server_address)
+            self.socket.listen(request_queue_size)
+        except:
+            self.socket.close()
+            raise
+        self.server_address = self.socket.getsockname()
+        self.server_name = self.server_address[0]
+        self.server_port = self.server_address[1]
+        self._shutdown = threading.Event()
+        self._stopped = threading.Event()
+        self._stopped.set()
+        # to wake up the loop in serve_forever
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        # counters
+        self.connections = 0
+        self.requests = 0
+        self._counter_lock = threading.Lock()
+
+    def _count(self, connections=0, requests=0):
+        with self._counter_lock:
+            self.connections += connections
+            self.requests += requests
+
+    def counters(self):
+        '''
+        Return a dict of the connections accepted and requests served so far
+        '''
+        with self._counter_lock:
+            return {'connections': self.connections, 'requests': self.requests}
+
+    def handle_request(self, request, client_address, served=1):
+        '''
+        Call the app for request (the served'th on its connection), returning
+        (head, body iterator, keep_alive)
+        '''
+        self._count(requests=1)
+        environ = make_environ(request, self.server_address, client_address, multithread=self.multithread)
+        response = call_app(self.app, environ)
+        head, body, keep_alive = frame_response(request, response, self.keep_alive(request, served))
+        if body is None:
+            response.close()
+            return head, None, keep_alive
+        # the servers sendfile() a FileWrapper body (unless it had to be chunked)
+        if body is response.body and response.file is not None and response.file.sendable():
+            return head, response.file, keep_alive
+        return head, _closing(body, response), keep_alive
+
+    def keep_alive(self, request, served):
+        '''
+        Return whether the connection may be reused after request, having
+        served served requests on it
+        '''
+        if self._shutdown.is_set():
+            return False
+        if self.max_requests is not None and served >= self.max_requests:
+            return False
+        tokens = [token.strip() for token in (request.header('Connection') or '').lower().split(',')]
+        if 'close' in tokens:
+            return False
+        if request.version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+        return True
+
+    def serve_forever(self):
+        raise NotImplementedError()
+
+    def shutdown(self):
+        '''
+        Stop serve_forever, and wait for it to exit
+        '''
+        self._shutdown.set()
+        self._wakeup()
+        self._stopped.wait()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError:
+            pass
+
+    def server_close(self):
+        self.socket.close()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _closing(body, response):
+    '''
+    Iterate over body, closing response when done (or when closed early)
+    '''
+    try:
+        for chunk in body:
+            yield chunk
+    finally:
+        response.close()
+
+
+class _Poller(object):
+    '''
+    epoll if we have it, otherwise poll (same events, timeout in seconds)
+    '''
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._scale = 1
+        else:
+            self._poller = select.poll()
+            self._scale = 1000
+        self.register = self._poller.register
+        self.modify = self._poller.modify
+        self.unregister = self._poller.unregister
+
+    def poll(self, timeout):
+        return self._poller.poll(timeout * self._scale)
+
+    def close(self):
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
+
+
+READ = select.POLLIN | select.POLLPRI
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP
+
+
+class _Connection(object):
+    __slots__ = ('sock', 'client_address', 'parser', 'requests', 'idle_since',
+                 'out', 'out_offset', 'body', 'file', 'file_offset', 'file_remaining',
+                 'keep_alive', 'continue_sent')
+
+    def __init__(self, sock, client_address):
+        self.sock = sock
+        self.client_address = client_address
+        self.parser = RequestParser()
+        # requests served on the connection
+        self.requests = 0
+        # when we finished the last response (or accepted the connection)
+        self.idle_since = time.time()
+        # strings to send (the first one from out_offset)
+        self.out = []
+        self.out_offset = 0
+        # body iterator of the response being sent
+        self.body = None
+        # or the FileWrapper to sendfile(), and what's left of it
+        self.file = None
+        self.file_offset = 0
+        self.file_remaining = 0
+        self.keep_alive = False
+        self.continue_sent = False
+
+
+def _idle(connections, timeout):
+    '''
+    Return the connections which have been idle for longer than timeout
+    '''
+    deadline = time.time() - timeout
+    return [conn for conn in connections
+            if (conn.idle_since < deadline and conn.body is None and conn.file is None and
+                not conn.out and not conn.parser.pending())]
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    '''
+    Serve requests with a pool of threads. Connections are only handed to a
+    thread once they have something to read, and go back to waiting between
+    requests, so idle (kept-alive) connections don't tie up the pool; beyond
+    that they wait in a queue until a thread is free.
+    '''
+    def __init__(self, server_address, app, threads=128, timeout=60, shutdown_timeout=5, **kwargs):
+        '''
+        timeout is how long a thread waits for the rest of a request it has
+        started reading, shutdown_timeout how long shutdown() waits for the
+        threads to exit (once the connections they are serving are shut down)
+        '''
+        super(ThreadPoolWSGIServer, self).__init__(server_address, app, **kwargs)
+        self.threads = threads
+        self.timeout = timeout
+        self.shutdown_timeout = shutdown_timeout
+        self._queue = Queue.Queue()
+        self._workers = []
+        # connections being served by the workers, and whether we are stopping
+        # (so connections are no longer served)
+        self._active = set()
+        self._closing = False
+        self._active_lock = threading.Lock()
+        # fd -> _Connection of connections waiting for a request
+        self._waiting = {}
+        # connections workers are done with, to go back in _waiting
+        self._returned = []
+        self._returned_lock = threading.Lock()
+
+    def serve_forever(self):
+        self._stopped.clear()
+        self._closing = False
+        poller = _Poller()
+        poller.register(self.socket.fileno(), READ)
+        poller.register(self._wakeup_r, READ)
+        last_sweep = time.time()
+        try:
+            for _ in xrange(self.threads):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+            while not self._shutdown.is_set():
+                try:
+                    events = poller.poll(min(0.5, self.idle_timeout))
+                except (IOError, OSError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, _ in events:
+                    if fd == self.socket.fileno():
+                        self._accept(poller)
+                    elif fd == self._wakeup_r:
+                        os.read(self._wakeup_r, 4096)
+                        with self._returned_lock:
+                            returned, self._returned = self._returned, []
+                        for conn in returned:
+                            self._waiting[conn.sock.fileno()] = conn
+                            poller.register(conn.sock.fileno(), READ)
+                    elif fd in self._waiting:
+                        poller.unregister(fd)
+                        self._queue.put(self._waiting.pop(fd))
+                if time.time() - last_sweep >= min(1, self.idle_timeout):
+                    last_sweep = time.time()
+                    for conn in _idle(self._waiting.values(), self.idle_timeout):
+                        poller.unregister(conn.sock.fileno())
+                        del self._waiting[conn.sock.fileno()]
+                        conn.sock.close()
+        finally:
+            # cut off the responses in flight (a slow or huge one could take
+            # forever), rather than waiting for them
+            with self._active_lock:
+                self._closing = True
+                for conn in self._active:
+                    try:
+                        conn.sock.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+            for _ in self._workers:
+                self._queue.put(None)
+            deadline = time.time() + self.shutdown_timeout
+            for worker in self._workers:
+                worker.join(max(0, deadline - time.time()))
+                if worker.is_alive():
+                    log.warning('Worker thread still busy at shutdown')
+            self._workers = []
+            for conn in self._waiting.values() + self._returned:
+                conn.sock.close()
+            self._waiting = {}
+            self._returned = []
+            poller.close()
+            self._shutdown.clear()
+            self._stopped.set()
+
+    def _accept(self, poller):
+        try:
+            sock, client_address = self.socket.accept()
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.ECONNABORTED, errno.EINTR, errno.EMFILE, errno.ENFILE):
+                raise
+            log.warning('Error accepting connection: {0}'.format(e))
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._count(connections=1)
+        self._waiting[sock.fileno()] = _Connection(sock, client_address)
+        poller.register(sock.fileno(), READ)
+
+    def _work(self):
+        while True:
+            conn = self._queue.get()
+            if conn is None:
+                break
+            with self._active_lock:
+                if self._closing:
+                    conn.sock.close()
+                    continue
+                self._active.add(conn)
+            try:
+                keep = self.handle_connection(conn)
+            except Exception:
+                if not self._closing:
+                    log.exception('Error handling connection from {0}'.format(conn.client_address))
+                keep = False
+            with self._active_lock:
+                self._active.discard(conn)
+            if keep and not self._shutdown.is_set():
+                conn.idle_since = time.time()
+                with self._returned_lock:
+                    self._returned.append(conn)
+                self._wakeup()
+            else:
+                conn.sock.close()
+
+    def handle_connection(self, conn):
+        '''
+        Serve the requests of a connection which has something to read.
+        Returns whether to keep the connection open for more requests
+        '''
+        sock = conn.sock
+        parser = conn.parser
+        sock.settimeout(self.timeout)
+        while True:
+            try:
+                request = parser.next_request()
+                while request is None:
+                    if parser.expects_continue() and not conn.continue_sent:
+                        sock.sendall(CONTINUE)
+                        conn.continue_sent = True
+                    data = sock.recv(RECV_BYTES)
+                    if not data:
+                        return False
+                    parser.feed(data)
+                    request = parser.next_request()
+            except HTTPError as e:
+                response = error_response(e.status, e.message)
+                head, body, _ = frame_response(Request('GET', '/', 'HTTP/1.1', [], ''), response, False)
+                sock.sendall(head + ''.join(body))
+                return False
+            except socket.timeout:
+                return False
+            conn.continue_sent = False
+
+            conn.requests += 1
+            head, body, keep_alive = self.handle_request(request, conn.client_address, conn.requests)
+            if body is None:
+                sock.sendall(head)
+            elif isinstance(body, FileWrapper):
+                try:
+                    sock.sendall(head)
+                    self._sendfile(sock, body)
+                finally:
+                    body.close()
+            else:
+                try:
+                    # send the head with the first chunk
+                    for chunk in body:
+                        if head is not None:
+                            chunk, head = head + chunk, None
+                        if chunk:
+                            sock.sendall(chunk)
+                    if head is not None:
+                        sock.sendall(head)
+                finally:
+                    body.close()
+            if not keep_alive:
+                return False
+            # answer pipelined requests right away, otherwise wait for the
+            # next one without holding on to this thread
+            if not parser.pending():
+                return True
+
+    def _sendfile(self, sock, wrapper):
+        '''
+        sendfile() wrapper to sock (which has a timeout, so is non-blocking
+        underneath)
+        '''
+        offset, remaining = wrapper.range()
+        while remaining > 0:
+            try:
+                sent = sendfile(sock.fileno(), wrapper.fileno(), offset, min(remaining, SENDFILE_BYTES))
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+                _, writable, _ = select.select([], [sock], [], self.timeout)
+                if not writable:
+                    raise socket.timeout()
+                continue
+            if sent == 0:
+                # the file shrank, the client will notice it's short
+                raise Exception('{0} ended at {1}, {2} bytes early'.format(wrapper.filelike, offset, remaining))
+            offset += sent
+            remaining -= sent
+
+
+class EventLoopWSGIServer(BaseWSGIServer):
+    '''
+    Serve all connections from one thread, with non-blocking sockets and epoll
+    (or poll). Responses are streamed from the body iterator as the socket
+    becomes writable, so a large body doesn't have to be in memory at once.
+    The app is called from the loop, so it must not block.
+    '''
+    multithread = False
+
+    def __init__(self, server_address, app, **kwargs):
+        super(EventLoopWSGIServer, self).__init__(server_address, app, **kwargs)
+        self.socket.setblocking(0)
+        # fd -> _Connection
+        self._connections = {}
+
+    def serve_forever(self):
+        self._stopped.clear()
+        self._poller = _Poller()
+        self._poller.register(self.socket.fileno(), READ)
+        self._poller.register(self._wakeup_r, READ)
+        last_sweep = time.time()
+        try:
+            while not self._shutdown.is_set():
+                try:
+                    events = self._poller.poll(min(1, self.idle_timeout))
+                except (IOError, OSError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, event in events:
+                    if fd == self.socket.fileno():
+                        self._accept()
+                    elif fd == self._wakeup_r:
+                        os.read(self._wakeup_r, 4096)
+                    elif fd in self._connections:
+                        self._handle_event(self._connections[fd], event)
+                if time.time() - last_sweep >= min(1, self.idle_timeout):
+                    last_sweep = time.time()
+                    for conn in _idle(self._connections.values(), self.idle_timeout):
+                        self._close(conn)
+        finally:
+            for conn in self._connections.values():
+                self._close(conn)
+            self._poller.close()
+            self._shutdown.clear()
+            self._stopped.set()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.errno in (errno.ECONNABORTED, errno.EINTR):
+                    continue
+                # out of fds etc., try again on the next event
+                log.warning('Error accepting connection: {0}'.format(e))
+                return
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._count(connections=1)
+            conn = _Connection(sock, client_address)
+            self._connections[sock.fileno()] = conn
+            self._poller.register(sock.fileno(), READ)
+
+    def _close(self, conn):
+        fd = conn.sock.fileno()
+        if self._connections.pop(fd, None) is not None:
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+        if conn.body is not None:
+            conn.body.close()
+            conn.body = None
+        if conn.file is not None:
+            conn.file.close()
+            conn.file = None
+        conn.sock.close()
+
+    def _handle_event(self, conn, event):
+        try:
+            if event & WRITE:
+                if self._write(conn):
+                    self._process(conn)
+            elif event & (READ | ERROR):
+                self._read(conn)
+        except Exception:
+            log.exception('Error handling connection from {0}'.format(conn.client_address))
+            self._close(conn)
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(RECV_BYTES)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._close(conn)
+            return
+        if not data:
+            self._close(conn)
+            return
+        conn.parser.feed(data)
+        self._process(conn)
+
+    def _process(self, conn):
+        '''
+        Respond to the requests we have all of, until one can't be written out
+        right away
+        '''
+        while True:
+            try:
+                request = conn.parser.next_request()
+            except HTTPError as e:
+                head, body, _ = frame_response(Request('GET', '/', 'HTTP/1.1', [], ''),
+                                               error_response(e.status, e.message), False)
+                conn.out = [head + ''.join(body)]
+                conn.out_offset = 0
+                conn.keep_alive = False
+                self._write(conn)
+                return
+            if request is None:
+                if conn.parser.expects_continue() and not conn.continue_sent:
+                    conn.continue_sent = True
+                    conn.sock.send(CONTINUE)
+                return
+            conn.continue_sent = False
+
+            conn.requests += 1
+            head, conn.body, conn.keep_alive = self.handle_request(request, conn.client_address, conn.requests)
+            if isinstance(conn.body, FileWrapper):
+                conn.file, conn.body = conn.body, None
+                conn.file_offset, conn.file_remaining = conn.file.range()
+            conn.out = [head]
+            conn.out_offset = 0
+            if not self._write(conn):
+                return
+
+    def _write(self, conn):
+        '''
+        Write out as much of the response as we can. Returns whether it is done,
+        and the connection is ready for the next request
+        '''
+        while True:
+            if not conn.out:
+                if conn.file is not None:
+                    if not self._sendfile(conn):
+                        return False
+                    continue
+                if conn.body is None:
+                    break
+                try:
+                    chunk = next(conn.body)
+                except StopIteration:
+                    conn.body = None
+                    continue
+                if chunk:
+                    conn.out.append(chunk)
+                continue
+            data = conn.out[0]
+            try:
+                sent = conn.sock.send(buffer(data, conn.out_offset))
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    sent = 0
+                else:
+                    self._close(conn)
+                    return False
+            conn.out_offset += sent
+            if conn.out_offset < len(data):
+                # the socket buffer is full, wait until it's writable (and
+                # don't read more pipelined requests in the meantime)
+                self._poller.modify(conn.sock.fileno(), WRITE)
+                return False
+            conn.out.pop(0)
+            conn.out_offset = 0
+
+        # done with this response
+        if not conn.keep_alive:
+            self._close(conn)
+            return False
+        conn.idle_since = time.time()
+        self._poller.modify(conn.sock.fileno(), READ)
+        return True
+
+    def _sendfile(self, conn):
+        '''
+        sendfile() as much of conn.file as we can. Returns whether it is done
+        '''
+        while conn.file_remaining > 0:
+            try:
+                sent = sendfile(conn.sock.fileno(), conn.file.fileno(), conn.file_offset,
+                                min(conn.file_remaining, SENDFILE_BYTES))
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    self._poller.modify(conn.sock.fileno(), WRITE)
+                    return False
+                self._close(conn)
+                return False
+            if sent == 0:
+                log.warning('{0} ended {1} bytes early'.format(conn.file.filelike, conn.file_remaining))
+                conn.keep_alive = False
+                break
+            conn.file_offset += sent
+            conn.file_remaining -= sent
+        conn.file.close()
+        conn.file = None
+        return True
+
+
+BACKENDS = {
+    'thread': ThreadPoolWSGIServer,
+    'event': EventLoopWSGIServer,
+}
+
+
+def make_server(host, port, app, backend=None, **kwargs):
+    '''
+    Return a server for app listening on (host, port). backend is one of
+    simple (wsgiref), thread or event, defaulting to TSQA_HTTP_BACKEND or simple.
+    kwargs are passed to the backend's server class (or wsgiref's make_server)
+    '''
+    if backend is None:
+        backend = os.environ.get('TSQA_HTTP_BACKEND', 'simple')
+    if backend == 'simple':
+        kwargs.setdefault('server_class', SimpleWSGIServer)
+        return make_simple_server(host, port, app, **kwargs)
+    if backend not in BACKENDS:
+        raise Exception('Unknown http backend: {0}'.format(backend))
+    return BACKENDS[backend]((host, port), app, **kwargs)